@@ -0,0 +1,311 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+
+import metrics
+from cache import invalidate_room
+from database import connect, pool
+
+# ---------------------------------------
+# Настройки архива
+# ---------------------------------------
+# Завершённые комнаты переносятся из santa.db в отдельный файл архива: строка
+# комнаты, участники, запреты и баны сжимаются zlib в один BLOB. Через сколько
+# дней после жеребьёвки (ARCHIVE_DRAWN_DAYS) или после последней активности
+# в комнате без жеребьёвки (ARCHIVE_INACTIVE_DAYS) это происходит; 0 — не архивировать
+ARCHIVE_DB = os.getenv("SANTA_ARCHIVE_DB", "santa_archive.db")
+ARCHIVE_DRAWN_DAYS = float(os.getenv("SANTA_ARCHIVE_DRAWN_DAYS", "60"))
+ARCHIVE_INACTIVE_DAYS = float(os.getenv("SANTA_ARCHIVE_INACTIVE_DAYS", "180"))
+ARCHIVE_INTERVAL = float(os.getenv("SANTA_ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH = 100
+
+# Компактизация: раз в COMPACT_INTERVAL секунд, если за это время апдейтов было
+# не больше COMPACT_IDLE_UPDATES, свободные страницы santa.db возвращаются ОС
+# шагами по COMPACT_PAGES страниц. Базе, созданной до включения auto_vacuum,
+# для перехода нужен один полный VACUUM; SANTA_COMPACT_FULL_VACUUM=0 его запрещает.
+COMPACT_INTERVAL = float(os.getenv("SANTA_COMPACT_INTERVAL", "60"))
+COMPACT_IDLE_UPDATES = int(os.getenv("SANTA_COMPACT_IDLE_UPDATES", "30"))
+COMPACT_FULL_VACUUM = os.getenv("SANTA_COMPACT_FULL_VACUUM", "1") == "1"
+COMPACT_PAGES = 256
+COMPACT_MIN_FREE_PAGES = 64
+COMPACT_STEP_PAUSE = 0.05
+
+logger = logging.getLogger("santa.archive")
+
+DAY = 24 * 3600
+
+
+async def _pragma(db, name):
+    cur = await db.execute(f"PRAGMA {name}")
+    return (await cur.fetchone())[0]
+
+
+# ---------------------------------------
+# Архив комнат
+# ---------------------------------------
+# Перенос одной комнаты — одна транзакция BEGIN IMMEDIATE в santa.db: пока
+# комната читается и пишется в архив, её никто не изменит. Если процесс упадёт
+# между commit архива и commit удаления, комната останется в santa.db и при
+# следующем проходе перезапишется в архиве той же строкой.
+class Archive:
+    def __init__(self, pool, path=ARCHIVE_DB, drawn_days=ARCHIVE_DRAWN_DAYS,
+                 inactive_days=ARCHIVE_INACTIVE_DAYS, interval=ARCHIVE_INTERVAL):
+        self.pool = pool
+        self.path = path
+        self.drawn_days = drawn_days
+        self.inactive_days = inactive_days
+        self.interval = interval
+        self.archived = 0
+        self.archived_bytes = 0
+        self._db = None
+        self._task = None
+
+    async def open(self):
+        # Читать архив может любой воркер, переносит комнаты только тот, где start()
+        if self._db is None:
+            self._db = await connect(self.path)
+            await self._db.execute("""
+            CREATE TABLE IF NOT EXISTS rooms (
+                id INTEGER PRIMARY KEY,
+                admin_id INTEGER NOT NULL,
+                title TEXT,
+                status TEXT,
+                participants INTEGER NOT NULL,
+                archived_at REAL NOT NULL,
+                data BLOB NOT NULL
+            )
+            """)
+            await self._db.execute("CREATE INDEX IF NOT EXISTS idx_rooms_admin ON rooms (admin_id, archived_at)")
+            await self._db.commit()
+        return self._db
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    def start(self):
+        if self._task is None and (self.drawn_days or self.inactive_days):
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.archive_due()
+            except Exception:
+                logger.exception("Ошибка при переносе комнат в архив")
+            await asyncio.sleep(self.interval)
+
+    # ---------------------------------------
+    # Чтение
+    # ---------------------------------------
+    async def rooms_of(self, admin_id, limit=20):
+        # -> [(id, title, status, участников, archived_at)], новые первыми
+        db = await self.open()
+        cur = await db.execute(
+            "SELECT id, title, status, participants, archived_at FROM rooms "
+            "WHERE admin_id=? ORDER BY archived_at DESC LIMIT ?", (admin_id, limit)
+        )
+        return await cur.fetchall()
+
+    async def load(self, room_id):
+        # -> dict с ключами room, participants, exclusions, bans или None
+        db = await self.open()
+        cur = await db.execute("SELECT archived_at, data FROM rooms WHERE id=?", (room_id,))
+        row = await cur.fetchone()
+        if row is None:
+            return None
+        data = json.loads(zlib.decompress(row[1]))
+        data["archived_at"] = row[0]
+        return data
+
+    # ---------------------------------------
+    # Перенос
+    # ---------------------------------------
+    def _cutoffs(self, now):
+        drawn = now - self.drawn_days * DAY if self.drawn_days else 0
+        inactive = now - self.inactive_days * DAY if self.inactive_days else 0
+        return drawn, inactive
+
+    async def archive_due(self, now=None):
+        # Переносит все подошедшие комнаты пачками по ARCHIVE_BATCH, возвращает их число
+        drawn, inactive = self._cutoffs(now or time.time())
+        total = 0
+        size = 0
+        while True:
+            async with self.pool.acquire() as db:
+                # Комнаты с ожидающими задачами (запланированная жеребьёвка,
+                # напоминания) ещё живые, их не трогаем
+                cur = await db.execute("""
+                SELECT id FROM rooms r
+                WHERE r.updated_at < ? AND ((r.status='drawn' AND r.updated_at < ?) OR r.updated_at < ?)
+                  AND NOT EXISTS (SELECT 1 FROM jobs j WHERE j.room_id=r.id AND j.status='pending')
+                ORDER BY r.updated_at LIMIT ?
+                """, (max(drawn, inactive), drawn, inactive, ARCHIVE_BATCH))
+                room_ids = [row[0] for row in await cur.fetchall()]
+            if not room_ids:
+                break
+            for room_id in room_ids:
+                size += await self.archive_room(room_id, drawn, inactive)
+            total += len(room_ids)
+            await asyncio.sleep(0)
+        if total:
+            logger.info("В архив перенесено комнат: %s (%.1f КБ в сжатом виде)", total, size / 1024)
+        return total
+
+    async def archive_room(self, room_id, drawn_before, inactive_before):
+        # -> размер сжатой записи или 0, если комната за это время ожила
+        archive_db = await self.open()
+        async with self.pool.acquire() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            cur = await db.execute("""
+            SELECT id, admin_id, title, status, password, description, updated_at FROM rooms r
+            WHERE id=? AND ((status='drawn' AND updated_at < ?) OR updated_at < ?)
+              AND NOT EXISTS (SELECT 1 FROM jobs j WHERE j.room_id=r.id AND j.status='pending')
+            """, (room_id, drawn_before, inactive_before))
+            room = await cur.fetchone()
+            if room is None:
+                await db.rollback()
+                return 0
+            cur = await db.execute(
+                "SELECT user_id, username, wishes, no_gifts, target_id, left FROM participants "
+                "WHERE room_id=? ORDER BY id", (room_id,)
+            )
+            participants = await cur.fetchall()
+            cur = await db.execute("SELECT giver_id, receiver_id, kind FROM exclusions WHERE room_id=?", (room_id,))
+            exclusions = await cur.fetchall()
+            cur = await db.execute("SELECT user_id FROM bans WHERE room_id=?", (room_id,))
+            bans = [row[0] for row in await cur.fetchall()]
+
+            data = zlib.compress(json.dumps({
+                "room": dict(zip(("id", "admin_id", "title", "status", "password", "description", "updated_at"), room)),
+                "participants": participants,
+                "exclusions": exclusions,
+                "bans": bans,
+            }, ensure_ascii=False).encode(), 9)
+            active = sum(1 for p in participants if not p[5])
+            await archive_db.execute(
+                "INSERT OR REPLACE INTO rooms (id, admin_id, title, status, participants, archived_at, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", (room[0], room[1], room[2], room[3], active, time.time(), data)
+            )
+            await archive_db.commit()
+
+            for table in ("participants", "exclusions", "bans", "jobs"):
+                await db.execute(f"DELETE FROM {table} WHERE room_id=?", (room_id,))
+            await db.execute("DELETE FROM rooms WHERE id=?", (room_id,))
+            await db.commit()
+        invalidate_room(room_id)
+        self.archived += 1
+        self.archived_bytes += len(data)
+        return len(data)
+
+
+# ---------------------------------------
+# Компактизация santa.db
+# ---------------------------------------
+# После удаления строк файл базы не уменьшается: страницы попадают в список
+# свободных. В режиме auto_vacuum=INCREMENTAL (database.PRAGMAS) их можно
+# отдать ОС командой PRAGMA incremental_vacuum(N) — короткой транзакцией
+# записи на каждые N страниц. Между шагами проверяем, не пошли ли апдейты,
+# и если пошли, откладываем остаток до следующего тихого интервала.
+class Compactor:
+    def __init__(self, pool, interval=COMPACT_INTERVAL, idle_updates=COMPACT_IDLE_UPDATES,
+                 full_vacuum=COMPACT_FULL_VACUUM, pages=COMPACT_PAGES):
+        self.pool = pool
+        self.interval = interval
+        self.idle_updates = idle_updates
+        self.full_vacuum = full_vacuum
+        self.pages = pages
+        self.reclaimed_bytes = 0
+        self.free_pages = 0
+        self.last_report = None
+        self._seen_updates = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._seen_updates = metrics.update_seconds.total()[1]
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _quiet(self):
+        # Число апдейтов с прошлой проверки по метрикам этого воркера
+        seen = metrics.update_seconds.total()[1]
+        quiet = seen - self._seen_updates <= self.idle_updates
+        self._seen_updates = seen
+        return quiet
+
+    def _busy(self):
+        return metrics.updates_in_flight.values[None] > 0
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._quiet():
+                continue
+            try:
+                await self.compact()
+            except Exception:
+                logger.exception("Ошибка компактизации базы")
+
+    async def compact(self):
+        # -> сколько байт файла базы освобождено за этот запуск
+        async with self.pool.acquire() as db:
+            page_size = await _pragma(db, "page_size")
+            pages_before = await _pragma(db, "page_count")
+            self.free_pages = await _pragma(db, "freelist_count")
+            mode = await _pragma(db, "auto_vacuum")
+            if self.free_pages < COMPACT_MIN_FREE_PAGES:
+                return 0
+            started = time.perf_counter()
+            if mode != 2:
+                if not self.full_vacuum:
+                    return 0
+                # Переключение в INCREMENTAL возможно только полным VACUUM: он
+                # переписывает файл целиком и на это время блокирует запись
+                logger.info("Перевод базы в auto_vacuum=INCREMENTAL: полный VACUUM %s страниц", pages_before)
+                await db.executescript("PRAGMA auto_vacuum=INCREMENTAL; VACUUM")
+        if mode == 2:
+            # Соединение берём на каждый шаг, чтобы не держать его, пока ждём
+            while self.free_pages and not self._busy():
+                async with self.pool.acquire() as db:
+                    await db.executescript(f"PRAGMA incremental_vacuum({self.pages})")
+                    self.free_pages = await _pragma(db, "freelist_count")
+                await asyncio.sleep(COMPACT_STEP_PAUSE)
+        async with self.pool.acquire() as db:
+            # WAL после компактизации разрастается на те же страницы, обнуляем его
+            await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            pages_after = await _pragma(db, "page_count")
+            self.free_pages = await _pragma(db, "freelist_count")
+        reclaimed = (pages_before - pages_after) * page_size
+        self.reclaimed_bytes += reclaimed
+        self.last_report = {
+            "at": time.time(),
+            "seconds": time.perf_counter() - started,
+            "reclaimed_bytes": reclaimed,
+            "size_before": pages_before * page_size,
+            "size_after": pages_after * page_size,
+            "free_pages_left": self.free_pages,
+        }
+        logger.info(
+            "Компактизация: освобождено %.1f МБ (%.1f -> %.1f МБ) за %.2f с, свободных страниц осталось %s",
+            reclaimed / 2 ** 20, pages_before * page_size / 2 ** 20, pages_after * page_size / 2 ** 20,
+            self.last_report["seconds"], self.free_pages
+        )
+        return reclaimed
+
+
+archive = Archive(pool)
+compactor = Compactor(pool)
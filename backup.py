@@ -0,0 +1,228 @@
+import asyncio
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+from database import DB_FILE
+
+# ---------------------------------------
+# Настройки резервного копирования
+# ---------------------------------------
+# Снимок santa.db делается раз в BACKUP_INTERVAL секунд (0 — только по команде
+# /admin backup), сжимается gzip и кладётся в BACKUP_DIR; хранятся BACKUP_KEEP
+# последних. Копирование идёт шагами по BACKUP_PAGES страниц с паузой между ними.
+BACKUP_DIR = os.getenv("SANTA_BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.getenv("SANTA_BACKUP_INTERVAL", str(6 * 3600)))
+BACKUP_KEEP = int(os.getenv("SANTA_BACKUP_KEEP", "14"))
+BACKUP_PAGES = int(os.getenv("SANTA_BACKUP_PAGES", "256"))
+BACKUP_STEP_PAUSE = 0.005
+# Если базу меняют быстрее, чем идёт копия, SQLite начинает её заново; после
+# стольких перезапусков остаток копируется одним шагом
+BACKUP_MAX_RESTARTS = 3
+BACKUP_PREFIX = "santa-"
+
+logger = logging.getLogger("santa.backup")
+
+_name = re.compile(rf"^{BACKUP_PREFIX}\d{{8}}-\d{{6}}(-[a-z]+)?\.db\.gz$")
+
+
+class BackupError(Exception):
+    pass
+
+
+class _Restart(Exception):
+    pass
+
+
+def _copy(source, target, pages, stats):
+    # Online backup API: каждый шаг держит блокировку чтения источника только на
+    # время копирования pages страниц. В режиме WAL чтение не мешает записи, а
+    # в режиме rollback-журнала писатели ждут не дольше одного шага.
+    last = [time.perf_counter(), None]
+
+    def progress(status, remaining, total):
+        now = time.perf_counter()
+        step = now - last[0]
+        stats["steps"] += 1
+        stats["locked_seconds"] += step
+        stats["max_step_seconds"] = max(stats["max_step_seconds"], step)
+        stats["pages"] = total
+        if last[1] is not None and remaining > last[1]:
+            stats["restarts"] += 1
+            if stats["restarts"] >= BACKUP_MAX_RESTARTS and pages > 0:
+                raise _Restart()
+        last[1] = remaining
+        if remaining:
+            time.sleep(BACKUP_STEP_PAUSE)
+        last[0] = time.perf_counter()
+
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    except _Restart:
+        source.backup(target, pages=-1, progress=progress)
+
+
+# ---------------------------------------
+# Снимки базы
+# ---------------------------------------
+# Вся работа с файлами идёт в потоке (run_in_executor) на отдельных соединениях
+# sqlite3, пул и event loop бота не заняты. Одновременно выполняется одна
+# операция: снимок, проверка или восстановление.
+class Backups:
+    def __init__(self, path=DB_FILE, directory=BACKUP_DIR, keep=BACKUP_KEEP, pages=BACKUP_PAGES,
+                 interval=BACKUP_INTERVAL):
+        self.path = path
+        self.directory = directory
+        self.keep = keep
+        self.pages = pages
+        self.interval = interval
+        self.count = 0
+        self.last_report = None
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.interval:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.create()
+            except Exception:
+                logger.exception("Не удалось сделать резервную копию")
+
+    async def _in_thread(self, func, *args):
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def list(self):
+        # -> [(имя, размер, время создания)], новые первыми
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted((n for n in os.listdir(self.directory) if _name.match(n)), reverse=True)
+        return [(n, os.path.getsize(self._file(n)), os.path.getmtime(self._file(n))) for n in names]
+
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+
+    def _find(self, name=None):
+        # Имя из команды не должно выводить за пределы BACKUP_DIR
+        snapshots = self.list()
+        if not snapshots:
+            raise BackupError("резервных копий нет")
+        if name is None:
+            return self._file(snapshots[0][0])
+        if not _name.match(name) or not os.path.exists(self._file(name)):
+            raise BackupError(f"копия {name} не найдена")
+        return self._file(name)
+
+    async def create(self, tag=None):
+        report = await self._in_thread(self._create, tag)
+        logger.info(
+            "Резервная копия %s: %.1f МБ -> %.1f МБ за %.2f с, шагов %s, блокировка до %.1f мс (всего %.2f с), "
+            "перезапусков %s", report["name"], report["db_bytes"] / 2 ** 20, report["size"] / 2 ** 20,
+            report["seconds"], report["steps"], report["max_step_seconds"] * 1000, report["locked_seconds"],
+            report["restarts"]
+        )
+        return report
+
+    def _create(self, tag=None):
+        started = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{BACKUP_PREFIX}{datetime.now():%Y%m%d-%H%M%S}{'-' + tag if tag else ''}.db.gz"
+        stats = {"steps": 0, "pages": 0, "restarts": 0, "locked_seconds": 0.0, "max_step_seconds": 0.0}
+        with tempfile.TemporaryDirectory(dir=self.directory) as tmp:
+            copy = os.path.join(tmp, "santa.db")
+            source = sqlite3.connect(self.path)
+            target = sqlite3.connect(copy)
+            try:
+                _copy(source, target, self.pages, stats)
+                page_size = target.execute("PRAGMA page_size").fetchone()[0]
+            finally:
+                target.close()
+                source.close()
+            copied = time.perf_counter()
+            partial = self._file(name + ".part")
+            with open(copy, "rb") as src, gzip.open(partial, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.replace(partial, self._file(name))
+        for old, _, _ in self.list()[self.keep:]:
+            os.remove(self._file(old))
+        self.count += 1
+        self.last_report = dict(
+            stats, name=name, db_bytes=stats["pages"] * page_size, size=os.path.getsize(self._file(name)),
+            copy_seconds=copied - started, seconds=time.perf_counter() - started, at=time.time(),
+        )
+        return self.last_report
+
+    async def verify(self, name=None):
+        return await self._in_thread(self._verify, self._find(name))
+
+    def _verify(self, file):
+        # Распаковываем во временный файл и проверяем integrity_check
+        with tempfile.TemporaryDirectory(dir=self.directory) as tmp:
+            copy = os.path.join(tmp, "santa.db")
+            with gzip.open(file, "rb") as src, open(copy, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            db = sqlite3.connect(copy)
+            try:
+                return self._check(db, os.path.basename(file))
+            finally:
+                db.close()
+
+    def _check(self, db, name):
+        try:
+            result = [row[0] for row in db.execute("PRAGMA integrity_check(10)")]
+            counts = {t: db.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("rooms", "participants")}
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            return {"name": name, "ok": False, "errors": [str(e)]}
+        return {"name": name, "ok": result == ["ok"], "errors": [] if result == ["ok"] else result,
+                "version": version, **counts}
+
+    async def restore(self, name):
+        # Перед восстановлением сохраняется текущее состояние (копия с меткой
+        # "prerestore"). Запись в santa.db на время копирования блокируется
+        # целиком; после восстановления вызывающий код сбрасывает кэши.
+        file = self._find(name)
+        await self.create("prerestore")
+        return await self._in_thread(self._restore, file)
+
+    def _restore(self, file):
+        started = time.perf_counter()
+        with tempfile.TemporaryDirectory(dir=self.directory) as tmp:
+            copy = os.path.join(tmp, "santa.db")
+            with gzip.open(file, "rb") as src, open(copy, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            source = sqlite3.connect(copy)
+            try:
+                report = self._check(source, os.path.basename(file))
+                if not report["ok"]:
+                    raise BackupError(f"копия {report['name']} повреждена: {'; '.join(report['errors'])}")
+                target = sqlite3.connect(self.path, timeout=30)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+        report["seconds"] = time.perf_counter() - started
+        logger.warning("База восстановлена из %s за %.2f с", report["name"], report["seconds"])
+        return report
+
+
+backups = Backups()
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import sqlite3
+
+from database import DB_FILE, TimedConnection, connect
+
+# ---------------------------------------
+# Настройки пакетной записи
+# ---------------------------------------
+BATCH_WINDOW = float(os.getenv("SANTA_BATCH_WINDOW_MS", "5")) / 1000
+BATCH_MAX = int(os.getenv("SANTA_BATCH_MAX", "200"))
+
+
+# ---------------------------------------
+# Объединение мелких записей в одну транзакцию
+# ---------------------------------------
+# Обработчики кладут запрос в очередь и ждут его результата. Очередь сбрасывается
+# одной транзакцией через BATCH_WINDOW после первого запроса или сразу, как только
+# набралось BATCH_MAX запросов. У батчера своё соединение, поэтому он не ждёт
+# соединений пула, которые держат обработчики; запросы в нём учитываются тем же
+# observer, что и в пуле (metrics.setup).
+class WriteBatcher:
+    def __init__(self, path=DB_FILE, window=BATCH_WINDOW, max_ops=BATCH_MAX):
+        self.path = path
+        self.window = window
+        self.max_ops = max_ops
+        self.flushes = 0
+        self.operations = 0
+        # observer(sql, секунды) — подключается metrics.setup()
+        self.observer = None
+        self._db = None
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = False
+
+    async def open(self):
+        if self._db is None:
+            self._db = await connect(self.path)
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._db is None:
+            return
+        # Дописываем то, что успели поставить в очередь до остановки, без ожидания окна
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        await self._db.close()
+        self._db = None
+
+    async def submit(self, sql, parameters=()):
+        # Возвращает rowcount запроса после commit всей пачки
+        if self._db is None or self._closing:
+            raise RuntimeError("Батчер записи не открыт, сначала вызовите init_db()")
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((sql, parameters, future))
+        if len(self._pending) == 1 or len(self._pending) >= self.max_ops:
+            self._wakeup.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if len(self._pending) < self.max_ops and not self._closing:
+                await asyncio.sleep(self.window)
+            batch, self._pending = self._pending[:self.max_ops], self._pending[self.max_ops:]
+            if self._pending:
+                self._wakeup.set()
+            if batch:
+                await self._flush(batch)
+            if self._closing and not self._pending:
+                return
+
+    async def _flush(self, batch):
+        self.flushes += 1
+        self.operations += len(batch)
+        try:
+            results = await self._apply(batch, isolated=False)
+        except sqlite3.Error:
+            # Один из запросов упал (например, нарушил ограничение) — повторяем пачку,
+            # обернув каждый запрос в SAVEPOINT, чтобы ошибка досталась только ему
+            await self._db.rollback()
+            try:
+                results = await self._apply(batch, isolated=True)
+            except Exception as e:
+                await self._db.rollback()
+                results = [e] * len(batch)
+        except Exception as e:
+            await self._db.rollback()
+            results = [e] * len(batch)
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _apply(self, batch, isolated):
+        db = TimedConnection(self._db, self.observer) if self.observer else self._db
+        results = []
+        await db.execute("BEGIN IMMEDIATE")
+        for sql, parameters, _ in batch:
+            if not isolated:
+                cur = await db.execute(sql, parameters)
+                results.append(cur.rowcount)
+                continue
+            await db.execute("SAVEPOINT op")
+            try:
+                cur = await db.execute(sql, parameters)
+                results.append(cur.rowcount)
+            except sqlite3.Error as e:
+                await db.execute("ROLLBACK TO op")
+                results.append(e)
+            await db.execute("RELEASE op")
+        await db.commit()
+        return results
+
+
+batcher = WriteBatcher()
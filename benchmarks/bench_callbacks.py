@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+# Микробенчмарк разбора нажатий inline-кнопок: цепочка фильтров
+# lambda c: c.data.startswith(...) + split("_") в обработчике (как было)
+# против callbacks.CallbackRouter (словарь по префиксу + CallbackData).
+# Меряется и один разбор, и полный путь через aiogram Dispatcher.feed_update.
+# Запуск: python benchmarks/bench_callbacks.py [8 32 128]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+from callbacks import CallbackRouter, RoomId
+
+ROUNDS = 20000
+ROOM_ID = 4321
+
+
+def factories(count):
+    return [
+        type(f"Button{i}", (CallbackData,), {"__annotations__": {"room_id": RoomId}}, prefix=f"btn{i}", sep="_")
+        for i in range(count)
+    ]
+
+
+def legacy_filters(count):
+    return [(lambda c, p=f"btn{i}_": c.data and c.data.startswith(p)) for i in range(count)]
+
+
+def update(data):
+    user = User(id=1, is_bot=False, first_name="bench")
+    return Update(update_id=1, callback_query=CallbackQuery(
+        id="1", chat_instance="bench", from_user=user, data=data,
+        message=Message(message_id=1, date=datetime.now(), chat=Chat(id=1, type="private"), text="-"),
+    ))
+
+
+def per_call(func, rounds=ROUNDS):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+async def per_call_async(func, rounds=ROUNDS // 4):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+async def bench(count, bot):
+    # Худший случай для цепочки: нажата кнопка последнего обработчика
+    data = f"btn{count - 1}_{ROOM_ID}"
+    event = update(data).callback_query
+
+    filters = legacy_filters(count)
+
+    def legacy_resolve():
+        for index, check in enumerate(filters):
+            if check(event):
+                return index, int(event.data.split("_")[1])
+
+    router = CallbackRouter()
+    for factory in factories(count):
+        router.route(factory)(handler)
+
+    legacy_dp = Dispatcher()
+    for check in filters:
+        legacy_dp.callback_query.register(legacy_handler, check)
+    router_dp = Dispatcher()
+    router.setup(router_dp.callback_query)
+
+    resolve_legacy = per_call(legacy_resolve)
+    resolve_router = per_call(lambda: router.resolve(data))
+    dispatch_legacy = await per_call_async(lambda: legacy_dp.feed_update(bot, update(data)))
+    dispatch_router = await per_call_async(lambda: router_dp.feed_update(bot, update(data)))
+    print(f"{count:>7} {resolve_legacy:>12.2f} {resolve_router:>12.2f} {dispatch_legacy:>12.1f} {dispatch_router:>12.1f}")
+
+
+async def handler(callback, callback_data):
+    return callback_data.room_id
+
+
+async def legacy_handler(callback):
+    return int(callback.data.split("_")[1])
+
+
+async def run(sizes):
+    bot = Bot("123456:bench-token")
+    print("время одного нажатия, мкс")
+    print(f"{'кнопок':>7} {'разбор: было':>12} {'разбор: стало':>12} {'feed: было':>12} {'feed: стало':>12}")
+    for count in sizes:
+        await bench(count, bot)
+    await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(run([int(a) for a in sys.argv[1:]] or [8, 32, 128]))
@@ -0,0 +1,82 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# Бенчмарк сохранения жеребьёвки: старый путь (UPDATE + SELECT на каждого дарителя)
+# против пакетного (один SELECT профилей + executemany).
+# Запуск: python benchmarks/bench_draw.py [100 1000 10000]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SANTA_TOKEN", "123456:bench-token")
+os.environ.setdefault("BOT_USERNAME", "santa_bench_bot")
+os.environ.setdefault("SANTA_DB", os.path.join(tempfile.mkdtemp(), "santa.db"))
+
+import main
+from database import connect, migrate
+from draw import assign
+from outbox import outbox
+
+ROOM_ID = 1000
+ROUNDS = 3
+
+
+async def legacy_draw(db, room_id):
+    cur = await db.execute("SELECT user_id FROM participants WHERE room_id=? AND left=0", (room_id,))
+    users = [u[0] for u in await cur.fetchall()]
+    pairs = assign(users)
+    messages = []
+    for giver, receiver in pairs.items():
+        await db.execute("UPDATE participants SET target_id=? WHERE user_id=? AND room_id=?", (receiver, giver, room_id))
+        cur = await db.execute("SELECT username, wishes, no_gifts FROM participants WHERE user_id=? AND room_id=?", (receiver, room_id))
+        row = await cur.fetchone()
+        if row:
+            messages.append((giver, main.target_message(*row)))
+    await outbox.enqueue(db, messages)
+    await db.commit()
+
+
+async def batched_draw(db, room_id):
+    profiles = await main.load_draw_profiles(db, room_id)
+    pairs = assign(profiles)
+    await main.save_draw(db, room_id, pairs, profiles)
+    await db.commit()
+
+
+async def fill_room(db, size):
+    await db.execute("DELETE FROM participants")
+    await db.execute("DELETE FROM rooms")
+    await db.execute("INSERT INTO rooms (id, admin_id, title) VALUES (?, 1, 'bench')", (ROOM_ID,))
+    await db.executemany(
+        "INSERT INTO participants (room_id, user_id, username, wishes) VALUES (?, ?, ?, ?)",
+        [(ROOM_ID, uid, f"user{uid}", "носки") for uid in range(1, size + 1)]
+    )
+    await db.commit()
+
+
+async def measure(db, func):
+    best = float("inf")
+    for _ in range(ROUNDS):
+        await db.execute("DELETE FROM outbox")
+        await db.commit()
+        start = time.perf_counter()
+        await func(db, ROOM_ID)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+async def run(sizes):
+    db = await connect(os.environ["SANTA_DB"])
+    await migrate(db)
+    print(f"{'участников':>10} {'старый, мс':>12} {'пакетный, мс':>14} {'ускорение':>10}")
+    for size in sizes:
+        await fill_room(db, size)
+        legacy = await measure(db, legacy_draw)
+        batched = await measure(db, batched_draw)
+        print(f"{size:>10} {legacy * 1000:>12.1f} {batched * 1000:>14.1f} {legacy / batched:>9.1f}x")
+    await db.close()
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    asyncio.run(run(sizes))
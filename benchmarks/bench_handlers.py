@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Обработчики main.py на MemoryRepository и MemoryStorage aiogram: без santa.db и
+# без сети (ответы Bot API подставляет LocalSession). Каждый сценарий — цепочка
+# апдейтов через Dispatcher.feed_update с проверкой ответов бота и содержимого
+# хранилища; при расхождении бенчмарк падает с AssertionError.
+# Запуск: python benchmarks/bench_handlers.py [--rounds 200]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SANTA_TOKEN", "123456:bench-token")
+os.environ.setdefault("BOT_USERNAME", "santa_bench_bot")
+os.environ.setdefault("SANTA_DB", os.path.join(tempfile.mkdtemp(), "santa.db"))
+# Сценарии шлют десятки апдейтов от одного админа подряд
+os.environ.setdefault("SANTA_THROTTLE_RATE", "0")
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+import main
+from callbacks import DeleteCallback
+from fake_telegram import BOT_USER
+from repository import MemoryRepository
+
+
+# ---------------------------------------
+# Bot API в памяти
+# ---------------------------------------
+class LocalSession(BaseSession):
+    # Ответы как у benchmarks/fake_telegram.py, но без HTTP: запрос сразу
+    # превращается в JSON ответа и разбирается тем же check_response
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+        self._ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        result = True
+        if name == "getMe":
+            result = BOT_USER
+        elif name in ("sendMessage", "editMessageText"):
+            self.sent.append((method.chat_id, method.text))
+            result = {"message_id": next(self._ids), "date": int(time.time()),
+                      "chat": {"id": method.chat_id, "type": "private"}, "from": BOT_USER, "text": method.text}
+        content = json.dumps({"ok": True, "result": result})
+        return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+# ---------------------------------------
+# Пользователь в чате с ботом
+# ---------------------------------------
+_ids = itertools.count(1)
+
+
+class Person:
+    def __init__(self, bot, user_id, username="auto"):
+        self.bot = bot
+        self.id = user_id
+        self.user = User(id=user_id, is_bot=False, first_name=f"user{user_id}",
+                         username=f"user{user_id}" if username == "auto" else username)
+
+    def _message(self, text):
+        return Message(message_id=next(_ids), date=datetime.now(), chat=Chat(id=self.id, type="private"),
+                       from_user=self.user, text=text)
+
+    async def send(self, text):
+        await main.dp.feed_update(self.bot, Update(update_id=next(_ids), message=self._message(text)))
+        return self.last()
+
+    async def press(self, data):
+        query = CallbackQuery(id=str(next(_ids)), chat_instance="bench", from_user=self.user, data=data,
+                              message=self._message("-"))
+        await main.dp.feed_update(self.bot, Update(update_id=next(_ids), callback_query=query))
+        return self.last()
+
+    def last(self):
+        # Последний ответ бота в этот чат
+        return next((text for chat_id, text in reversed(self.bot.session.sent) if chat_id == self.id), "")
+
+
+def expect(text, fragment):
+    assert fragment in text, f"ожидали «{fragment}», бот ответил «{text}»"
+
+
+# ---------------------------------------
+# Сценарии
+# ---------------------------------------
+async def new_room(admin, title, password=None, description=None):
+    expect(await admin.send(f"/newroom {title}"), "пароль")
+    if password:
+        await admin.press("set_password")
+        expect(await admin.send("12"), "4-значным")
+        await admin.send(password)
+    else:
+        await admin.press("skip_password")
+    if description:
+        reply = await admin.send(description)
+    else:
+        reply = await admin.press("skip_description")
+    expect(reply, "Комната создана")
+    return int(reply.split("ID: ")[1].split()[0])
+
+
+async def scenario_rooms(repo, bot, base):
+    admin = Person(bot, base)
+    room_id = await new_room(admin, "Офис", password="1234", description="До 1000 ₽")
+    room = repo.rooms[room_id]
+    assert (room.title, room.password, room.description) == ("Офис", "1234", "До 1000 ₽"), room
+    guest = Person(bot, base + 1)
+    expect(await guest.send(f"/join {room_id}"), "защищена паролем")
+    expect(await guest.send("0000"), "Неверный пароль")
+    expect(await guest.send("1234"), "Вы присоединились")
+    expect(await guest.send(f"/leave {room_id}"), "Вы вышли")
+    assert repo.members[room_id][guest.id].left == 1
+    # Пароль уже проверен (password_verified в данных FSM), второй раз его не спрашивают
+    expect(await guest.send(f"/join {room_id}"), "Вы вернулись")
+    nameless = Person(bot, base + 2, username=None)
+    await nameless.send(f"/join {room_id}")
+    expect(await nameless.send("1234"), "введите имя")
+    expect(await nameless.send("Дед Мороз"), "Имя 'Дед Мороз' сохранено")
+    expect(await admin.send("/myrooms"), f"ID: {room_id} 👑 админ")
+    expect(await guest.send("/myrooms"), f"ID: {room_id}")
+
+
+async def scenario_members(repo, bot, base):
+    admin = Person(bot, base)
+    room_id = await new_room(admin, "Участники")
+    people = [Person(bot, base + i) for i in range(1, 6)]
+    for person in people:
+        await person.send(f"/join {room_id}")
+    expect(await people[0].send("/wishes"), "Напиши свои пожелания")
+    await people[0].send("Книги")
+    await people[1].send(f"/nogifts {room_id}")
+    await people[1].send("Носки")
+    reply = await admin.send(f"/participants {room_id}")
+    expect(reply, "всего 5")
+    expect(reply, "№1. user" + str(base + 1) + ", Пожелания: Книги")
+    expect(reply, "Не дарить: Носки")
+    expect(await people[2].send(f"/participants {room_id}"), "Только админ")
+    await admin.press(DeleteCallback(room_id=room_id).pack())
+    expect(await admin.send("3"), f"Участник user{base + 3} заблокирован")
+    assert (room_id, base + 3) in repo.bans and base + 3 not in repo.members[room_id]
+    expect(await people[2].send(f"/join {room_id}"), "не можете в неё войти")
+    reply = await admin.send(f"/ban {room_id} @user{base + 4} {base + 99}")
+    expect(reply, "Заблокировано 2, из них удалено из комнаты «Участники» 1")
+    expect(await admin.send(f"/unban {room_id} @user{base + 4} {base + 3}"), "Разблокировано в комнате «Участники»: 2")
+    expect(await people[2].send(f"/join {room_id}"), "Вы присоединились")
+
+
+async def scenario_draw(repo, bot, base):
+    admin = Person(bot, base)
+    room_id = await new_room(admin, "Жеребьёвка")
+    people = [Person(bot, base + i) for i in range(1, 7)]
+    for person in people:
+        await person.send(f"/join {room_id}")
+    first, second = people[0], people[1]
+    expect(await admin.send(f"/exclude {room_id} @{first.user.username} @{second.user.username}"), "Запрет добавлен")
+    expect(await admin.send(f"/block {room_id} {people[2].id} {people[3].id}"), "Запрет добавлен")
+    expect(await admin.send(f"/exclude {room_id} @nobody @{first.user.username}"), "Участник не найден")
+    reply = await admin.send(f"/exclusions {room_id}")
+    expect(reply, f"{first.user.username} ⇢ {second.user.username} (пара)")
+    expect(reply, f"{people[2].user.username} ⇢ {people[3].user.username} (админ)")
+    expect(await admin.send(f"/unexclude {room_id} {people[2].id} {people[3].id}"), "Запрет снят")
+    sent = len(repo.sent)
+    expect(await admin.send(f"/draw {room_id}"), "Жеребьёвка завершена")
+    pairs = {m.user_id: m.target_id for m in repo.members[room_id].values()}
+    assert repo.rooms[room_id].status == "drawn" and len(repo.sent) - sent == len(pairs)
+    assert sorted(pairs.values()) == sorted(pairs) and pairs[first.id] != second.id and pairs[second.id] != first.id
+    # Вход и выход после жеребьёвки чинят пары точечно
+    late = Person(bot, base + 50)
+    await late.send(f"/join {room_id}")
+    await people[5].send(f"/leave {room_id}")
+    active = {m.user_id: m.target_id for m in repo.members[room_id].values() if not m.left}
+    assert sorted(active.values()) == sorted(active) and late.id in active, active
+    # Прошлогодние пары — запретами в новой комнате
+    next_room = await new_room(admin, "Следующий год")
+    for person in people[:3]:
+        await person.send(f"/join {next_room}")
+    reply = await admin.send(f"/excludepast {next_room} {room_id}")
+    past = sum(1 for g in people[:3] for r in people[:3] if repo.members[room_id][g.id].target_id == r.id)
+    expect(reply, f"из прошлой жеребьёвки: {past}")
+
+
+async def scenario_schedule(repo, bot, base):
+    admin = Person(bot, base)
+    room_id = await new_room(admin, "План")
+    when = (datetime.now(main.TIMEZONE) + timedelta(days=10)).strftime("%d.%m.%Y %H:%M")
+    expect(await admin.send(f"/schedule {room_id} {when}"), "пройдёт автоматически")
+    expect(await admin.send(f"/deadline {room_id} {when[:10]}"), "Напоминания участникам")
+    reply = await admin.send(f"/jobs {room_id}")
+    for title in main.JOB_TITLES.values():
+        expect(reply, title)
+    expect(await Person(bot, base + 1).send(f"/jobs {room_id}"), "Только админ")
+    expect(await admin.send(f"/unschedule {room_id}"), "Отменено событий: 4")
+    expect(await admin.send(f"/jobs {room_id}"), "Запланированных событий нет")
+
+
+SCENARIOS = [scenario_rooms, scenario_members, scenario_draw, scenario_schedule]
+
+
+async def run(rounds):
+    repo = MemoryRepository()
+    main.use_repository(repo, MemoryStorage())
+    bot = Bot(os.environ["SANTA_TOKEN"], session=LocalSession())
+    main.bot = bot
+    timings = {scenario.__name__: 0.0 for scenario in SCENARIOS}
+    for number in range(rounds):
+        for index, scenario in enumerate(SCENARIOS):
+            start = time.perf_counter()
+            await scenario(repo, bot, (number * len(SCENARIOS) + index + 1) * 1000)
+            timings[scenario.__name__] += time.perf_counter() - start
+    print(f"{'сценарий':<20} {'прогонов':>8} {'в секунду':>10}")
+    for name, seconds in timings.items():
+        print(f"{name:<20} {rounds:>8} {rounds / seconds:>10.0f}")
+    print(f"Ответов бота: {len(bot.session.sent)}, сообщений в outbox: {len(repo.sent)}, комнат: {len(repo.rooms)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сценарии обработчиков на хранилище в памяти")
+    parser.add_argument("--rounds", type=int, default=200, help="сколько раз прогнать каждый сценарий")
+    asyncio.run(run(parser.parse_args().rounds))
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Сравнение хранилищ repository.py на одной нагрузке: создание комнат, входы
+# (get_room + is_banned + member_left + join), выходы и баны, жеребьёвка
+# (draw_profiles + exclusions + save_pairs) и чтение списка комнат.
+# Запуск: python benchmarks/bench_storage.py [комнат [участников в комнате]]
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SANTA_TOKEN", "123456:bench-token")
+os.environ.setdefault("BOT_USERNAME", "santa_bench_bot")
+os.environ.setdefault("SANTA_DB", os.path.join(tempfile.mkdtemp(), "santa.db"))
+
+from cache import room_cache
+from database import Pool, migrate
+from draw import assign
+from repository import MemoryRepository, SQLiteRepository
+
+SEED = 2024
+
+
+async def workload(repo, rooms, members):
+    rng = random.Random(SEED)
+    timings = {}
+
+    async def phase(name, count, func):
+        start = time.perf_counter()
+        await func()
+        timings[name] = (count, time.perf_counter() - start)
+
+    room_list = []
+    users = {}
+
+    async def create():
+        for number in range(rooms):
+            async with repo.session() as db:
+                room_id = await repo.create_room(db, number + 1, f"Комната {number}")
+                await db.commit()
+            room_list.append(room_id)
+            # Каждый пользователь состоит в нескольких комнатах, как в жизни
+            users[room_id] = [rooms + 1 + (number + i * 7) % (rooms * members // 4 + 1) for i in range(members)]
+
+    async def join():
+        for room_id in room_list:
+            for user_id in users[room_id]:
+                async with repo.session() as db:
+                    room = await repo.get_room(db, room_id)
+                    if room and not await repo.is_banned(db, room_id, user_id):
+                        if await repo.member_left(db, room_id, user_id) is None:
+                            await repo.join(db, room_id, user_id, f"user{user_id}")
+                    await db.commit()
+
+    async def churn():
+        for room_id in room_list:
+            for user_id in rng.sample(users[room_id], members // 10):
+                async with repo.session() as db:
+                    await repo.leave(db, room_id, user_id)
+                    await db.commit()
+            for user_id in rng.sample(users[room_id], members // 20):
+                async with repo.session() as db:
+                    await repo.ban(db, room_id, user_id, f"user{user_id}")
+                    await db.commit()
+
+    async def draw():
+        for room_id in room_list:
+            async with repo.session() as db:
+                profiles = await repo.draw_profiles(db, room_id)
+                pairs = assign(profiles, await repo.exclusions(db, room_id), rng)
+                await repo.save_pairs(db, room_id, pairs)
+                await db.commit()
+
+    async def my_rooms():
+        async with repo.session() as db:
+            for room_users in users.values():
+                for user_id in room_users:
+                    await repo.rooms_of(db, user_id)
+
+    await phase("комнаты", rooms, create)
+    await phase("входы", rooms * members, join)
+    await phase("выходы и баны", rooms * (members // 10 + members // 20), churn)
+    await phase("жеребьёвки", rooms, draw)
+    await phase("мои комнаты", rooms * members, my_rooms)
+    return timings
+
+
+async def run(rooms, members):
+    pool = Pool(os.environ["SANTA_DB"], size=1)
+    await pool.open()
+    async with pool.acquire() as db:
+        await migrate(db)
+    # Нагрузка пишет только в транзакциях session(), batcher (write) не нужен
+    results = {"SQLite": await workload(SQLiteRepository(pool, None), rooms, members)}
+    await pool.close()
+    room_cache.clear()
+    results["память"] = await workload(MemoryRepository(), rooms, members)
+
+    print(f"{rooms} комнат по {members} участников")
+    print(f"{'операция':>14} {'операций':>9} {'SQLite, оп/с':>13} {'память, оп/с':>13} {'разница':>8}")
+    totals = {engine: 0.0 for engine in results}
+    for name, (count, _) in results["SQLite"].items():
+        rates = []
+        for engine in results:
+            seconds = results[engine][name][1]
+            totals[engine] += seconds
+            rates.append(count / seconds)
+        print(f"{name:>14} {count:>9} {rates[0]:>13.0f} {rates[1]:>13.0f} {rates[1] / rates[0]:>7.1f}x")
+    print(f"{'всего, с':>14} {'':>9} {totals['SQLite']:>13.2f} {totals['память']:>13.2f} "
+          f"{totals['SQLite'] / totals['память']:>7.1f}x")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.run(run(*(args + [200, 50][len(args):])))
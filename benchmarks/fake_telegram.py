@@ -0,0 +1,94 @@
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# ---------------------------------------
+# Поддельный Bot API для нагрузочных тестов
+# ---------------------------------------
+# Отвечает на /bot<token>/<method> так же, как настоящий Telegram, но ничего
+# не отправляет. Умеет добавлять задержку и отвечать 429 с заданной вероятностью.
+# Можно запустить отдельно и направить на него бота через SANTA_API_URL:
+#   python benchmarks/fake_telegram.py 8081
+#   SANTA_API_URL=http://127.0.0.1:8081 python main.py
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Santa", "username": "santa_bench_bot"}
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.errors = Counter()
+        self.messages = []
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method not in ("getMe", "getUpdates") and random.random() < self.error_rate:
+            self.errors[method] += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        return web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def result(self, method, params):
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return []
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            self.messages.append((chat_id, params.get("text", "")))
+            return {
+                "message_id": next(self._ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        return True
+
+
+async def _serve_forever(port):
+    fake = FakeTelegram()
+    print("Fake Bot API:", await fake.start(port=port))
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(_serve_forever(int(sys.argv[1]) if len(sys.argv) > 1 else 8081))
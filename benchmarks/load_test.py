@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Нагрузочный тест обработчиков main.py против поддельного Bot API.
+# Апдейты подаются прямо в Dispatcher, как это делает polling.
+# Запуск: python benchmarks/load_test.py --joins 1000 --rooms 200 --draw 2000
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SANTA_TOKEN", "123456:bench-token")
+os.environ.setdefault("BOT_USERNAME", "santa_bench_bot")
+os.environ.setdefault("SANTA_DB", os.path.join(tempfile.mkdtemp(), "santa.db"))
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+
+import main
+import metrics
+from database import pool
+from fake_telegram import FakeTelegram
+from outbox import RateLimiter, outbox
+
+
+# ---------------------------------------
+# Синтетические апдейты
+# ---------------------------------------
+_ids = itertools.count(1)
+
+
+def _user(user_id, username):
+    return User(id=user_id, is_bot=False, first_name=f"user{user_id}", username=username)
+
+
+def message_update(user_id, text, username="auto"):
+    username = f"user{user_id}" if username == "auto" else username
+    return Update(update_id=next(_ids), message=Message(
+        message_id=next(_ids), date=datetime.now(), chat=Chat(id=user_id, type="private"),
+        from_user=_user(user_id, username), text=text,
+    ))
+
+
+def callback_update(user_id, data):
+    return Update(update_id=next(_ids), callback_query=CallbackQuery(
+        id=str(next(_ids)), chat_instance="bench", from_user=_user(user_id, f"user{user_id}"), data=data,
+        message=Message(message_id=next(_ids), date=datetime.now(), chat=Chat(id=user_id, type="private"), text="-"),
+    ))
+
+
+# ---------------------------------------
+# Сценарии
+# ---------------------------------------
+class Scenario:
+    def __init__(self, name, bot, concurrency):
+        self.name = name
+        self.bot = bot
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.latencies = []
+        self.errors = 0
+
+    async def feed(self, update):
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                await main.dp.feed_update(self.bot, update)
+            except Exception:
+                self.errors += 1
+            self.latencies.append(time.perf_counter() - start)
+
+    async def run(self, coro):
+        # Время в базе берётся из гистограммы запросов metrics.db_seconds
+        db_time, queries = metrics.db_seconds.total()
+        start = time.perf_counter()
+        await coro
+        self.wall = time.perf_counter() - start
+        db_time_after, queries_after = metrics.db_seconds.total()
+        self.db_time = db_time_after - db_time
+        self.queries = queries_after - queries
+
+    def report(self):
+        lat = sorted(self.latencies)
+        p50 = lat[len(lat) // 2] if lat else 0
+        p99 = lat[min(len(lat) - 1, int(len(lat) * 0.99))] if lat else 0
+        return (f"{self.name:<22} {len(lat):>7} {len(lat) / self.wall:>9.0f} {p50 * 1000:>8.1f} "
+                f"{p99 * 1000:>8.1f} {self.db_time * 1000:>9.0f} {self.queries:>8} {self.errors:>6}")
+
+
+async def create_room(scenario, admin_id):
+    await scenario.feed(message_update(admin_id, f"/newroom Комната {admin_id}"))
+    await scenario.feed(callback_update(admin_id, "skip_password"))
+    await scenario.feed(callback_update(admin_id, "skip_description"))
+
+
+async def latest_room(admin_id):
+    async with pool.acquire() as db:
+        cur = await db.execute("SELECT MAX(id) FROM rooms WHERE admin_id=?", (admin_id,))
+        return (await cur.fetchone())[0]
+
+
+async def join_storm(scenario, joins):
+    setup = Scenario("setup", scenario.bot, 1)
+    await create_room(setup, 1)
+    room_id = await latest_room(1)
+    users = range(10_000, 10_000 + joins)
+    await scenario.run(asyncio.gather(*(scenario.feed(message_update(u, f"/start {room_id}")) for u in users)))
+
+
+async def parallel_rooms(scenario, rooms):
+    admins = range(100_000, 100_000 + rooms)
+    await scenario.run(asyncio.gather(*(create_room(scenario, a) for a in admins)))
+
+
+async def big_draw(scenario, size, fake):
+    admin_id = 2
+    setup = Scenario("setup", scenario.bot, 1)
+    await create_room(setup, admin_id)
+    room_id = await latest_room(admin_id)
+    async with pool.acquire() as db:
+        await db.executemany(
+            "INSERT INTO participants (room_id, user_id, username) VALUES (?, ?, ?)",
+            [(room_id, u, f"user{u}") for u in range(1_000_000, 1_000_000 + size)]
+        )
+        await db.commit()
+    sent_before = fake.calls["sendMessage"]
+
+    async def draw_and_drain():
+        await scenario.feed(message_update(admin_id, f"/draw {room_id}"))
+        # Ждём, пока outbox разошлёт все уведомления
+        while fake.calls["sendMessage"] - sent_before < size + 1:
+            await asyncio.sleep(0.01)
+
+    await scenario.run(draw_and_drain())
+
+
+async def run(args):
+    fake = FakeTelegram(latency=args.latency, error_rate=args.error_rate)
+    url = await fake.start()
+    bot = Bot(os.environ["SANTA_TOKEN"], session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    main.bot = bot
+    outbox.limiter = RateLimiter(rate=args.send_rate, per_chat_interval=0)
+    await main.dp.emit_startup(bot=bot)
+
+    print(f"Fake Bot API: {url}, задержка {args.latency * 1000:.0f} мс, 429: {args.error_rate:.0%}")
+    print(f"{'сценарий':<22} {'апдейтов':>7} {'апд/сек':>9} {'p50, мс':>8} {'p99, мс':>8} {'БД, мс':>9} {'запросов':>8} {'ошибок':>6}")
+    scenarios = [
+        ("join storm", lambda s: join_storm(s, args.joins)),
+        ("parallel rooms", lambda s: parallel_rooms(s, args.rooms)),
+        (f"draw {args.draw}", lambda s: big_draw(s, args.draw, fake)),
+    ]
+    for name, body in scenarios:
+        scenario = Scenario(name, bot, args.concurrency)
+        await body(scenario)
+        print(scenario.report())
+
+    await main.dp.emit_shutdown(bot=bot)
+    await bot.session.close()
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота против поддельного Bot API")
+    parser.add_argument("--joins", type=int, default=1000, help="пользователей в join storm")
+    parser.add_argument("--rooms", type=int, default=200, help="комнат, создаваемых параллельно")
+    parser.add_argument("--draw", type=int, default=2000, help="участников в комнате для /draw")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременно обрабатываемых апдейтов")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--send-rate", type=float, default=10000, help="лимит outbox, сообщений в секунду")
+    asyncio.run(run(parser.parse_args()))
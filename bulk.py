@@ -0,0 +1,126 @@
+import asyncio
+import codecs
+import csv
+import io
+import os
+import re
+from collections import Counter, namedtuple
+
+# ---------------------------------------
+# Настройки массовых операций
+# ---------------------------------------
+# Файл для /import, /ban, /unban не больше IMPORT_MAX_BYTES; строки пишутся
+# транзакциями по IMPORT_CHUNK, чтобы не держать блокировку записи долго
+IMPORT_MAX_BYTES = int(os.getenv("SANTA_IMPORT_MAX_BYTES", str(5 * 2 ** 20)))
+IMPORT_CHUNK = int(os.getenv("SANTA_IMPORT_CHUNK", "500"))
+IMPORT_COLUMNS = ("user_id", "username", "wishes", "no_gifts", "exclude")
+IMPORT_FIELD_CHARS = 1000
+# В ответе перечисляются только первые ошибки
+IMPORT_MAX_ERRORS = 10
+
+Row = namedtuple("Row", "line user_id username wishes no_gifts exclude")
+RowError = namedtuple("RowError", "line reason")
+
+_refs = re.compile(r"[\s,;]+")
+_username = re.compile(r"^[\w.\- ]{1,64}$")
+
+
+def decode(stream):
+    # UTF-8 (в том числе с BOM) или, если не читается, cp1251 — так сохраняет CSV Excel.
+    # Кодировка определяется по началу файла, дальше файл читается построчно
+    head = stream.read(64 * 1024)
+    stream.seek(0)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        encoding = "cp1251"
+    return io.TextIOWrapper(stream, encoding=encoding, errors="replace", newline="")
+
+
+def parse_refs(text):
+    # "@user1, 123; user2" -> ["user1", "123", "user2"]
+    return [ref.lstrip("@") for ref in _refs.split(text or "") if ref.lstrip("@")]
+
+
+def read_refs(stream):
+    # Список пользователей для /ban и /unban: любые разделители, одна или много ссылок в строке
+    for line in decode(stream):
+        yield from parse_refs(line)
+
+
+def read_rows(stream, errors):
+    # Построчный разбор CSV для /import: отдаёт Row, ошибочные строки добавляет
+    # в errors как RowError. Разделитель — запятая, точка с запятой или табуляция;
+    # первая строка с названиями колонок необязательна, без неё порядок IMPORT_COLUMNS
+    text = decode(stream)
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample.split("\n", 1)[0], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    columns = IMPORT_COLUMNS
+    seen = set()
+    for number, cells in enumerate(csv.reader(text, dialect), 1):
+        cells = [cell.strip() for cell in cells]
+        if not any(cells):
+            continue
+        if number == 1 and not cells[0].lstrip("@").isdigit():
+            names = [cell.lower() for cell in cells]
+            if "user_id" in names:
+                columns = names
+                continue
+        row = dict(zip(columns, cells))
+        error = _validate(row)
+        if error:
+            errors.append(RowError(number, error))
+            continue
+        user_id = int(row["user_id"])
+        if user_id in seen:
+            errors.append(RowError(number, f"user_id {user_id} уже был выше"))
+            continue
+        seen.add(user_id)
+        yield Row(number, user_id, row["username"].lstrip("@"), row.get("wishes") or None,
+                  row.get("no_gifts") or None, parse_refs(row.get("exclude")))
+
+
+def _validate(row):
+    user_id = row.get("user_id", "")
+    if not user_id.isdigit() or not 0 < int(user_id) < 2 ** 63:
+        return "нет числового user_id"
+    if not _username.match(row.get("username", "").lstrip("@")):
+        return "нет username или в нём недопустимые символы"
+    for column in ("wishes", "no_gifts"):
+        if len(row.get(column) or "") > IMPORT_FIELD_CHARS:
+            return f"{column} длиннее {IMPORT_FIELD_CHARS} символов"
+    return None
+
+
+def chunked(items, size=IMPORT_CHUNK):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# ---------------------------------------
+# Запись пачками
+# ---------------------------------------
+# apply(db, chunk, summary) пишет одну пачку в транзакции repository.session(),
+# commit делается здесь. Соединение берётся на каждую пачку и между пачками
+# отдаётся другим обработчикам; упавшая пачка откатывается целиком, записанные
+# до неё остаются.
+async def apply_chunks(repository, items, apply, size=IMPORT_CHUNK, summary=None):
+    summary = Counter() if summary is None else summary
+    for chunk in chunked(items, size):
+        async with repository.session() as db:
+            await apply(db, chunk, summary)
+            await db.commit()
+        summary["chunks"] += 1
+        await asyncio.sleep(0)
+    return summary
@@ -0,0 +1,98 @@
+import os
+import time
+from collections import OrderedDict, namedtuple
+
+# ---------------------------------------
+# LRU-кэш с TTL и счётчиками попаданий
+# ---------------------------------------
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is not None:
+            value, expires_at = item
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# ---------------------------------------
+# Кэш метаданных комнат
+# ---------------------------------------
+# Комнаты меняются редко, а читаются на каждом присоединении, поэтому строка
+# rooms кэшируется по id. Все места, где меняется rooms, вызывают invalidate_room.
+ROOM_CACHE_SIZE = int(os.getenv("SANTA_ROOM_CACHE_SIZE", "10000"))
+ROOM_CACHE_TTL = float(os.getenv("SANTA_ROOM_CACHE_TTL", "300"))
+
+Room = namedtuple("Room", "id admin_id title status password description updated_at")
+
+room_cache = TTLCache(ROOM_CACHE_SIZE, ROOM_CACHE_TTL)
+
+
+def room_key(room_id):
+    # room_id приходит и числом, и строкой из текста команды
+    if isinstance(room_id, int):
+        return room_id
+    room_id = str(room_id).strip()
+    return int(room_id) if room_id.isdigit() else None
+
+
+async def get_room(db, room_id):
+    key = room_key(room_id)
+    if key is None:
+        return None
+    room = room_cache.get(key)
+    if room is None:
+        cur = await db.execute(
+            "SELECT id, admin_id, title, status, password, description, updated_at FROM rooms WHERE id=?", (key,)
+        )
+        row = await cur.fetchone()
+        if row is None:
+            return None
+        room = Room(*row)
+        room_cache.set(key, room)
+    return room
+
+
+def invalidate_room(room_id):
+    key = room_key(room_id)
+    if key is not None:
+        room_cache.invalidate(key)
+
+
+async def warm_rooms(db, limit):
+    # При запуске недавно активные комнаты сразу кладутся в кэш (idx_rooms_updated),
+    # чтобы первые входы после перезапуска не шли в базу
+    cur = await db.execute(
+        "SELECT id, admin_id, title, status, password, description, updated_at FROM rooms "
+        "ORDER BY updated_at DESC LIMIT ?", (min(limit, room_cache.maxsize),)
+    )
+    rows = await cur.fetchall()
+    for row in reversed(rows):
+        room_cache.set(row[0], Room(*row))
+    return len(rows)
@@ -0,0 +1,122 @@
+import logging
+from typing import Annotated
+
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.filters.callback_data import CallbackData
+from pydantic import Field
+
+logger = logging.getLogger("santa.callbacks")
+
+# ID комнат начинаются с 4-значных (см. room_ids.py); всё прочее — подделка или мусор
+RoomId = Annotated[int, Field(ge=1000, lt=2 ** 63)]
+RowId = Annotated[int, Field(ge=0, lt=2 ** 63)]
+
+
+# ---------------------------------------
+# Данные inline-кнопок
+# ---------------------------------------
+# Разделитель "_" оставлен прежним, поэтому кнопки в уже отправленных
+# сообщениях ("join_1234", "parts_1234_17") продолжают работать.
+class JoinCallback(CallbackData, prefix="join", sep="_"):
+    room_id: RoomId
+
+
+class WishesCallback(CallbackData, prefix="wishes", sep="_"):
+    room_id: RoomId
+
+
+class NoGiftsCallback(CallbackData, prefix="nogifts", sep="_"):
+    room_id: RoomId
+
+
+class ParticipantsCallback(CallbackData, prefix="parts", sep="_"):
+    room_id: RoomId
+    after_id: RowId
+
+
+class ParticipantsBackCallback(CallbackData, prefix="partsback", sep="_"):
+    room_id: RoomId
+    before_id: RowId
+
+
+class MyRoomsCallback(CallbackData, prefix="myrooms", sep="_"):
+    after_id: RowId
+
+
+class MyRoomsBackCallback(CallbackData, prefix="myroomsback", sep="_"):
+    before_id: RowId
+
+
+class DeleteCallback(CallbackData, prefix="delete", sep="_"):
+    room_id: RoomId
+
+
+class DrawCancelCallback(CallbackData, prefix="drawcancel", sep="_"):
+    room_id: RoomId
+
+
+# ---------------------------------------
+# Маршрутизация по префиксу
+# ---------------------------------------
+# Вместо цепочки фильтров lambda c: c.data.startswith(...), которые aiogram
+# проверяет по очереди для каждого нажатия, callback_data разбирается один раз:
+# точное совпадение для статических кнопок, иначе поиск по префиксу в словаре
+# и разбор в типизированный объект. Обработчик получает его в callback_data.
+# Кнопки с непонятными или невалидными данными получают ответ "кнопка устарела".
+class CallbackRouter:
+    def __init__(self, sep="_"):
+        self.sep = sep
+        self._static = {}
+        self._prefixed = {}
+        self._stale = CallableObject(self._answer_stale)
+
+    def route(self, factory):
+        # @callbacks.route(JoinCallback) async def callback_join(callback, callback_data, state): ...
+        def register(func):
+            self._prefixed[factory.__prefix__] = (factory, CallableObject(func))
+            return func
+        return register
+
+    def static(self, *values):
+        # @callbacks.static("skip_description") async def skip_description(callback, state): ...
+        def register(func):
+            handler = CallableObject(func)
+            for value in values:
+                self._static[value] = handler
+            return func
+        return register
+
+    def resolve(self, data):
+        # -> (CallableObject, разобранные данные или None)
+        if data is None:
+            return self._stale, None
+        handler = self._static.get(data)
+        if handler is not None:
+            return handler, None
+        route = self._prefixed.get(data.split(self.sep, 1)[0])
+        if route is None:
+            return self._stale, None
+        factory, handler = route
+        try:
+            return handler, factory.unpack(data)
+        except (TypeError, ValueError):
+            logger.info("Невалидные данные кнопки: %r", data[:64])
+            return self._stale, None
+
+    def setup(self, observer):
+        # Один обработчик на observer (dp.callback_query) вместо одного на кнопку
+        observer.register(self._dispatch, self._filter)
+
+    async def _filter(self, callback):
+        handler, callback_data = self.resolve(callback.data)
+        # callback_handler нужен metrics.HandlerMetricsMiddleware для имени в метриках
+        return {"callback_handler": handler, "callback_data": callback_data}
+
+    async def _dispatch(self, callback, callback_handler, **kwargs):
+        return await callback_handler.call(callback, **kwargs)
+
+    async def _answer_stale(self, callback):
+        await callback.answer("Кнопка устарела, откройте меню заново")
+
+
+callbacks = CallbackRouter()
@@ -0,0 +1,421 @@
+import asyncio
+import os
+import secrets
+import time
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+import room_ids
+
+# ---------------------------------------
+# Настройки базы
+# ---------------------------------------
+DB_FILE = os.getenv("SANTA_DB", "santa.db")
+POOL_SIZE = int(os.getenv("SANTA_DB_POOL_SIZE", "4"))
+
+# WAL позволяет читать параллельно с записью, synchronous=NORMAL в режиме WAL
+# безопасен и убирает fsync на каждый commit, busy_timeout вместо "database is locked".
+# auto_vacuum=INCREMENTAL действует для новой базы, старую переводит archive.Compactor
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+async def connect(path=DB_FILE):
+    db = await aiosqlite.connect(path)
+    for pragma in PRAGMAS:
+        await db.execute(pragma)
+    return db
+
+
+# ---------------------------------------
+# Замер времени запросов
+# ---------------------------------------
+# Обёртка над aiosqlite.Connection: сообщает observer(sql, секунды) по каждому
+# execute/executemany/commit, остальное прозрачно передаёт соединению.
+class TimedConnection:
+    def __init__(self, db, observer):
+        self._db = db
+        self._observer = observer
+
+    async def _timed(self, label, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self._observer(label, time.perf_counter() - start)
+
+    async def execute(self, sql, parameters=None):
+        return await self._timed(sql, self._db.execute(sql, parameters))
+
+    async def executemany(self, sql, parameters):
+        return await self._timed(sql, self._db.executemany(sql, parameters))
+
+    async def commit(self):
+        return await self._timed("COMMIT", self._db.commit())
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+# ---------------------------------------
+# Пул долгоживущих соединений
+# ---------------------------------------
+class Pool:
+    def __init__(self, path=DB_FILE, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        # observer(sql, секунды) — подключается metrics.setup()
+        self.observer = None
+        self._conns = []
+        self._idle = None
+        # (busy, страниц в WAL, перенесено) последнего wal_checkpoint при close()
+        self.last_checkpoint = None
+
+    @property
+    def is_open(self):
+        return self._idle is not None
+
+    async def open(self):
+        if self.is_open:
+            return
+        # Соединения открываются параллельно: у каждого свой поток aiosqlite
+        self._conns = list(await asyncio.gather(*(connect(self.path) for _ in range(self.size))))
+        self._idle = asyncio.Queue()
+        for db in self._conns:
+            self._idle.put_nowait(db)
+
+    @asynccontextmanager
+    async def acquire(self):
+        if not self.is_open:
+            raise RuntimeError("Пул соединений не открыт, сначала вызовите init_db()")
+        db = await self._idle.get()
+        try:
+            yield TimedConnection(db, self.observer) if self.observer else db
+        finally:
+            # Соединение уже закрыто, если close() не дождался его по таймауту
+            if db in self._conns:
+                # Незакоммиченные изменения не должны утечь к следующему обработчику
+                if db.in_transaction:
+                    await db.rollback()
+                self._idle.put_nowait(db)
+
+    async def close(self, timeout=None):
+        if not self.is_open:
+            return
+        # Дожидаемся, пока соединения вернутся в пул, но не дольше timeout: занятые
+        # после него закрываются как есть, их незавершённые транзакции откатываются
+        idle = []
+
+        async def wait_idle():
+            while len(idle) < len(self._conns):
+                idle.append(await self._idle.get())
+
+        try:
+            await asyncio.wait_for(wait_idle(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        # Переносим WAL в основной файл и обнуляем его: следующему запуску не
+        # придётся читать длинный журнал. busy=1 — базу ещё читает другой процесс
+        # или занятое соединение; без свободных соединений checkpoint пропускается
+        self.last_checkpoint = None
+        if idle:
+            cur = await idle[0].execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.last_checkpoint = tuple(await cur.fetchone())
+        for db in self._conns:
+            await db.close()
+        self._conns.clear()
+        self._idle = None
+
+
+pool = Pool()
+
+
+# ---------------------------------------
+# Миграции схемы
+# ---------------------------------------
+# Номер применённой миграции хранится в PRAGMA user_version.
+# Новые миграции только добавляются в конец списка, старые не редактируются.
+async def _create_tables(db):
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS rooms (
+        id INTEGER PRIMARY KEY,
+        admin_id INTEGER NOT NULL,
+        title TEXT,
+        status TEXT DEFAULT 'open',
+        password TEXT,
+        description TEXT,
+        banned TEXT DEFAULT ''
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS participants (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        room_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        username TEXT,
+        wishes TEXT,
+        no_gifts TEXT,
+        target_id INTEGER,
+        left INTEGER DEFAULT 0
+    )
+    """)
+
+
+async def _add_indexes(db):
+    # Старые версии бота могли вставить одного пользователя в комнату дважды,
+    # оставляем самую раннюю запись, иначе уникальный индекс не создастся
+    await db.execute("""
+    DELETE FROM participants WHERE id NOT IN (
+        SELECT MIN(id) FROM participants GROUP BY room_id, user_id
+    )
+    """)
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_participants_room_user ON participants (room_id, user_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_participants_user ON participants (user_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_rooms_admin ON rooms (admin_id)")
+
+
+async def _move_bans(db):
+    await db.execute("""
+    CREATE TABLE bans (
+        room_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (room_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    cur = await db.execute("SELECT id, banned FROM rooms WHERE banned IS NOT NULL AND banned != ''")
+    rows = []
+    for room_id, banned in await cur.fetchall():
+        rows.extend((room_id, int(uid)) for uid in banned.split(",") if uid.strip().isdigit())
+    await db.executemany("INSERT OR IGNORE INTO bans (room_id, user_id) VALUES (?, ?)", rows)
+    await db.execute("ALTER TABLE rooms DROP COLUMN banned")
+
+
+async def _add_exclusions(db):
+    # Пары "даритель не может дарить получателю": пары, прошлогодние пары и запреты админа
+    await db.execute("""
+    CREATE TABLE exclusions (
+        room_id INTEGER NOT NULL,
+        giver_id INTEGER NOT NULL,
+        receiver_id INTEGER NOT NULL,
+        kind TEXT NOT NULL DEFAULT 'admin',
+        PRIMARY KEY (room_id, giver_id, receiver_id)
+    ) WITHOUT ROWID
+    """)
+
+
+async def _add_outbox(db):
+    # Исходящие сообщения: status = pending / sending / failed, отправленные удаляются
+    await db.execute("""
+    CREATE TABLE outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL DEFAULT 0,
+        error TEXT
+    )
+    """)
+    await db.execute("CREATE INDEX idx_outbox_pending ON outbox (next_attempt_at) WHERE status='pending'")
+
+
+async def _add_fsm(db):
+    # Состояния FSM: ключ aiogram StorageKey, data в JSON, updated_at для TTL
+    await db.execute("""
+    CREATE TABLE fsm (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at REAL NOT NULL
+    ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX idx_fsm_updated ON fsm (updated_at)")
+
+
+async def _add_participants_room_index(db):
+    # Индекс по room_id неявно упорядочен по (room_id, id): на нём работает
+    # постраничный вывод /participants по id
+    await db.execute("CREATE INDEX idx_participants_room ON participants (room_id)")
+
+
+async def _add_room_id_allocator(db):
+    # Счётчик и секретный ключ для room_ids.create_room
+    await db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID")
+    cur = await db.execute("SELECT COUNT(*) FROM rooms WHERE id BETWEEN 1000 AND 9999")
+    legacy = (await cur.fetchone())[0]
+    counter = room_ids.tier_start(5) if legacy >= room_ids.LEGACY_TIER_LIMIT else 0
+    await db.executemany("INSERT INTO meta (key, value) VALUES (?, ?)", [
+        ("room_id_key", secrets.token_hex(32)),
+        ("room_id_counter", counter),
+    ])
+
+
+async def _add_draw_state(db):
+    # Поиск дарителя по получателю для draw_repair и статус 'drawn' у комнат,
+    # где жеребьёвка уже прошла
+    await db.execute(
+        "CREATE INDEX idx_participants_target ON participants (room_id, target_id) WHERE target_id IS NOT NULL"
+    )
+    await db.execute(
+        "UPDATE rooms SET status='drawn' WHERE id IN (SELECT room_id FROM participants WHERE target_id IS NOT NULL)"
+    )
+
+
+async def _add_jobs(db):
+    # Отложенные задачи scheduler.Scheduler: status = pending / failed, выполненные удаляются
+    await db.execute("""
+    CREATE TABLE jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        room_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        due_at REAL NOT NULL,
+        payload TEXT NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT
+    )
+    """)
+    await db.execute("CREATE INDEX idx_jobs_due ON jobs (due_at) WHERE status='pending'")
+    await db.execute("CREATE INDEX idx_jobs_room ON jobs (room_id)")
+
+
+async def _add_profiles(db):
+    # Пожелания и запреты по умолчанию, общие для всех комнат пользователя. Старый
+    # /wishes писал одно значение во все комнаты сразу: такие одинаковые копии
+    # переносим в профиль, а в participants оставляем только отличающиеся. Это
+    # касается и пользователей из одной комнаты, иначе их копия в participants
+    # перекрывала бы новый общий /wishes (COALESCE(p.wishes, pr.wishes))
+    await db.execute("""
+    CREATE TABLE profiles (
+        user_id INTEGER PRIMARY KEY,
+        wishes TEXT,
+        no_gifts TEXT
+    )
+    """)
+    await db.execute("""
+    INSERT INTO profiles (user_id, wishes, no_gifts)
+    SELECT user_id,
+        CASE WHEN COUNT(wishes) = COUNT(*) AND COUNT(DISTINCT wishes) = 1 THEN MIN(wishes) END,
+        CASE WHEN COUNT(no_gifts) = COUNT(*) AND COUNT(DISTINCT no_gifts) = 1 THEN MIN(no_gifts) END
+    FROM participants GROUP BY user_id
+    """)
+    await db.execute("DELETE FROM profiles WHERE wishes IS NULL AND no_gifts IS NULL")
+    for column in ("wishes", "no_gifts"):
+        await db.execute(f"""
+        UPDATE participants SET {column}=NULL
+        WHERE {column} = (SELECT pr.{column} FROM profiles pr WHERE pr.user_id=participants.user_id)
+        """)
+
+
+async def _add_room_activity(db):
+    # Время последней активности комнаты для archive.Archive. Возраст старых
+    # комнат неизвестен, поэтому отсчёт для них начинается с момента миграции
+    await db.execute("ALTER TABLE rooms ADD COLUMN updated_at REAL")
+    await db.execute("UPDATE rooms SET updated_at=?", (time.time(),))
+    await db.execute("CREATE INDEX idx_rooms_updated ON rooms (updated_at)")
+
+
+async def _add_memberships(db):
+    # Комнаты пользователя для /myrooms одним чтением по первичному ключу. Таблицу
+    # ведут триггеры на rooms и participants, поэтому её не нужно помнить в каждом
+    # месте, где создаются комнаты, входят, выходят, удаляются или уходят в архив.
+    # Админ — строка с role='admin', она не пропадает, если админ вышел как участник
+    await db.execute("""
+    CREATE TABLE memberships (
+        user_id INTEGER NOT NULL,
+        room_id INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        title TEXT,
+        status TEXT,
+        PRIMARY KEY (user_id, room_id)
+    ) WITHOUT ROWID
+    """)
+    await db.execute("CREATE INDEX idx_memberships_room ON memberships (room_id)")
+    await db.execute("""
+    CREATE TRIGGER memberships_room_insert AFTER INSERT ON rooms BEGIN
+        INSERT OR REPLACE INTO memberships (user_id, room_id, role, title, status)
+        VALUES (NEW.admin_id, NEW.id, 'admin', NEW.title, NEW.status);
+    END
+    """)
+    await db.execute("""
+    CREATE TRIGGER memberships_room_update AFTER UPDATE OF title, status ON rooms BEGIN
+        UPDATE memberships SET title=NEW.title, status=NEW.status WHERE room_id=NEW.id;
+    END
+    """)
+    await db.execute("""
+    CREATE TRIGGER memberships_room_delete AFTER DELETE ON rooms BEGIN
+        DELETE FROM memberships WHERE room_id=OLD.id;
+    END
+    """)
+    join = """
+        INSERT OR IGNORE INTO memberships (user_id, room_id, role, title, status)
+        SELECT NEW.user_id, NEW.room_id, 'member', title, status FROM rooms WHERE id=NEW.room_id;
+    """
+    leave = "DELETE FROM memberships WHERE user_id={0}.user_id AND room_id={0}.room_id AND role='member';"
+    await db.execute(f"CREATE TRIGGER memberships_join AFTER INSERT ON participants WHEN NEW.left=0 BEGIN {join} END")
+    await db.execute(f"""
+    CREATE TRIGGER memberships_return AFTER UPDATE OF left ON participants
+    WHEN NEW.left=0 AND OLD.left!=0 BEGIN {join} END
+    """)
+    await db.execute(f"""
+    CREATE TRIGGER memberships_leave AFTER UPDATE OF left ON participants
+    WHEN NEW.left!=0 AND OLD.left=0 BEGIN {leave.format("NEW")} END
+    """)
+    await db.execute(f"CREATE TRIGGER memberships_delete AFTER DELETE ON participants BEGIN {leave.format('OLD')} END")
+    await db.execute("""
+    INSERT INTO memberships (user_id, room_id, role, title, status)
+    SELECT admin_id, id, 'admin', title, status FROM rooms
+    """)
+    await db.execute("""
+    INSERT OR IGNORE INTO memberships (user_id, room_id, role, title, status)
+    SELECT p.user_id, p.room_id, 'member', r.title, r.status
+    FROM participants p JOIN rooms r ON r.id=p.room_id WHERE p.left=0
+    """)
+
+
+async def _add_ban_usernames(db):
+    # Строка участника при бане удаляется, а /unban @username должен его найти
+    await db.execute("ALTER TABLE bans ADD COLUMN username TEXT")
+
+
+MIGRATIONS = [
+    _create_tables,
+    _add_indexes,
+    _move_bans,
+    _add_exclusions,
+    _add_outbox,
+    _add_fsm,
+    _add_participants_room_index,
+    _add_room_id_allocator,
+    _add_draw_state,
+    _add_jobs,
+    _add_profiles,
+    _add_room_activity,
+    _add_memberships,
+    _add_ban_usernames,
+]
+
+
+async def migrate(db):
+    while True:
+        # BEGIN IMMEDIATE сразу берёт блокировку записи: если базу обновляют
+        # одновременно несколько процессов, каждая миграция применится один раз
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            cur = await db.execute("PRAGMA user_version")
+            version = (await cur.fetchone())[0]
+            if version >= len(MIGRATIONS):
+                await db.commit()
+                return version
+            await MIGRATIONS[version](db)
+            await db.execute(f"PRAGMA user_version={version + 1}")
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
@@ -0,0 +1,92 @@
+import random
+from collections import deque
+
+# ---------------------------------------
+# Распределение пар для жеребьёвки
+# ---------------------------------------
+# assign(users, exclusions) возвращает словарь {даритель: получатель}.
+# Без ограничений строится один общий цикл (алгоритм Саттоло) — O(n), без повторов.
+# С ограничениями тот же цикл берётся как начальное паросочетание, а нарушенные
+# пары чинятся поиском увеличивающих путей в графе "кто кому может дарить".
+# Граф хранится как дополнение к списку запретов, поэтому один поиск стоит
+# O(n + число запретов), а не O(n²).
+
+
+class DrawInfeasible(Exception):
+    pass
+
+
+def single_cycle(users, rng=random):
+    order = list(users)
+    rng.shuffle(order)
+    n = len(order)
+    return {order[i]: order[(i + 1) % n] for i in range(n)}
+
+
+def assign(users, exclusions=(), rng=random):
+    users = list(dict.fromkeys(users))
+    if len(users) < 2:
+        raise DrawInfeasible("Недостаточно участников (минимум 2).")
+
+    index = {user: i for i, user in enumerate(users)}
+    blocked = {}
+    for giver, receiver in exclusions:
+        g, r = index.get(giver), index.get(receiver)
+        if g is None or r is None or g == r:
+            continue
+        blocked.setdefault(g, set()).add(r)
+
+    cycle = single_cycle(range(len(users)), rng)
+    if not blocked:
+        return {users[g]: users[r] for g, r in cycle.items()}
+
+    match_g = _match(len(users), blocked, cycle, rng)
+    return {users[g]: users[r] for g, r in enumerate(match_g)}
+
+
+def _match(n, blocked, initial, rng):
+    match_g = [-1] * n
+    match_r = [-1] * n
+    for g, r in initial.items():
+        if r not in blocked.get(g, ()):
+            match_g[g] = r
+            match_r[r] = g
+
+    order = list(range(n))
+    rng.shuffle(order)
+    for u in range(n):
+        if match_g[u] == -1 and not _augment(u, order, blocked, match_g, match_r):
+            raise DrawInfeasible("Невозможно провести жеребьёвку с такими запретами.")
+    return match_g
+
+
+def _augment(u, order, blocked, match_g, match_r):
+    # BFS по чередующимся путям. Каждый получатель посещается не больше одного раза:
+    # после посещения он выбывает из unvisited, а остаются в нём только запрещённые
+    # для текущего дарителя, поэтому суммарная работа — O(n + запреты).
+    parent = {}
+    unvisited = order[:]
+    queue = deque([u])
+    while queue:
+        g = queue.popleft()
+        bl = blocked.get(g, ())
+        keep = []
+        for r in unvisited:
+            if r == g or r in bl:
+                keep.append(r)
+                continue
+            parent[r] = g
+            if match_r[r] == -1:
+                # Свободный получатель найден — переворачиваем путь до u
+                while True:
+                    g = parent[r]
+                    prev = match_g[g]
+                    match_g[g] = r
+                    match_r[r] = g
+                    if g == u:
+                        return True
+                    r = prev
+            queue.append(match_r[r])
+        unvisited = keep
+    # Увеличивающего пути нет — по теореме Бержа полного паросочетания не существует
+    return False
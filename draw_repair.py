@@ -0,0 +1,97 @@
+import random
+
+# ---------------------------------------
+# Починка пар после жеребьёвки
+# ---------------------------------------
+# Пары комнаты — перестановка без неподвижных точек: у каждого ровно один
+# получатель и ровно один даритель. Когда участник X выходит, его даритель G
+# получает бывшего получателя X — меняются две строки, уведомляется один G.
+# Если G -> T запрещено или G и X дарили друг другу, G и T вставляются в другую
+# пару A -> B: G -> B, A -> T. Новый участник L вставляется в случайную пару
+# A -> B как A -> L -> B. Функции работают в текущей транзакции, commit делает
+# вызывающий код, и возвращают список (даритель, новый получатель) или None,
+# если подходящей пары нет и нужна полная жеребьёвка.
+
+
+async def _allowed(db, room_id, giver, receiver):
+    if giver == receiver:
+        return False
+    cur = await db.execute(
+        "SELECT 1 FROM exclusions WHERE room_id=? AND giver_id=? AND receiver_id=?", (room_id, giver, receiver)
+    )
+    return await cur.fetchone() is None
+
+
+async def _random_pair(db, room_id, receiver_for, giver_for, skip_givers, skip_receivers):
+    # Пара A -> B, где разрешены receiver_for -> B и A -> giver_for. Просмотр по
+    # индексу (room_id, id) начинается со случайного id, поэтому при редких
+    # запретах подходящая пара находится за несколько строк, а не за проход по комнате
+    cur = await db.execute("SELECT MIN(id), MAX(id) FROM participants WHERE room_id=?", (room_id,))
+    low, high = await cur.fetchone()
+    if low is None:
+        return None
+    start = random.randint(low, high)
+    skip_a = ",".join("?" * len(skip_givers))
+    skip_b = ",".join("?" * len(skip_receivers))
+    for bound in ("p.id >= ?", "p.id < ?"):
+        cur = await db.execute(f"""
+            SELECT p.user_id, p.target_id FROM participants p
+            WHERE p.room_id=? AND {bound} AND p.left=0 AND p.target_id IS NOT NULL
+              AND p.user_id NOT IN ({skip_a}) AND p.target_id NOT IN ({skip_b})
+              AND NOT EXISTS (SELECT 1 FROM exclusions e WHERE e.room_id=p.room_id
+                              AND e.giver_id=? AND e.receiver_id=p.target_id)
+              AND NOT EXISTS (SELECT 1 FROM exclusions e WHERE e.room_id=p.room_id
+                              AND e.giver_id=p.user_id AND e.receiver_id=?)
+            ORDER BY p.id LIMIT 1
+        """, (room_id, start, *skip_givers, *skip_receivers, receiver_for, giver_for))
+        row = await cur.fetchone()
+        if row:
+            return row
+    return None
+
+
+async def _set_targets(db, room_id, changes):
+    await db.executemany(
+        "UPDATE participants SET target_id=? WHERE room_id=? AND user_id=?",
+        [(receiver, room_id, giver) for giver, receiver in changes]
+    )
+
+
+async def remove_participant(db, room_id, user_id):
+    # Вызывается до удаления строки участника или вместе с left=1
+    cur = await db.execute("SELECT target_id FROM participants WHERE room_id=? AND user_id=?", (room_id, user_id))
+    row = await cur.fetchone()
+    cur = await db.execute(
+        "SELECT user_id FROM participants WHERE room_id=? AND target_id=? AND user_id!=?", (room_id, user_id, user_id)
+    )
+    giver_row = await cur.fetchone()
+    await db.execute("UPDATE participants SET target_id=NULL WHERE room_id=? AND user_id=?", (room_id, user_id))
+    if not row or row[0] is None or giver_row is None:
+        return []
+    target, giver = row[0], giver_row[0]
+
+    if await _allowed(db, room_id, giver, target):
+        changes = [(giver, target)]
+    else:
+        pair = await _random_pair(db, room_id, giver, target, (giver, target, user_id), (giver, user_id))
+        if pair is None:
+            return None
+        other, other_target = pair
+        changes = [(giver, other_target), (other, target)]
+    await _set_targets(db, room_id, changes)
+    return changes
+
+
+async def add_participant(db, room_id, user_id):
+    # Новый или вернувшийся участник встаёт между случайным дарителем и его получателем
+    cur = await db.execute("SELECT target_id FROM participants WHERE room_id=? AND user_id=?", (room_id, user_id))
+    row = await cur.fetchone()
+    if row and row[0] is not None:
+        return []
+    pair = await _random_pair(db, room_id, user_id, user_id, (user_id,), (user_id,))
+    if pair is None:
+        return None
+    giver, target = pair
+    changes = [(giver, user_id), (user_id, target)]
+    await _set_targets(db, room_id, changes)
+    return changes
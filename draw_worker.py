@@ -0,0 +1,203 @@
+import asyncio
+import os
+import pickle
+import sys
+import time
+
+from database import pool
+from draw import DrawInfeasible, assign
+
+# ---------------------------------------
+# Настройки жеребьёвки в отдельном процессе
+# ---------------------------------------
+# Размер задачи — участники плюс запреты. Всё, что меньше порога, считается
+# прямо в обработчике (это миллисекунды), крупнее — в отдельном процессе.
+DRAW_PROCESS_THRESHOLD = int(os.getenv("SANTA_DRAW_PROCESS_THRESHOLD", "5000"))
+# Сколько тяжёлых жеребьёвок может считаться одновременно
+DRAW_PROCESSES = int(os.getenv("SANTA_DRAW_PROCESSES", "2"))
+DRAW_TIMEOUT = float(os.getenv("SANTA_DRAW_TIMEOUT", "120"))
+# Как часто обновлять сообщение о ходе жеребьёвки и проверять отмену
+DRAW_PROGRESS_INTERVAL = 5.0
+# При остановке бота начатая жеребьёвка отменяется за столько секунд до конца
+# SHUTDOWN_TIMEOUT, чтобы её обработчик успел ответить админу до закрытия пула
+DRAW_STOP_GRACE = 3.0
+# Списки уходят в процесс кусками по DRAW_CHUNK: pickle держит GIL, и сотни
+# тысяч запретов одним вызовом остановили бы event loop на десятки миллисекунд
+DRAW_CHUNK = 10000
+
+# Процесс жеребьёвки — отдельный интерпретатор (python draw_worker.py), а не
+# multiprocessing: fork из процесса с потоками aiosqlite может унаследовать
+# захваченную блокировку, а spawn и forkserver в каждом дочернем процессе заново
+# выполняют main.py (импорт aiogram — секунды). Запуск процесса и передача задачи
+# через stdin идут асинхронно и не останавливают event loop даже на больших данных.
+
+
+class DrawCancelled(Exception):
+    pass
+
+
+class DrawTimeout(Exception):
+    pass
+
+
+def _compute(users, exclusions):
+    # Выполняется в дочернем процессе, см. конец модуля
+    try:
+        return "ok", assign(users, exclusions)
+    except DrawInfeasible as e:
+        return "infeasible", str(e)
+    except Exception as e:
+        return "error", repr(e)
+
+
+def _cancel_key(room_id):
+    return f"draw_cancel_{room_id}"
+
+
+# ---------------------------------------
+# Запуск и отмена жеребьёвок
+# ---------------------------------------
+# Каждая тяжёлая жеребьёвка получает свой процесс: отмену и таймаут можно
+# выполнить, просто убив его, не задевая жеребьёвки других комнат. Пока процесс
+# считает, event loop продолжает обслуживать остальных пользователей.
+#
+# Кнопка отмены в режиме webhook может попасть в другой воркер, поэтому кроме
+# прямой отмены есть флаг в таблице meta, который проверяется на каждом тике.
+class DrawWorker:
+    def __init__(self, pool, threshold=DRAW_PROCESS_THRESHOLD, processes=DRAW_PROCESSES,
+                 timeout=DRAW_TIMEOUT, interval=DRAW_PROGRESS_INTERVAL):
+        self.pool = pool
+        self.threshold = threshold
+        self.timeout = timeout
+        self.interval = interval
+        self._slots = asyncio.Semaphore(processes)
+        self._running = {}
+        self._stopping = False
+
+    def offloaded(self, users, exclusions):
+        return len(users) + len(exclusions) >= self.threshold
+
+    def is_running(self, room_id):
+        return str(room_id) in self._running
+
+    async def run(self, room_id, users, exclusions, progress=None):
+        # progress(elapsed) вызывается раз в interval секунд, пока идёт расчёт
+        users = list(users)
+        if not self.offloaded(users, exclusions):
+            return assign(users, exclusions)
+        room_id = str(room_id)
+        if self._stopping:
+            raise DrawCancelled()
+        async with self.pool.acquire() as db:
+            await db.execute("DELETE FROM meta WHERE key=?", (_cancel_key(room_id),))
+            await db.commit()
+        async with self._slots:
+            task = asyncio.create_task(self._spawn(users, exclusions))
+            self._running[room_id] = task
+            start = time.monotonic()
+            try:
+                while True:
+                    elapsed = time.monotonic() - start
+                    if elapsed >= self.timeout:
+                        task.cancel()
+                        await asyncio.wait({task})
+                        raise DrawTimeout()
+                    await asyncio.wait({task}, timeout=min(self.interval, self.timeout - elapsed))
+                    if task.done():
+                        break
+                    if await self._cancel_requested(room_id):
+                        task.cancel()
+                        continue
+                    if progress:
+                        await progress(time.monotonic() - start)
+            finally:
+                del self._running[room_id]
+                if not task.done():
+                    task.cancel()
+        if task.cancelled():
+            raise DrawCancelled()
+        status, value = task.result()
+        if status == "infeasible":
+            raise DrawInfeasible(value)
+        if status == "error":
+            raise RuntimeError(f"Ошибка в процессе жеребьёвки: {value}")
+        return value
+
+    async def cancel(self, room_id):
+        # True — жеребьёвка шла в этом процессе и остановлена сразу,
+        # иначе оставляем флаг для воркера, который её считает
+        task = self._running.get(str(room_id))
+        if task:
+            task.cancel()
+            return True
+        async with self.pool.acquire() as db:
+            await db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, 1)", (_cancel_key(room_id),))
+            await db.commit()
+        return False
+
+    async def stop(self, timeout=0):
+        # Начатым жеребьёвкам даётся до timeout секунд, потом они отменяются
+        # (процессы убиваются), а новые сразу получают DrawCancelled
+        self._stopping = True
+        tasks = list(self._running.values())
+        if tasks and timeout > 0:
+            await asyncio.wait(tasks, timeout=timeout)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def _cancel_requested(self, room_id):
+        async with self.pool.acquire() as db:
+            cur = await db.execute("DELETE FROM meta WHERE key=? RETURNING 1", (_cancel_key(room_id),))
+            found = await cur.fetchone() is not None
+            await db.commit()
+        return found
+
+    async def _spawn(self, users, exclusions):
+        # stderr общий с ботом: traceback процесса попадёт в его лог
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+        )
+        try:
+            try:
+                for items in (users, exclusions):
+                    await _write_chunks(process.stdin, items)
+                process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            output = await process.stdout.read()
+            await process.wait()
+        finally:
+            # Отмена (таймаут, /draw cancel, остановка бота) убивает процесс
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        if process.returncode or not output:
+            return "error", f"процесс завершился с кодом {process.returncode}"
+        return pickle.loads(output)
+
+
+async def _write_chunks(stream, items):
+    items = list(items)
+    for start in range(0, len(items), DRAW_CHUNK):
+        stream.write(pickle.dumps(items[start:start + DRAW_CHUNK]))
+        await stream.drain()
+    stream.write(pickle.dumps([]))
+
+
+def _read_chunks(stream):
+    items = []
+    while chunk := pickle.load(stream):
+        items += chunk
+    return items
+
+
+draw_worker = DrawWorker(pool)
+
+
+if __name__ == "__main__":
+    # Дочерний процесс _spawn: задача приходит в stdin, ответ уходит в stdout
+    users, exclusions = _read_chunks(sys.stdin.buffer), _read_chunks(sys.stdin.buffer)
+    pickle.dump(_compute(users, exclusions), sys.stdout.buffer)
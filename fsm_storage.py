@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+# ---------------------------------------
+# Настройки хранилища FSM
+# ---------------------------------------
+# Брошенный на середине сценарий (ввод пароля, создание комнаты и т.п.)
+# считается забытым через FSM_TTL секунд с последнего изменения
+FSM_TTL = int(os.getenv("SANTA_FSM_TTL", str(24 * 3600)))
+FSM_CACHE_SIZE = int(os.getenv("SANTA_FSM_CACHE_SIZE", "10000"))
+FSM_CLEANUP_INTERVAL = 600
+FSM_CLEANUP_BATCH = 1000
+
+logger = logging.getLogger("santa.fsm")
+
+
+# ---------------------------------------
+# FSM в таблице fsm той же базы santa.db
+# ---------------------------------------
+# Запись сквозная: каждое изменение сразу пишется в базу, а кэш в памяти
+# ограничен FSM_CACHE_SIZE ключами (LRU). В кэше хранятся и пустые ответы,
+# потому что состояние запрашивается на каждом апдейте каждого пользователя.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, pool, ttl=FSM_TTL, cache_size=FSM_CACHE_SIZE):
+        self.pool = pool
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache = OrderedDict()
+        self._cleanup_task = None
+
+    def _remember(self, key, record):
+        if self.cache_size <= 0:
+            return
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, key):
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+        else:
+            async with self.pool.acquire() as db:
+                cur = await db.execute("SELECT state, data, updated_at FROM fsm WHERE key=?", (key,))
+                row = await cur.fetchone()
+            record = (row[0], json.loads(row[1]), row[2]) if row else (None, {}, 0.0)
+            self._remember(key, record)
+        state, data, updated_at = record
+        if (state is not None or data) and time.time() - updated_at > self.ttl:
+            return None, {}
+        return state, data
+
+    async def _store(self, key, state, data):
+        now = time.time()
+        async with self.pool.acquire() as db:
+            if state is None and not data:
+                await db.execute("DELETE FROM fsm WHERE key=?", (key,))
+            else:
+                await db.execute(
+                    "INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                    (key, state, json.dumps(data, ensure_ascii=False), now)
+                )
+            await db.commit()
+        self._remember(key, (state, data, now))
+
+    async def set_state(self, key, state=None):
+        k = self.key_builder.build(key)
+        _, data = await self._load(k)
+        await self._store(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key):
+        state, _ = await self._load(self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key, data):
+        k = self.key_builder.build(key)
+        state, _ = await self._load(k)
+        await self._store(k, state, dict(data))
+
+    async def get_data(self, key):
+        _, data = await self._load(self.key_builder.build(key))
+        return dict(data)
+
+    # ---------------------------------------
+    # Периодическая очистка брошенных сценариев
+    # ---------------------------------------
+    def start_cleanup(self, interval=FSM_CLEANUP_INTERVAL):
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop(interval))
+
+    async def _cleanup_loop(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.cleanup()
+            except Exception:
+                # Не удалось сейчас (например, база занята) — попробуем в следующий раз
+                logger.exception("Не удалось очистить старые состояния FSM")
+
+    async def cleanup(self):
+        # Удаляем пачками, чтобы не держать блокировку записи долго
+        deadline = time.time() - self.ttl
+        removed = 0
+        while True:
+            async with self.pool.acquire() as db:
+                cur = await db.execute(
+                    "DELETE FROM fsm WHERE key IN (SELECT key FROM fsm WHERE updated_at<? LIMIT ?)",
+                    (deadline, FSM_CLEANUP_BATCH)
+                )
+                await db.commit()
+            removed += cur.rowcount
+            if cur.rowcount < FSM_CLEANUP_BATCH:
+                break
+            await asyncio.sleep(0)
+        for key in [k for k, (_, _, updated_at) in self._cache.items() if updated_at and updated_at < deadline]:
+            del self._cache[key]
+        return removed
+
+    def clear_cache(self):
+        # После восстановления базы из резервной копии (backup.py)
+        self._cache.clear()
+
+    async def close(self):
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            await asyncio.gather(self._cleanup_task, return_exceptions=True)
+            self._cleanup_task = None
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+
+# ---------------------------------------
+# Настройки запуска и остановки
+# ---------------------------------------
+# При остановке бот ждёт начатые обработчики и рассылку из outbox не дольше
+# SHUTDOWN_TIMEOUT секунд: значение должно быть меньше, чем systemd
+# (TimeoutStopSec) или docker (stop_grace_period) ждут до SIGKILL
+SHUTDOWN_TIMEOUT = float(os.getenv("SANTA_SHUTDOWN_TIMEOUT", "20"))
+# Столько недавно активных комнат загружается в кэш при запуске
+WARM_ROOMS = int(os.getenv("SANTA_WARM_ROOMS", "1000"))
+
+logger = logging.getLogger("santa.lifecycle")
+
+
+# ---------------------------------------
+# Учёт апдейтов в обработке
+# ---------------------------------------
+# Внешний middleware на dp.update. Polling при остановке отменяет только цикл
+# getUpdates, а webhook — только приём запросов: уже начатые обработчики
+# продолжают работать, и on_shutdown дожидается их через drain(), прежде чем
+# закрывать пул. Заодно засекается время от запуска процесса до первого апдейта;
+# started main.py ставит в самом начале, чтобы в замер вошёл и импорт aiogram.
+class Lifecycle(BaseMiddleware):
+    def __init__(self, timeout=SHUTDOWN_TIMEOUT):
+        self.timeout = timeout
+        self.started = time.perf_counter()
+        self.ready_seconds = None
+        self.first_update_seconds = None
+        self.shutdown_report = None
+        self.in_flight = 0
+        self._deadline = None
+        self._stopping = None
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        if self.first_update_seconds is None:
+            self.first_update_seconds = time.perf_counter() - self.started
+            logger.info("Первый апдейт через %.2f с после запуска", self.first_update_seconds)
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._idle.set()
+
+    def ready(self):
+        self.ready_seconds = time.perf_counter() - self.started
+        logger.info("Запуск занял %.2f с", self.ready_seconds)
+
+    def begin_shutdown(self):
+        self._deadline = time.monotonic() + self.timeout
+        self._stopping = time.perf_counter()
+
+    def stopped(self, handlers, unsent, checkpoint):
+        # checkpoint — (busy, страниц в WAL, перенесено), см. database.Pool.close
+        self.shutdown_report = {"seconds": time.perf_counter() - self._stopping, "handlers": handlers,
+                                "unsent": unsent, "checkpoint": checkpoint}
+        logger.info("Остановка за %.2f с: не завершено обработчиков %s, не отправлено сообщений %s, "
+                    "checkpoint WAL %s", *self.shutdown_report.values())
+
+    def remaining(self):
+        # Сколько секунд осталось до конца SHUTDOWN_TIMEOUT, отсчитанного в begin_shutdown
+        return max(0.0, self._deadline - time.monotonic()) if self._deadline else self.timeout
+
+    async def drain(self):
+        # -> сколько обработчиков не успело завершиться
+        try:
+            await asyncio.wait_for(self._idle.wait(), self.remaining())
+        except asyncio.TimeoutError:
+            logger.warning("Остановка: не дождались %s обработчиков за %.0f с", self.in_flight, self.timeout)
+        return self.in_flight
+
+
+lifecycle = Lifecycle()
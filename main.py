@@ -1,29 +1,103 @@
 import asyncio
-import random
+import itertools
+import logging
 import os
-import aiosqlite
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+# Отсчёт времени запуска (lifecycle.py) начинается до импорта aiogram и чтения .env
+STARTED = time.perf_counter()
+
 from dotenv import load_dotenv
 load_dotenv()
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramAPIError
 from aiogram.filters import Command
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+import bulk
+import metrics
+import throttle
+import webhook
+from callbacks import (
+    DeleteCallback,
+    DrawCancelCallback,
+    JoinCallback,
+    MyRoomsBackCallback,
+    MyRoomsCallback,
+    NoGiftsCallback,
+    ParticipantsBackCallback,
+    ParticipantsCallback,
+    WishesCallback,
+    callbacks,
+)
+from archive import archive, compactor
+from backup import BackupError, backups
+from batcher import batcher
+from cache import invalidate_room, room_cache, room_key
+from database import pool
+from draw import DrawInfeasible
+from draw_worker import DRAW_STOP_GRACE, DrawCancelled, DrawTimeout, draw_worker
+from fsm_storage import SQLiteStorage
+from lifecycle import WARM_ROOMS, lifecycle
+from outbox import outbox
+from repository import repository
+from scheduler import scheduler
+
 # ---------------------------------------
 # Настройки
 # ---------------------------------------
 TOKEN = os.getenv("SANTA_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
+# polling — один процесс с getUpdates, webhook — aiohttp-сервер (см. webhook.py)
+MODE = os.getenv("SANTA_MODE", "polling")
+# Свой адрес Bot API: локальный telegram-bot-api или benchmarks/fake_telegram.py
+API_URL = os.getenv("SANTA_API_URL")
+ROOM_CACHE_SHARED_TTL = 2.0
+# Часовой пояс для дат в /schedule и /deadline
+TIMEZONE = ZoneInfo(os.getenv("SANTA_TIMEZONE", "Europe/Moscow"))
+# За сколько до запланированной жеребьёвки напомнить заполнить пожелания
+NUDGE_BEFORE = 24 * 3600
+# За сколько дней до обмена подарками напоминать участникам
+REMINDER_DAYS = (3, 1)
+# Входы и выходы сдвигают время активности комнаты (rooms.updated_at, по нему
+# archive.py решает, что комната заброшена) не чаще раза в столько секунд
+ROOM_TOUCH_INTERVAL = 24 * 3600
+# Владельцы бота (user_id через запятую): им доступна команда /admin
+OWNERS = {int(uid) for uid in os.getenv("SANTA_OWNERS", "").replace(" ", "").split(",") if uid.isdigit()}
 
 if not TOKEN or not BOT_USERNAME:
     raise SystemExit("❌ В секретах должны быть SANTA_TOKEN и BOT_USERNAME")
 
-bot = Bot(TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(API_URL)) if API_URL else None)
+storage = SQLiteStorage(pool)
+dp = Dispatcher(storage=storage)
+lifecycle.started = STARTED
+dp.update.outer_middleware(lifecycle)
+metrics.setup(dp, pool, batcher)
+throttle.setup(dp)
+callbacks.setup(dp.callback_query)
+metrics.collectors.append(metrics.cache_collector("room", room_cache))
+metrics.collectors.append(metrics.batcher_collector(batcher))
+metrics.collectors.append(metrics.archive_collector(archive, compactor))
+metrics.collectors.append(metrics.backup_collector(backups))
+metrics.collectors.append(metrics.lifecycle_collector(lifecycle))
 
-DB_FILE = "santa.db"
+# ---------------------------------------
+# Подмена хранилищ
+# ---------------------------------------
+def use_repository(new_repository, new_storage):
+    # Обработчики берут данные из repository, а FSMContext — из dp.fsm.storage:
+    # use_repository(MemoryRepository(), MemoryStorage()) гоняет их без santa.db
+    # (benchmarks/bench_handlers.py). Вызывать до первого апдейта
+    global repository, storage
+    repository, storage = new_repository, new_storage
+    dp.fsm.storage = new_storage
 
 # ---------------------------------------
 # FSM для username, пожеланий, запретов, пароля, описания, удаления
@@ -49,35 +123,17 @@ class DeleteParticipantState(StatesGroup):
 class JoinPasswordState(StatesGroup):
     wait_text = State()
 
+class ImportState(StatesGroup):
+    wait_document = State()
+
 # ---------------------------------------
 # Инициализация базы
 # ---------------------------------------
 async def init_db():
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS rooms (
-            id INTEGER PRIMARY KEY,
-            admin_id INTEGER NOT NULL,
-            title TEXT,
-            status TEXT DEFAULT 'open',
-            password TEXT,
-            description TEXT,
-            banned TEXT DEFAULT ''
-        );
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS participants (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            room_id INTEGER NOT NULL,
-            user_id INTEGER NOT NULL,
-            username TEXT,
-            wishes TEXT,
-            no_gifts TEXT,
-            target_id INTEGER,
-            left INTEGER DEFAULT 0
-        );
-        """)
-        await db.commit()
+    # Соединения пула и batcher открываются параллельно; кэш комнат заполняется
+    # после миграций, уже по новой схеме
+    await asyncio.gather(pool.open(), batcher.open())
+    await repository.migrate(WARM_ROOMS)
 
 # ---------------------------------------
 # Inline-кнопки для пожеланий и запретов
@@ -85,93 +141,121 @@ async def init_db():
 def wishes_buttons(room_id):
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="✨ Ввести пожелания", callback_data=f"wishes_{room_id}")],
-            [InlineKeyboardButton(text="🚫 Ввести запреты", callback_data=f"nogifts_{room_id}")]
+            [InlineKeyboardButton(text="✨ Ввести пожелания", callback_data=WishesCallback(room_id=room_id).pack())],
+            [InlineKeyboardButton(text="🚫 Ввести запреты", callback_data=NoGiftsCallback(room_id=room_id).pack())]
         ]
     )
 
 # ---------------------------------------
 # Универсальная функция для нового пользователя
 # ---------------------------------------
-async def handle_new_user(user_id, username, room_id, state: FSMContext, message_obj):
-    async with aiosqlite.connect(DB_FILE) as db:
-        # Получаем информацию о комнате
-        cur = await db.execute("SELECT admin_id, title, banned, password, description FROM rooms WHERE id=?", (room_id,))
-        row = await cur.fetchone()
-        if not row:
-            # Исправлено: message_obj может быть types.Message или types.CallbackQuery
-            if isinstance(message_obj, types.CallbackQuery):
-                await message_obj.message.answer("❌ Комната не найдена")
+async def change_membership(room, room_id, user_id, op, *args):
+    # op — операция репозитория: "join", "rejoin" или "leave". До жеребьёвки это
+    # одиночная запись (repository.write, в SQLite — через batcher). После неё в той
+    # же транзакции чиним пары и ставим уведомления затронутым в outbox.
+    # Возвращает True, если состав комнаты изменился.
+    joined = op != "leave"
+    if room is None or room.status != "drawn":
+        updated = await repository.write(op, room_id, user_id, *args)
+        if updated:
+            await touch_room(room)
+        return updated
+    async with repository.session() as db:
+        updated = await getattr(repository, op)(db, room_id, user_id, *args)
+        if updated:
+            if joined:
+                changes = await repository.repair_join(db, room.id, user_id)
             else:
-                await message_obj.answer("❌ Комната не найдена")
-            return
-        admin_id, room_name, banned, room_password, room_description = row
-
-        # Проверка banned (но админ может войти всегда)
-        if banned and str(user_id) in banned.split(',') and user_id != admin_id:
-            if isinstance(message_obj, types.CallbackQuery):
-                await message_obj.message.answer("⛔ Вы были удалены из этой комнаты и не можете в неё войти.")
-            else:
-                await message_obj.answer("⛔ Вы были удалены из этой комнаты и не можете в неё войти.")
-            return
-
-        # Проверка пароля при join
-        data = await state.get_data()
-        if room_password and data.get("password_verified") != True:
-            # Сохраняем данные для JoinPasswordState
-            await state.update_data(room_id=room_id, user_id=user_id, username=username, room_password=room_password)
-
-            # Отправляем сообщение
-            if isinstance(message_obj, types.CallbackQuery):
-                await message_obj.message.answer(f"🔒 Эта комната защищена паролем. Введите 4-значный пароль:")
-            else:
-                await message_obj.answer(f"🔒 Эта комната защищена паролем. Введите 4-значный пароль:")
-
-            await state.set_state(JoinPasswordState.wait_text)
-            return
-
-        # Проверяем, есть ли уже такой пользователь в этой комнате
-        cur = await db.execute("SELECT left FROM participants WHERE room_id=? AND user_id=?", (room_id, user_id))
-        row = await cur.fetchone()
-
-        # Выбираем объект для ответа
-        answer_obj = message_obj.message if isinstance(message_obj, types.CallbackQuery) else message_obj
-
-        if row:
-            if row[0] == 1:
-                # Пользователь ранее вышел, возвращаем его
-                await db.execute("UPDATE participants SET left=0 WHERE room_id=? AND user_id=?", (room_id, user_id))
-                await db.commit()
-
-                text = f"Вы вернулись в комнату «{room_name}»! Можно указать пожелания и запреты:"
-                if room_description:
-                    text += f"\n\n📄 **Правила комнаты:**\n{room_description}"
+                changes = await repository.repair_leave(db, room.id, user_id)
+            await notify_draw_changes(db, room, changes, user_id if joined else None)
+        await db.commit()
+    outbox.wake()
+    if updated:
+        await touch_room(room)
+    return updated
+
+async def touch_room(room):
+    if room is not None and (room.updated_at or 0) < time.time() - ROOM_TOUCH_INTERVAL:
+        await repository.write("touch_room", room.id, time.time())
+        invalidate_room(room.id)
+
+async def notify_draw_changes(db, room, changes, joined_user=None):
+    if changes is None:
+        text = (f"⚠️ После изменения состава комнаты «{room.title}» не удалось перестроить пары "
+                f"с учётом запретов. Проведите жеребьёвку заново: /draw {room.id}")
+        return await repository.enqueue(db, [(room.admin_id, text)])
+    if not changes:
+        return
+    profiles = await repository.draw_profiles(db, room.id, [receiver for _, receiver in changes])
+    messages = []
+    for giver, receiver in changes:
+        text = target_message(*profiles[receiver])
+        if giver != joined_user:
+            text = f"🔄 Состав комнаты «{room.title}» изменился, у тебя новый получатель.\n\n{text}"
+        messages.append((giver, text))
+    await repository.enqueue(db, messages)
 
-                await answer_obj.answer(text, reply_markup=wishes_buttons(room_id))
-                return
-            else:
-                # Уже в комнате
-                text = f"Вы уже присоединились к комнате «{room_name}»! Можно указать пожелания и запреты:"
-                if room_description:
-                    text += f"\n\n📄 **Правила комнаты:**\n{room_description}"
-
-                await answer_obj.answer(text, reply_markup=wishes_buttons(room_id))
-                return
-
-        # Новый пользователь
-        if not username:
-            await answer_obj.answer("У вас нет Telegram username. Пожалуйста, введите имя для отображения в комнате:")
-            await state.set_state(UsernameState.wait_text)
-            await state.update_data(room_id=room_id)
+async def handle_new_user(user_id, username, room_id, state: FSMContext, message_obj):
+    # Выбираем объект для ответа (message_obj может быть types.Message или types.CallbackQuery)
+    answer_obj = message_obj.message if isinstance(message_obj, types.CallbackQuery) else message_obj
+
+    # Все чтения делаем за одно короткое обращение к пулу: ответы в Telegram и
+    # записи через batcher идут уже без занятого соединения
+    async with repository.session() as db:
+        room = await repository.get_room(db, room_id)
+        if room:
+            banned = user_id != room.admin_id and await repository.is_banned(db, room_id, user_id)
+            # Проверяем, есть ли уже такой пользователь в этой комнате
+            left = await repository.member_left(db, room_id, user_id)
+
+    if not room:
+        await answer_obj.answer("❌ Комната не найдена")
+        return
+    room_name, room_password, room_description = room.title, room.password, room.description
+
+    # Проверка banned (но админ может войти всегда)
+    if banned:
+        await answer_obj.answer("⛔ Вы были удалены из этой комнаты и не можете в неё войти.")
+        return
+
+    # Проверка пароля при join
+    data = await state.get_data()
+    if room_password and data.get("password_verified") != True:
+        # Сохраняем данные для JoinPasswordState
+        await state.update_data(room_id=room_id, user_id=user_id, username=username, room_password=room_password)
+        await answer_obj.answer(f"🔒 Эта комната защищена паролем. Введите 4-значный пароль:")
+        await state.set_state(JoinPasswordState.wait_text)
+        return
+
+    if left is not None:
+        if left == 1:
+            # Пользователь ранее вышел, возвращаем его
+            await change_membership(room, room_id, user_id, "rejoin")
+
+            text = f"Вы вернулись в комнату «{room_name}»! Можно указать пожелания и запреты:"
         else:
-            await db.execute("INSERT INTO participants (room_id, user_id, username) VALUES (?, ?, ?)", (room_id, user_id, username))
-            await db.commit()
+            # Уже в комнате
+            text = f"Вы уже присоединились к комнате «{room_name}»! Можно указать пожелания и запреты:"
+        if room_description:
+            text += f"\n\n📄 **Правила комнаты:**\n{room_description}"
+
+        await answer_obj.answer(text, reply_markup=wishes_buttons(room_id))
+        return
+
+    # Новый пользователь
+    if not username:
+        await answer_obj.answer("У вас нет Telegram username. Пожалуйста, введите имя для отображения в комнате:")
+        await state.set_state(UsernameState.wait_text)
+        await state.update_data(room_id=room_id)
+    else:
+        # OR IGNORE: при двойном нажатии "Присоединиться" второй INSERT упрётся в уникальный индекс
+        await change_membership(room, room_id, user_id, "join", username)
 
-            text = f"Вы присоединились к комнате «{room_name}»! Можно сразу указать пожелания и запреты:"
-            if room_description:
-                text += f"\n\n📄 **Правила комнаты:**\n{room_description}"
+        text = f"Вы присоединились к комнате «{room_name}»! Можно сразу указать пожелания и запреты:"
+        if room_description:
+            text += f"\n\n📄 **Правила комнаты:**\n{room_description}"
 
-            await answer_obj.answer(text, reply_markup=wishes_buttons(room_id))
+        await answer_obj.answer(text, reply_markup=wishes_buttons(room_id))
 
 # ---------------------------------------
 # START
@@ -188,11 +272,21 @@ async def cmd_start(message: types.Message, state: FSMContext):
             "Создать комнату: /newroom Название\n"
             "Присоединиться в комнату: /join ID\n"
             "Выйти из комнаты: /leave ID\n"
-            "Указать пожелания: /wishes\n"
-            "Указать запреты: /nogifts\n"
+            "Указать пожелания: /wishes (общие) или /wishes ID (для комнаты)\n"
+            "Указать запреты: /nogifts (общие) или /nogifts ID (для комнаты)\n"
             "Провести жеребьёвку (только админ): /draw ID\n"
+            "Запланировать жеребьёвку (только админ): /schedule ID ДД.ММ.ГГГГ ЧЧ:ММ\n"
+            "Дата обмена подарками и напоминания (только админ): /deadline ID ДД.ММ.ГГГГ\n"
+            "Запланированные события (только админ): /jobs ID, отменить: /unschedule ID\n"
+            "Запретить паре дарить друг другу (только админ): /exclude ID @user1 @user2\n"
+            "Запретить одному дарить другому (только админ): /block ID @кто @кому\n"
+            "Исключить прошлогодние пары (только админ): /excludepast ID ID_прошлой_комнаты\n"
+            "Посмотреть запреты (только админ): /exclusions ID\n"
             "Посмотреть участников (только админ): /participants ID\n"
-            "Показать ваши комнаты: /myrooms"
+            "Добавить участников из CSV (только админ): /import ID\n"
+            "Заблокировать или разблокировать (только админ): /ban ID @user1 @user2, /unban ID @user1\n"
+            "Показать ваши комнаты: /myrooms\n"
+            "Архив ваших завершённых комнат (только админ): /archive или /archive ID"
         )
 
 # ---------------------------------------
@@ -202,14 +296,10 @@ async def cmd_start(message: types.Message, state: FSMContext):
 async def cmd_newroom(message: types.Message, state: FSMContext):
     title = message.text.replace("/newroom", "").strip() or "Моя комната"
 
-    async with aiosqlite.connect(DB_FILE) as db:
-        while True:
-            room_id = random.randint(1000, 9999)
-            cur = await db.execute("SELECT id FROM rooms WHERE id=?", (room_id,))
-            if not await cur.fetchone():
-                break
-        await db.execute("INSERT INTO rooms (id, admin_id, title) VALUES (?, ?, ?)", (room_id, message.from_user.id, title))
+    async with repository.session() as db:
+        room_id = await repository.create_room(db, message.from_user.id, title)
         await db.commit()
+    invalidate_room(room_id)
 
     await state.update_data(room_id=room_id)
 
@@ -222,17 +312,16 @@ async def cmd_newroom(message: types.Message, state: FSMContext):
 # ---------------------------------------
 # Inline кнопка присоединения
 # ---------------------------------------
-@dp.callback_query(lambda c: c.data and c.data.startswith("join_"))
-async def callback_join(callback_query: types.CallbackQuery, state: FSMContext):
-    room_id = callback_query.data.split("_")[1]
+@callbacks.route(JoinCallback)
+async def callback_join(callback_query: types.CallbackQuery, callback_data: JoinCallback, state: FSMContext):
     # Передаем callback_query как message_obj
-    await handle_new_user(callback_query.from_user.id, callback_query.from_user.username, room_id, state, callback_query)
+    await handle_new_user(callback_query.from_user.id, callback_query.from_user.username, callback_data.room_id, state, callback_query)
     await callback_query.answer()
 
 # ---------------------------------------
 # Callback пароля
 # ---------------------------------------
-@dp.callback_query(lambda c: c.data in ["set_password", "skip_password"])
+@callbacks.static("set_password", "skip_password")
 async def callback_password_choice(callback: types.CallbackQuery, state: FSMContext):
     if callback.data == "set_password":
         await callback.message.answer("Введите 4-значный пароль:")
@@ -257,9 +346,10 @@ async def save_room_password(message: types.Message, state: FSMContext):
 
     data = await state.get_data()
     room_id = data["room_id"]
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("UPDATE rooms SET password=? WHERE id=?", (password, room_id))
+    async with repository.session() as db:
+        await repository.update_room(db, room_id, "password", password)
         await db.commit()
+    invalidate_room(room_id)
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Пропустить", callback_data="skip_description")]
@@ -270,7 +360,7 @@ async def save_room_password(message: types.Message, state: FSMContext):
 # ---------------------------------------
 # Ввод описания или пропуск
 # ---------------------------------------
-@dp.callback_query(lambda c: c.data == "skip_description")
+@callbacks.static("skip_description")
 async def skip_description(callback: types.CallbackQuery, state: FSMContext):
     # await state.update_data(room_description=None) # Удалено, т.к. не нужно
     await finalize_room_creation(callback.message, state)
@@ -281,9 +371,10 @@ async def save_room_description(message: types.Message, state: FSMContext):
     description = message.text.strip()
     data = await state.get_data()
     room_id = data["room_id"]
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("UPDATE rooms SET description=? WHERE id=?", (description, room_id))
+    async with repository.session() as db:
+        await repository.update_room(db, room_id, "description", description)
         await db.commit()
+    invalidate_room(room_id)
     await finalize_room_creation(message, state)
 
 # ---------------------------------------
@@ -292,13 +383,12 @@ async def save_room_description(message: types.Message, state: FSMContext):
 async def finalize_room_creation(message: types.Message, state: FSMContext):
     data = await state.get_data()
     room_id = data["room_id"]
-    async with aiosqlite.connect(DB_FILE) as db:
-        cur = await db.execute("SELECT title FROM rooms WHERE id=?", (room_id,))
-        title = (await cur.fetchone())[0]
+    async with repository.session() as db:
+        title = (await repository.get_room(db, room_id)).title
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="Присоединиться", callback_data=f"join_{room_id}")]
+            [InlineKeyboardButton(text="Присоединиться", callback_data=JoinCallback(room_id=room_id).pack())]
         ]
     )
     await message.answer(
@@ -317,37 +407,15 @@ async def save_username(message: types.Message, state: FSMContext):
     room_id = data.get("room_id")
     username = message.text.strip()
 
-    async with aiosqlite.connect(DB_FILE) as db:
-        cur = await db.execute("SELECT title FROM rooms WHERE id=?", (room_id,))
-        row = await cur.fetchone()
-        room_name = row[0] if row and row[0] else f"#{room_id}"
+    async with repository.session() as db:
+        room = await repository.get_room(db, room_id)
+        room_name = room.title if room and room.title else f"#{room_id}"
+        room_description = room.description if room else None
 
-        # Проверяем, есть ли уже такой пользователь в этой комнате
-        cur = await db.execute(
-            "SELECT left FROM participants WHERE room_id=? AND user_id=?",
-            (room_id, message.from_user.id)
-        )
-        row = await cur.fetchone()
-
-        if row:
-            # Пользователь уже в комнате, обновляем имя и возвращаем, если был left=1
-            await db.execute(
-                "UPDATE participants SET username=?, left=0 WHERE room_id=? AND user_id=?",
-                (username, room_id, message.from_user.id)
-            )
-        else:
-            # Новый пользователь, добавляем запись
-            await db.execute(
-                "INSERT INTO participants (room_id, user_id, username) VALUES (?, ?, ?)",
-                (room_id, message.from_user.id, username)
-            )
-        await db.commit()
-
-    # Получаем описание комнаты для отображения
-    async with aiosqlite.connect(DB_FILE) as db:
-        cur = await db.execute("SELECT description FROM rooms WHERE id=?", (room_id,))
-        row = await cur.fetchone()
-        room_description = row[0] if row else None
+    # Новый пользователь добавляется, а если он уже в комнате —
+    # обновляем имя и возвращаем, если был left=1
+    if not await change_membership(room, room_id, message.from_user.id, "join", username):
+        await change_membership(room, room_id, message.from_user.id, "rejoin", username)
 
     await state.clear()
 
@@ -360,21 +428,64 @@ async def save_username(message: types.Message, state: FSMContext):
 # ---------------------------------------
 # Обработчики кнопок пожеланий и запретов
 # ---------------------------------------
-@dp.callback_query(lambda c: c.data and c.data.startswith("wishes_"))
-async def callback_wishes(callback_query: types.CallbackQuery, state: FSMContext):
-    await callback_query.message.answer("Напиши свои пожелания (одним сообщением):")
-    await state.set_state(WishState.wait_text)
+@callbacks.route(WishesCallback)
+async def callback_wishes(callback_query: types.CallbackQuery, callback_data: WishesCallback, state: FSMContext):
+    await ask_profile(callback_query.message, state, WishState.wait_text, "пожелания", "wishes", callback_data.room_id)
     await callback_query.answer()
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("nogifts_"))
-async def callback_nogifts(callback_query: types.CallbackQuery, state: FSMContext):
-    await callback_query.message.answer("Напиши свои запреты (одним сообщением):")
-    await state.set_state(NoGiftState.wait_text)
+@callbacks.route(NoGiftsCallback)
+async def callback_nogifts(callback_query: types.CallbackQuery, callback_data: NoGiftsCallback, state: FSMContext):
+    await ask_profile(callback_query.message, state, NoGiftState.wait_text, "запреты", "nogifts", callback_data.room_id)
     await callback_query.answer()
 
 # ---------------------------------------
 # Просмотр участников с возможностью удаления
 # ---------------------------------------
+PARTICIPANTS_PAGE_SIZE = 20
+# Запас до лимита Telegram в 4096 символов на сообщение
+PARTICIPANTS_PAGE_CHARS = 3800
+PROFILE_FIELD_CHARS = 300
+# Имя, введённое вручную (UsernameState), длиной не ограничено
+PARTICIPANT_NAME_CHARS = 64
+
+def shorten(text, limit=PROFILE_FIELD_CHARS):
+    if not text:
+        return "—"
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+async def participants_page(db, room_id, after_id=0, before_id=None):
+    # Keyset-пагинация по participants.id: читается одна страница, а не вся комната.
+    # Номер в списке — позиция участника в комнате (смещение страницы + индекс);
+    # третьим значением возвращается страница [первый номер, [participants.id]],
+    # по ней delete_participant переводит введённый номер в стабильный id.
+    rows = await repository.members_page(db, room_id, after_id, before_id, PARTICIPANTS_PAGE_SIZE)
+    if not rows:
+        return None, None, None
+
+    total = await repository.count_members(db, room_id)
+    start = await repository.count_members(db, room_id, before_id=rows[0][0])
+    text = f"Список участников (всего {total}):\n"
+    shown = []
+    for number, (pid, uname, wishes, nogifts, left) in enumerate(rows, start + 1):
+        line = (f"№{number}. {shorten(uname, PARTICIPANT_NAME_CHARS)}{' (вышел)' if left else ''}, "
+                f"Пожелания: {shorten(wishes)}, Не дарить: {shorten(nogifts)}\n")
+        if shown and len(text) + len(line) > PARTICIPANTS_PAGE_CHARS:
+            break
+        text += line
+        shown.append(pid)
+
+    has_prev = start > 0
+    has_next = await repository.has_members_after(db, room_id, shown[-1])
+
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=ParticipantsBackCallback(room_id=room_id, before_id=shown[0]).pack()))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=ParticipantsCallback(room_id=room_id, after_id=shown[-1]).pack()))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton(text="Удалить участника", callback_data=DeleteCallback(room_id=room_id).pack())])
+    return text, InlineKeyboardMarkup(inline_keyboard=rows), [start + 1, shown]
+
 @dp.message(Command("participants"))
 async def cmd_participants(message: types.Message, state: FSMContext):
     parts = message.text.split()
@@ -382,37 +493,41 @@ async def cmd_participants(message: types.Message, state: FSMContext):
         return await message.answer("Использование: /participants ID_комнаты")
 
     room_id = parts[1]
-    async with aiosqlite.connect(DB_FILE) as db:
-        cur = await db.execute("SELECT admin_id FROM rooms WHERE id=?", (room_id,))
-        row = await cur.fetchone()
-        if not row:
+    async with repository.session() as db:
+        room = await repository.get_room(db, room_id)
+        if not room:
             return await message.answer("❌ Комната не найдена")
-        if row[0] != message.from_user.id:
+        if room.admin_id != message.from_user.id:
             return await message.answer("⛔ Только админ может просматривать участников")
-
-        # Исправлено: добавлено user_id в SELECT для корректного отображения
-        cur = await db.execute("SELECT user_id, username, wishes, no_gifts FROM participants WHERE room_id=?", (room_id,))
-        rows = await cur.fetchall()
-        if not rows:
-            return await message.answer("В комнате нет участников")
-
-        text = "Список участников:\n"
-        # Исправлено: использование user_id вместо id из participants
-        for idx, r in enumerate(rows, 1):
-            user_id, uname, wishes, nogifts = r
-            text += f"{idx}. {uname}, Пожелания: {wishes or '—'}, Не дарить: {nogifts or '—'}\n"
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Удалить участника", callback_data=f"delete_{room_id}")]])
-        await message.answer(text, reply_markup=keyboard)
+        text, keyboard, page = await participants_page(db, room.id)
+    if not text:
+        return await message.answer("В комнате нет участников")
+    await state.update_data(participants_room=room.id, participants_page=page)
+    await message.answer(text, reply_markup=keyboard)
+
+@callbacks.route(ParticipantsCallback)
+@callbacks.route(ParticipantsBackCallback)
+async def callback_participants_page(callback: types.CallbackQuery, callback_data, state: FSMContext):
+    async with repository.session() as db:
+        room = await repository.get_room(db, callback_data.room_id)
+        if not room or room.admin_id != callback.from_user.id:
+            return await callback.answer("⛔ Только админ может просматривать участников")
+        if isinstance(callback_data, ParticipantsCallback):
+            text, keyboard, page = await participants_page(db, room.id, after_id=callback_data.after_id)
+        else:
+            text, keyboard, page = await participants_page(db, room.id, before_id=callback_data.before_id)
+    if text:
+        await state.update_data(participants_room=room.id, participants_page=page)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
 
 # ---------------------------------------
 # Удаление участника админом
 # ---------------------------------------
-@dp.callback_query(lambda c: c.data.startswith("delete_"))
-async def callback_delete_participant(callback: types.CallbackQuery, state: FSMContext):
-    room_id = callback.data.split("_")[1]
-    await state.update_data(room_id=room_id)
-    await callback.message.answer("Введите номер участника, которого хотите удалить:")
+@callbacks.route(DeleteCallback)
+async def callback_delete_participant(callback: types.CallbackQuery, callback_data: DeleteCallback, state: FSMContext):
+    await state.update_data(room_id=callback_data.room_id)
+    await callback.message.answer("Введите номер участника (№ из списка), которого хотите удалить:")
     await state.set_state(DeleteParticipantState.wait_text)
     await callback.answer()
 
@@ -420,56 +535,122 @@ async def callback_delete_participant(callback: types.CallbackQuery, state: FSMC
 async def delete_participant(message: types.Message, state: FSMContext):
     data = await state.get_data()
     room_id = data["room_id"]
-    num = message.text.strip()
+    num = message.text.strip().lstrip("№")
     if not num.isdigit():
         return await message.answer("❌ Введите корректный номер участника.")
-    idx = int(num)
-
-    async with aiosqlite.connect(DB_FILE) as db:
-        # Исправлено: добавлено user_id в SELECT для корректного отображения
-        cur = await db.execute("SELECT user_id, username FROM participants WHERE room_id=?", (room_id,))
-        participants = await cur.fetchall()
-        if idx < 1 or idx > len(participants):
-            return await message.answer("❌ Нет участника с таким номером.")
-
-        # Исправлено: использование user_id вместо id из participants
-        user_id, uname = participants[idx-1]
-
-        cur = await db.execute("SELECT banned FROM rooms WHERE id=?", (room_id,))
-        banned_row = await cur.fetchone()
-        banned = banned_row[0] if banned_row else ""
-        banned_list = banned.split(",") if banned else []
-        banned_list.append(str(user_id))
-
-        await db.execute("UPDATE rooms SET banned=? WHERE id=?", (",".join(banned_list), room_id))
-        await db.execute("DELETE FROM participants WHERE room_id=? AND user_id=?", (room_id, user_id))
+
+    async with repository.session() as db:
+        room = await repository.get_room(db, room_id)
+        if not room or room.admin_id != message.from_user.id:
+            await state.clear()
+            return await message.answer("⛔ Только админ может удалять участников")
+
+        # Номер переводится в стабильный participants.id по последней показанной
+        # странице списка: сдвиг списка после показа не заденет другого участника
+        first, ids = data.get("participants_page") or (0, [])
+        if data.get("participants_room") != room.id or not first <= int(num) < first + len(ids):
+            return await message.answer("❌ Нет участника с таким номером на открытой странице списка.")
+        row = await repository.member_by_id(db, room_id, ids[int(num) - first])
+        if not row:
+            return await message.answer("❌ Участник уже удалён из комнаты.")
+        user_id, uname = row
+
+        if room.status == "drawn":
+            changes = await repository.repair_leave(db, room.id, user_id)
+            await notify_draw_changes(db, room, changes)
+        await repository.ban(db, room_id, user_id, uname)
         await db.commit()
+    outbox.wake()
     await state.clear()
     await message.answer(f"✔ Участник {uname} заблокирован и удалён из комнаты.")
 
 # ---------------------------------------
 # Просмотр своих комнат /myrooms
 # ---------------------------------------
+MYROOMS_PAGE_SIZE = 20
+ROOM_STATUS = {"drawn": "жеребьёвка проведена", "open": "идёт набор"}
+
+async def myrooms_page(db, user_id, after_id=0, before_id=None):
+    # Страницы по room_id, как в /participants; лишняя строка показывает, есть ли следующая
+    rows = await repository.rooms_of(db, user_id, after_id, before_id, MYROOMS_PAGE_SIZE + 1)
+    if before_id is None:
+        has_prev, has_next = after_id > 0, len(rows) > MYROOMS_PAGE_SIZE
+        rows = rows[:MYROOMS_PAGE_SIZE]
+    else:
+        has_prev, has_next = len(rows) > MYROOMS_PAGE_SIZE, True
+        rows = rows[:MYROOMS_PAGE_SIZE][::-1]
+    if not rows:
+        return None, None
+
+    text = "Ваши комнаты:\n"
+    for rid, role, title, status in rows:
+        text += (f"- {shorten(title or 'Без названия', 100)}, ID: {rid}{' 👑 админ' if role == 'admin' else ''} — "
+                 f"{ROOM_STATUS.get(status, status)}\n")
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton(text="◀️ Назад", callback_data=MyRoomsBackCallback(before_id=rows[0][0]).pack()))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=MyRoomsCallback(after_id=rows[-1][0]).pack()))
+    return text, InlineKeyboardMarkup(inline_keyboard=[nav]) if nav else None
+
 @dp.message(Command("myrooms"))
 async def cmd_myrooms(message: types.Message):
-    async with aiosqlite.connect(DB_FILE) as db:
-        # Исправлено: Добавлен поиск комнат, где пользователь является админом
-        cur = await db.execute("""
-        SELECT id, title FROM rooms
-        WHERE admin_id=?
-        UNION
-        SELECT r.id, r.title FROM rooms r
-        JOIN participants p ON r.id=p.room_id
-        WHERE p.user_id=? AND p.left=0
-        """, (message.from_user.id, message.from_user.id))
-        rows = await cur.fetchall()
+    async with repository.session() as db:
+        text, keyboard = await myrooms_page(db, message.from_user.id)
+    if not text:
+        return await message.answer("Вы пока не состоите ни в одной комнате.")
+    await message.answer(text, reply_markup=keyboard)
+
+@callbacks.route(MyRoomsCallback)
+@callbacks.route(MyRoomsBackCallback)
+async def callback_myrooms_page(callback: types.CallbackQuery, callback_data):
+    async with repository.session() as db:
+        if isinstance(callback_data, MyRoomsCallback):
+            text, keyboard = await myrooms_page(db, callback.from_user.id, after_id=callback_data.after_id)
+        else:
+            text, keyboard = await myrooms_page(db, callback.from_user.id, before_id=callback_data.before_id)
+    if text:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+# ---------------------------------------
+# Архив завершённых комнат /archive
+# ---------------------------------------
+ARCHIVE_STATUS = {"drawn": "жеребьёвка проведена"}
+
+@dp.message(Command("archive"))
+async def cmd_archive(message: types.Message):
+    parts = message.text.split()
+    if len(parts) < 2:
+        rows = await archive.rooms_of(message.from_user.id)
         if not rows:
-            return await message.answer("Вы пока не состоите ни в одной комнате.")
-        text = "Ваши комнаты:\n"
-        for r in rows:
-            rid, title = r
-            text += f"- {title or 'Без названия'}, ID: {rid}\n"
-        await message.answer(text)
+            return await message.answer("В архиве нет ваших комнат.")
+        text = "🗄 Ваши комнаты в архиве:\n"
+        for rid, title, status, count, archived_at in rows:
+            text += (f"- {title or 'Без названия'}, ID: {rid} — {ARCHIVE_STATUS.get(status, 'без жеребьёвки')}, "
+                     f"участников: {count}, в архиве с {format_when(archived_at)}\n")
+        return await message.answer(text + "\nПодробнее: /archive ID")
+
+    if not parts[1].isdigit():
+        return await message.answer("Использование: /archive ID_комнаты")
+    data = await archive.load(int(parts[1]))
+    if data is None or data["room"]["admin_id"] != message.from_user.id:
+        return await message.answer("❌ Комната не найдена в архиве")
+    room = data["room"]
+    active = [p for p in data["participants"] if not p[5]]
+    text = (f"🗄 «{room['title'] or 'Без названия'}», ID: {room['id']}\n"
+            f"{ARCHIVE_STATUS.get(room['status'], 'без жеребьёвки')}, в архиве с {format_when(data['archived_at'])}\n"
+            f"Участников: {len(active)}, запретов: {len(data['exclusions'])}, заблокировано: {len(data['bans'])}\n")
+    if room["description"]:
+        text += f"\n📄 {shorten(room['description'])}\n"
+    text += "\nУчастники:\n"
+    for index, (user_id, username, *_) in enumerate(active):
+        line = f"- {username or user_id}\n"
+        if len(text) + len(line) > PARTICIPANTS_PAGE_CHARS:
+            text += f"… и ещё {len(active) - index}\n"
+            break
+        text += line
+    await message.answer(text)
 
 # ---------------------------------------
 # Присоединение через команду /join
@@ -491,92 +672,461 @@ async def cmd_leave(message: types.Message):
     if len(parts) < 2:
         return await message.answer("Использование: /leave ID_комнаты")
     room_id = parts[1]
-    async with aiosqlite.connect(DB_FILE) as db:
-        cur = await db.execute("SELECT 1 FROM participants WHERE room_id=? AND user_id=?", (room_id, message.from_user.id))
-        if not await cur.fetchone():
-            return await message.answer("❌ Вы не состоите в этой комнате")
-        await db.execute("UPDATE participants SET left=1 WHERE room_id=? AND user_id=?", (room_id, message.from_user.id))
-        await db.commit()
+    async with repository.session() as db:
+        room = await repository.get_room(db, room_id)
+    # False — пользователя нет в комнате, отдельный SELECT не нужен
+    updated = await change_membership(room, room_id, message.from_user.id, "leave")
+    if not updated:
+        return await message.answer("❌ Вы не состоите в этой комнате")
     await message.answer(f"✔ Вы вышли из комнаты #{room_id}. Для возвращения используйте ссылку снова.")
 
 # ---------------------------------------
-# FSM /wishes
+# FSM /wishes и /nogifts
 # ---------------------------------------
+# Пожелания и запреты хранятся отдельно для каждой комнаты (participants) и один
+# раз на пользователя (profiles). Профиль подставляется во все комнаты, где своё
+# значение не указано: при чтении COALESCE(participants.x, profiles.x), поэтому
+# правка профиля — одна строка, сколько бы комнат ни было.
+async def ask_profile(answer_obj, state: FSMContext, new_state, what, command, room_id=None):
+    await state.update_data(profile_room=room_id)
+    await state.set_state(new_state)
+    if room_id:
+        await answer_obj.answer(
+            f"Напиши свои {what} для комнаты #{room_id} (одним сообщением).\n"
+            f"Отправь «-», чтобы использовать общие {what} из /{command}."
+        )
+    else:
+        await answer_obj.answer(
+            f"Напиши свои {what} (одним сообщением). Они будут видны во всех комнатах, "
+            f"где вы не указали отдельные {what}."
+        )
+
+async def save_profile(message: types.Message, state: FSMContext, column, what):
+    text = message.text.strip()
+    room_id = (await state.get_data()).get("profile_room")
+    await state.clear()
+    if room_id:
+        value = None if text == "-" else text
+        updated = await repository.write("set_member_profile", room_id, message.from_user.id, column, value)
+        if not updated:
+            return await message.answer("❌ Вы не состоите в этой комнате")
+        if value is None:
+            return await message.answer(f"✔ В комнате #{room_id} теперь используются общие {what}.")
+        return await message.answer(f"✔ {what.capitalize()} для комнаты #{room_id} сохранены!")
+    await repository.write("set_profile", message.from_user.id, column, text)
+    await message.answer(f"✔ {what.capitalize()} сохранены!")
+
+def profile_room_arg(message: types.Message):
+    # /wishes 1234 — для одной комнаты, /wishes — общие
+    parts = message.text.split()
+    return int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+
 @dp.message(Command("wishes"))
 async def ask_wishes(message: types.Message, state: FSMContext):
-    await message.answer("Напиши свои пожелания (одним сообщением):")
-    await state.set_state(WishState.wait_text)
+    await ask_profile(message, state, WishState.wait_text, "пожелания", "wishes", profile_room_arg(message))
 
 @dp.message(WishState.wait_text)
 async def save_wishes(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-    async with aiosqlite.connect(DB_FILE) as db:
-        # Исправлено: добавлено условие room_id в UPDATE, чтобы избежать обновления всех записей пользователя
-        # Однако, для простоты, оставим как в V1, т.к. в V1 нет возможности выбрать комнату.
-        # Если пользователь в нескольких комнатах, это обновит пожелания для всех.
-        # Для корректной работы нужно запрашивать room_id или сохранять его в FSM.
-        # В V1 и V2 (в этой части) логика одинакова, поэтому оставляем как есть, но отмечаем как потенциальное улучшение.
-        await db.execute("UPDATE participants SET wishes=? WHERE user_id=?", (text, message.from_user.id))
-        await db.commit()
-    await state.clear()
-    await message.answer("✔ Пожелания сохранены!")
+    await save_profile(message, state, "wishes", "пожелания")
 
-# ---------------------------------------
-# FSM /nogifts
-# ---------------------------------------
 @dp.message(Command("nogifts"))
 async def ask_nogifts(message: types.Message, state: FSMContext):
-    await message.answer("Напиши свои запреты (одним сообщением):")
-    await state.set_state(NoGiftState.wait_text)
+    await ask_profile(message, state, NoGiftState.wait_text, "запреты", "nogifts", profile_room_arg(message))
 
 @dp.message(NoGiftState.wait_text)
 async def save_nogifts(message: types.Message, state: FSMContext):
-    text = message.text.strip()
-    async with aiosqlite.connect(DB_FILE) as db:
-        # См. комментарий выше
-        await db.execute("UPDATE participants SET no_gifts=? WHERE user_id=?", (text, message.from_user.id))
-        await db.commit()
-    await state.clear()
-    await message.answer("✔ Запреты сохранены!")
+    await save_profile(message, state, "no_gifts", "запреты")
 
 # ---------------------------------------
 # Жеребьёвка /draw
 # ---------------------------------------
+def target_message(uname, wishes, nogifts):
+    return f"🎁 Твой получатель: @{uname}\n\n✨ Пожелания: {wishes or '—'}\n🚫 Не дарить: {nogifts or '—'}"
+
+async def load_draw_profiles(db, room_id):
+    return await repository.draw_profiles(db, room_id)
+
+async def save_draw(db, room_id, pairs, profiles):
+    # Пары и статус пишутся в текущей транзакции, сообщения собираются из памяти.
+    # Дальнейшие входы и выходы чинят пары точечно, см. change_membership
+    await repository.save_pairs(db, room_id, pairs)
+    messages = [(giver, target_message(*profiles[receiver])) for giver, receiver in pairs.items()]
+    await repository.enqueue(db, messages)
+
+def draw_cancel_button(room_id):
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="⏹ Отменить жеребьёвку", callback_data=DrawCancelCallback(room_id=room_id).pack())]]
+    )
+
 @dp.message(Command("draw"))
 async def cmd_draw(message: types.Message):
     parts = message.text.split()
     if len(parts) < 2:
         return await message.answer("Использование: /draw ID_комнаты")
     room_id = parts[1]
-    async with aiosqlite.connect(DB_FILE) as db:
-        cur = await db.execute("SELECT admin_id FROM rooms WHERE id=?", (room_id,))
-        row = await cur.fetchone()
-        if not row:
+    if draw_worker.is_running(room_id):
+        return await message.answer("⏳ Жеребьёвка в этой комнате уже идёт")
+    async with repository.session() as db:
+        room = await repository.get_room(db, room_id)
+        if not room:
             return await message.answer("❌ Комната не найдена")
-        if row[0] != message.from_user.id:
+        if room.admin_id != message.from_user.id:
             return await message.answer("⛔ Только админ может провести жеребьёвку")
-        cur = await db.execute("SELECT user_id FROM participants WHERE room_id=? AND left=0", (room_id,))
-        users = [u[0] for u in await cur.fetchall()]
-        if len(users) < 2:
+        profiles = await load_draw_profiles(db, room_id)
+        if len(profiles) < 2:
             return await message.answer("Недостаточно участников (минимум 2).")
-        shuffled = users[:]
-        random.shuffle(shuffled)
-        while any(a == b for a, b in zip(users, shuffled)):
-            random.shuffle(shuffled)
-        for giver, receiver in zip(users, shuffled):
-            # Исправлено: добавлено условие room_id в UPDATE, чтобы избежать обновления target_id в других комнатах
-            await db.execute("UPDATE participants SET target_id=? WHERE user_id=? AND room_id=?", (receiver, giver, room_id))
-            cur = await db.execute("SELECT username, wishes, no_gifts FROM participants WHERE user_id=? AND room_id=?", (receiver, room_id))
-            # Исправлено: добавлено условие room_id в SELECT
-            row = await cur.fetchone()
-            if row:
-                uname, wishes, nogifts = row
-                msg = f"🎁 Твой получатель: @{uname}\n\n✨ Пожелания: {wishes or '—'}\n🚫 Не дарить: {nogifts or '—'}"
-                await bot.send_message(giver, msg)
-            # else: # Обработка ошибки, если получатель не найден (хотя не должен)
-            #     pass
+        exclusions = await repository.exclusions(db, room_id)
+
+    # Большая жеребьёвка считается в отдельном процессе, соединение с базой на это
+    # время не занято, а админ видит сообщение о ходе с кнопкой отмены
+    progress_message = None
+    progress = None
+    if draw_worker.offloaded(profiles, exclusions):
+        progress_text = f"⏳ Идёт жеребьёвка: {len(profiles)} участников, {len(exclusions)} запретов"
+        progress_message = await message.answer(progress_text, reply_markup=draw_cancel_button(room_id))
+
+        async def progress(elapsed):
+            try:
+                await progress_message.edit_text(
+                    f"{progress_text}\nПрошло {elapsed:.0f} с", reply_markup=draw_cancel_button(room_id)
+                )
+            except TelegramAPIError:
+                pass
+
+    async def report(text):
+        if progress_message:
+            await progress_message.edit_text(text)
+        else:
+            await message.answer(text)
+
+    try:
+        pairs = await draw_worker.run(room_id, profiles, exclusions, progress)
+    except DrawInfeasible as e:
+        return await report(f"❌ {e} Проверьте /exclusions {room_id}")
+    except DrawCancelled:
+        return await report("⏹ Жеребьёвка отменена, результаты не сохранены.")
+    except DrawTimeout:
+        return await report(
+            f"⌛ Не удалось подобрать пары за {draw_worker.timeout:.0f} с. "
+            f"Попробуйте убрать часть запретов: /exclusions {room_id}"
+        )
+
+    async with repository.session() as db:
+        # Пары и сообщения сохраняются одной транзакцией, рассылкой занимается outbox,
+        # поэтому ошибка отправки или перезапуск бота не теряют результаты жеребьёвки.
+        # Запланированная жеребьёвка и напоминание о ней больше не нужны
+        await save_draw(db, room_id, pairs, profiles)
+        await repository.cancel_jobs(db, room.id, ["draw", "nudge"])
         await db.commit()
-    await message.answer("🎉 Жеребьёвка завершена! Участники получили свои роли.")
+    invalidate_room(room_id)
+    outbox.wake()
+    await report("🎉 Жеребьёвка завершена! Участники получили свои роли.")
+
+@callbacks.route(DrawCancelCallback)
+async def callback_draw_cancel(callback: types.CallbackQuery, callback_data: DrawCancelCallback):
+    room_id = callback_data.room_id
+    async with repository.session() as db:
+        room = await repository.get_room(db, room_id)
+    if not room or room.admin_id != callback.from_user.id:
+        return await callback.answer("⛔ Только админ может отменить жеребьёвку")
+    await draw_worker.cancel(room_id)
+    await callback.answer("Отменяем жеребьёвку…")
+
+# ---------------------------------------
+# Запреты для жеребьёвки: /exclude, /block, /unexclude, /excludepast, /exclusions
+# ---------------------------------------
+async def find_participant(db, room_id, ref):
+    # ref — @username или числовой user_id участника комнаты
+    ref = ref.lstrip("@")
+    return await repository.find_member(db, room_id, ref, int(ref) if ref.isdigit() else None)
+
+async def check_room_admin(db, room_id, message: types.Message):
+    room = await repository.get_room(db, room_id)
+    if not room:
+        await message.answer("❌ Комната не найдена")
+        return None
+    if room.admin_id != message.from_user.id:
+        await message.answer("⛔ Только админ может управлять запретами")
+        return None
+    return room
+
+async def change_exclusion(message: types.Message, usage, kind, both_ways, remove=False):
+    parts = message.text.split()
+    if len(parts) < 4:
+        return await message.answer(usage)
+    async with repository.session() as db:
+        room = await check_room_admin(db, parts[1], message)
+        if not room:
+            return
+        first = await find_participant(db, room.id, parts[2])
+        second = await find_participant(db, room.id, parts[3])
+        if first is None or second is None:
+            return await message.answer("❌ Участник не найден в комнате")
+        if first == second:
+            return await message.answer("❌ Укажите двух разных участников")
+        pairs = [(first, second)]
+        if both_ways:
+            pairs.append((second, first))
+        if remove:
+            await repository.remove_exclusions(db, room.id, pairs)
+        else:
+            await repository.add_exclusions(db, room.id, pairs, kind, replace=True)
+        await db.commit()
+    await message.answer("✔ Запрет снят." if remove else "✔ Запрет добавлен.")
+
+@dp.message(Command("exclude"))
+async def cmd_exclude(message: types.Message):
+    await change_exclusion(message, "Использование: /exclude ID_комнаты @user1 @user2", "couple", both_ways=True)
+
+@dp.message(Command("block"))
+async def cmd_block(message: types.Message):
+    await change_exclusion(message, "Использование: /block ID_комнаты @кто @кому", "admin", both_ways=False)
+
+@dp.message(Command("unexclude"))
+async def cmd_unexclude(message: types.Message):
+    await change_exclusion(message, "Использование: /unexclude ID_комнаты @user1 @user2", None, both_ways=True, remove=True)
+
+@dp.message(Command("excludepast"))
+async def cmd_excludepast(message: types.Message):
+    parts = message.text.split()
+    if len(parts) < 3:
+        return await message.answer("Использование: /excludepast ID_комнаты ID_прошлой_комнаты")
+    async with repository.session() as db:
+        room = await check_room_admin(db, parts[1], message)
+        if not room:
+            return
+        # Пары прошлой жеребьёвки секретны: переносить их может только админ той комнаты
+        past_room = await repository.get_room(db, parts[2])
+        past = None if past_room else await archive.load(room_key(parts[2]))
+        past_admin = past_room.admin_id if past_room else past["room"]["admin_id"] if past else None
+        if past_admin is None:
+            return await message.answer("❌ Прошлая комната не найдена")
+        if past_admin != message.from_user.id:
+            return await message.answer("⛔ Только админ может управлять запретами")
+        # Переносим пары прошлой жеребьёвки, в которых оба участника есть в текущей комнате;
+        # если прошлогодняя комната уже в архиве, пары берём оттуда
+        if past_room:
+            pairs = await repository.drawn_pairs(db, past_room.id)
+        else:
+            pairs = [(giver, target) for giver, _, _, _, target, _ in past["participants"] if target is not None]
+        added = await repository.add_exclusions(db, room.id, pairs, "history")
+        await db.commit()
+    await message.answer(f"✔ Добавлено запретов из прошлой жеребьёвки: {added}")
+
+@dp.message(Command("exclusions"))
+async def cmd_exclusions(message: types.Message):
+    parts = message.text.split()
+    if len(parts) < 2:
+        return await message.answer("Использование: /exclusions ID_комнаты")
+    async with repository.session() as db:
+        room = await check_room_admin(db, parts[1], message)
+        if not room:
+            return
+        rows = await repository.exclusion_list(db, room.id)
+    if not rows:
+        return await message.answer("Запретов нет")
+    kinds = {"couple": "пара", "history": "прошлый год", "admin": "админ"}
+    text = "Запреты (кто ⇢ кому):\n"
+    for giver, receiver, kind in rows:
+        text += f"- {giver or '—'} ⇢ {receiver or '—'} ({kinds.get(kind, kind)})\n"
+    await message.answer(text)
+
+# ---------------------------------------
+# Массовые операции админа: /import, /ban, /unban
+# ---------------------------------------
+IMPORT_HELP = (
+    "📥 Пришлите CSV-файл (или .txt) документом. Колонки: user_id, username, wishes, no_gifts, exclude — "
+    "первая строка с названиями колонок необязательна, разделитель запятая или точка с запятой. "
+    "В exclude через пробел — @username или user_id тех, кому участник не дарит.\n"
+    "Файл можно сразу прислать с подписью /import ID"
+)
+
+def command_text(message: types.Message):
+    # Команда может прийти подписью к документу
+    return message.text or message.caption or ""
+
+async def load_admin_room(message: types.Message, room_id, action):
+    async with repository.session() as db:
+        room = await repository.get_room(db, room_id)
+    if not room:
+        await message.answer("❌ Комната не найдена")
+        return None
+    if room.admin_id != message.from_user.id:
+        await message.answer(f"⛔ Только админ может {action}")
+        return None
+    return room
+
+async def download_document(message: types.Message):
+    # -> BytesIO с содержимым файла или None (ответ пользователю уже отправлен)
+    if message.document.file_size and message.document.file_size > bulk.IMPORT_MAX_BYTES:
+        await message.answer(f"❌ Файл больше {bulk.IMPORT_MAX_BYTES / 2 ** 20:.0f} МБ")
+        return None
+    return await bot.download(message.document)
+
+def errors_text(errors, lines):
+    if not errors:
+        return ""
+    shown = "\n".join(f"- {lines} {e.line}: {e.reason}" for e in errors[:bulk.IMPORT_MAX_ERRORS])
+    more = f"\n… и ещё {len(errors) - bulk.IMPORT_MAX_ERRORS}" if len(errors) > bulk.IMPORT_MAX_ERRORS else ""
+    return f"\n\nОшибки ({len(errors)}):\n{shown}{more}"
+
+async def import_chunk(db, room, rows, summary, exclusions):
+    ids = [row.user_id for row in rows]
+    banned = await repository.banned_among(db, room.id, ids)
+    present = await repository.members_left(db, room.id, ids)
+    rows = [row for row in rows if row.user_id not in banned]
+    summary["banned"] += len(ids) - len(rows)
+    # Пустые wishes/no_gifts в файле не затирают то, что участник уже ввёл сам
+    await repository.import_members(db, room.id, [(row.user_id, row.username, row.wishes, row.no_gifts) for row in rows])
+    joined = [row.user_id for row in rows if present.get(row.user_id, 1)]
+    summary["added"] += len(joined)
+    summary["updated"] += len(rows) - len(joined)
+    if room.status == "drawn":
+        for user_id in joined:
+            changes = await repository.repair_join(db, room.id, user_id)
+            await notify_draw_changes(db, room, changes, user_id)
+    text = (f"🎅 Админ добавил вас в комнату Тайного Санты «{room.title}» (ID: {room.id}).\n"
+            f"Укажите пожелания: /wishes {room.id}, запреты: /nogifts {room.id}")
+    await repository.enqueue(db, [(user_id, text) for user_id in joined])
+    exclusions.extend((row.user_id, ref) for row in rows for ref in row.exclude)
+
+async def import_exclusions(room, exclusions, summary, errors):
+    # Ссылки в exclude могут указывать на строки ниже по файлу, поэтому
+    # запреты пишутся после всех участников
+    if not exclusions:
+        return
+    async with repository.session() as db:
+        by_ref = {}
+        for user_id, username in await repository.active_members(db, room.id):
+            by_ref[str(user_id)] = user_id
+            if username:
+                by_ref.setdefault(username, user_id)
+    pairs = []
+    for giver, ref in exclusions:
+        receiver = by_ref.get(ref)
+        if receiver is None:
+            summary["unknown"] += 1
+            errors.append(bulk.RowError(giver, f"в exclude нет участника {ref}"))
+        elif receiver != giver:
+            pairs.append((giver, receiver))
+
+    async def apply(db, chunk, summary):
+        summary["exclusions"] += await repository.add_exclusions(db, room.id, chunk, "admin")
+
+    await bulk.apply_chunks(repository, pairs, apply, summary=summary)
+
+async def import_document(message: types.Message, room):
+    stream = await download_document(message)
+    if stream is None:
+        return
+    errors, exclusions = [], []
+
+    async def apply(db, chunk, summary):
+        await import_chunk(db, room, chunk, summary, exclusions)
+
+    summary = await bulk.apply_chunks(repository, bulk.read_rows(stream, errors), apply)
+    line_errors = list(errors)
+    errors.clear()
+    await import_exclusions(room, exclusions, summary, errors)
+    outbox.wake()
+    text = (f"✔ Импорт в комнату «{room.title}»: добавлено {summary['added']}, обновлено {summary['updated']}, "
+            f"пропущено заблокированных {summary['banned']}, запретов добавлено {summary['exclusions']}")
+    text += errors_text(line_errors, "строка") + errors_text(errors, "user_id")
+    await message.answer(text[:4096])
+
+@dp.message(Command("import"))
+async def cmd_import(message: types.Message, state: FSMContext):
+    parts = command_text(message).split()
+    if len(parts) < 2:
+        return await message.answer("Использование: /import ID_комнаты\n\n" + IMPORT_HELP)
+    room = await load_admin_room(message, parts[1], "импортировать участников")
+    if not room:
+        return
+    if message.document:
+        return await import_document(message, room)
+    await state.set_state(ImportState.wait_document)
+    await state.update_data(room_id=room.id)
+    await message.answer(IMPORT_HELP)
+
+# Только документы: команды, объявленные ниже по файлу, в этом состоянии продолжают работать
+@dp.message(ImportState.wait_document, F.document)
+async def receive_import(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    await state.clear()
+    room = await load_admin_room(message, data["room_id"], "импортировать участников")
+    if room:
+        await import_document(message, room)
+
+async def ban_chunk(db, room, refs, summary):
+    ids = [int(ref) for ref in refs if ref.isdigit()]
+    names = [ref for ref in refs if not ref.isdigit()]
+    members = await repository.members_by_refs(db, room.id, ids, names)
+    found = {str(user_id) for user_id in members} | set(members.values())
+    summary["not_found"] += sum(1 for name in names if name not in found)
+    # По числовому ID можно заблокировать и того, кто в комнату ещё не входил
+    targets = {user_id: members.get(user_id) for user_id in ids}
+    targets.update(members)
+    if room.admin_id in targets:
+        del targets[room.admin_id]
+        summary["admin"] += 1
+    if room.status == "drawn":
+        for user_id in members.keys() & targets.keys():
+            changes = await repository.repair_leave(db, room.id, user_id)
+            await notify_draw_changes(db, room, changes)
+    removed = await repository.ban_many(db, room.id, targets)
+    summary["banned"] += len(targets)
+    summary["removed"] += removed
+
+async def unban_chunk(db, room, refs, summary):
+    unbanned = await repository.unban(db, room.id, refs)
+    summary["unbanned"] += unbanned
+    summary["not_found"] += max(0, len(refs) - unbanned)
+
+async def change_bans(message: types.Message, usage, apply):
+    # Список пользователей — в тексте команды и/или в присланном файле, пишется
+    # тем же путём bulk.apply_chunks, что и /import
+    parts = command_text(message).split()
+    if len(parts) < 2 or (len(parts) < 3 and not message.document):
+        await message.answer(usage)
+        return None
+    room = await load_admin_room(message, parts[1], "блокировать участников")
+    if not room:
+        return None
+    refs = bulk.parse_refs(" ".join(parts[2:]))
+    if message.document:
+        stream = await download_document(message)
+        if stream is None:
+            return None
+        refs = itertools.chain(refs, bulk.read_refs(stream))
+
+    async def apply_chunk(db, chunk, summary):
+        await apply(db, room, chunk, summary)
+
+    summary = await bulk.apply_chunks(repository, refs, apply_chunk)
+    outbox.wake()
+    return summary, room
+
+@dp.message(Command("ban"))
+async def cmd_ban(message: types.Message):
+    result = await change_bans(message, "Использование: /ban ID_комнаты @user1 @user2 … (или файл со списком)", ban_chunk)
+    if result:
+        summary, room = result
+        text = f"✔ Заблокировано {summary['banned']}, из них удалено из комнаты «{room.title}» {summary['removed']}"
+        if summary["not_found"]:
+            text += f"\nНе найдено в комнате: {summary['not_found']} (по @username блокируются только участники)"
+        if summary["admin"]:
+            text += "\nАдмина комнаты заблокировать нельзя"
+        await message.answer(text)
+
+@dp.message(Command("unban"))
+async def cmd_unban(message: types.Message):
+    result = await change_bans(message, "Использование: /unban ID_комнаты @user1 @user2 … (или файл со списком)", unban_chunk)
+    if result:
+        summary, room = result
+        text = f"✔ Разблокировано в комнате «{room.title}»: {summary['unbanned']}"
+        if summary["not_found"]:
+            text += f"\nНе найдено среди заблокированных: {summary['not_found']}"
+        await message.answer(text)
 
 # ---------------------------------------
 # Проверка пароля при join
@@ -614,13 +1164,316 @@ async def check_join_password(message: types.Message, state: FSMContext):
     # В обоих случаях state.clear() не нужен.
     pass
 
+# ---------------------------------------
+# Отложенные задачи: /schedule, /deadline, /jobs, /unschedule
+# ---------------------------------------
+JOB_TITLES = {
+    "draw": "🎲 Жеребьёвка",
+    "nudge": "✍️ Напоминание заполнить пожелания",
+    "reminder": "⏰ Напоминание об обмене подарками",
+}
+
+def parse_when(text):
+    # "ДД.ММ.ГГГГ ЧЧ:ММ" или "ДД.ММ.ГГГГ" (тогда 12:00) в часовом поясе TIMEZONE
+    for fmt, hour in (("%d.%m.%Y %H:%M", 0), ("%d.%m.%Y", 12)):
+        try:
+            return (datetime.strptime(text, fmt).replace(tzinfo=TIMEZONE) + timedelta(hours=hour)).timestamp()
+        except ValueError:
+            pass
+    return None
+
+def format_when(timestamp):
+    return datetime.fromtimestamp(timestamp, TIMEZONE).strftime("%d.%m.%Y %H:%M")
+
+async def parse_job_command(message: types.Message, usage):
+    # Общая часть /schedule и /deadline: комната админа и время в будущем
+    parts = message.text.split(maxsplit=2)
+    if len(parts) < 3:
+        await message.answer(usage)
+        return None, None
+    due_at = parse_when(parts[2].strip())
+    if due_at is None:
+        await message.answer(f"❌ Не удалось разобрать дату.\n{usage}")
+        return None, None
+    if due_at <= time.time():
+        await message.answer("❌ Это время уже прошло")
+        return None, None
+    async with repository.session() as db:
+        room = await repository.get_room(db, parts[1])
+    if not room:
+        await message.answer("❌ Комната не найдена")
+        return None, None
+    if room.admin_id != message.from_user.id:
+        await message.answer("⛔ Только админ может планировать события комнаты")
+        return None, None
+    return room, due_at
+
+@dp.message(Command("schedule"))
+async def cmd_schedule(message: types.Message):
+    room, draw_at = await parse_job_command(message, "Использование: /schedule ID_комнаты ДД.ММ.ГГГГ ЧЧ:ММ")
+    if not room:
+        return
+    async with repository.session() as db:
+        # Новое время заменяет ранее запланированную жеребьёвку
+        await repository.cancel_jobs(db, room.id, ["draw", "nudge"])
+        await repository.add_job(db, room.id, "draw", draw_at)
+        nudge_at = draw_at - NUDGE_BEFORE
+        if nudge_at > time.time():
+            await repository.add_job(db, room.id, "nudge", nudge_at, {"draw_at": draw_at})
+        await db.commit()
+    scheduler.wake()
+    await message.answer(
+        f"🗓 Жеребьёвка в комнате «{room.title}» пройдёт автоматически {format_when(draw_at)}.\n"
+        f"Участникам без пожеланий бот напомнит заранее. Отменить: /unschedule {room.id}"
+    )
+
+@dp.message(Command("deadline"))
+async def cmd_deadline(message: types.Message):
+    room, deadline = await parse_job_command(message, "Использование: /deadline ID_комнаты ДД.ММ.ГГГГ [ЧЧ:ММ]")
+    if not room:
+        return
+    reminders = [deadline - days * 86400 for days in REMINDER_DAYS if deadline - days * 86400 > time.time()]
+    async with repository.session() as db:
+        await repository.cancel_jobs(db, room.id, ["reminder"])
+        for remind_at in reminders:
+            await repository.add_job(db, room.id, "reminder", remind_at, {"deadline": deadline})
+        await db.commit()
+    scheduler.wake()
+    if not reminders:
+        return await message.answer("До обмена подарками меньше суток — напоминания не запланированы.")
+    await message.answer(
+        f"🎁 Обмен подарками в комнате «{room.title}»: {format_when(deadline)}.\n"
+        f"Напоминания участникам: {', '.join(format_when(t) for t in reminders)}"
+    )
+
+@dp.message(Command("jobs"))
+async def cmd_jobs(message: types.Message):
+    parts = message.text.split()
+    if len(parts) < 2:
+        return await message.answer("Использование: /jobs ID_комнаты")
+    async with repository.session() as db:
+        room = await repository.get_room(db, parts[1])
+        if not room or room.admin_id != message.from_user.id:
+            return await message.answer("⛔ Только админ может смотреть запланированные события")
+        jobs = await repository.pending_jobs(db, room.id)
+    if not jobs:
+        return await message.answer("Запланированных событий нет")
+    lines = [f"{format_when(job.due_at)} — {JOB_TITLES.get(job.kind, job.kind)}" for job in jobs]
+    await message.answer(f"Запланировано в комнате «{room.title}»:\n" + "\n".join(lines))
+
+@dp.message(Command("unschedule"))
+async def cmd_unschedule(message: types.Message):
+    parts = message.text.split()
+    if len(parts) < 2:
+        return await message.answer("Использование: /unschedule ID_комнаты")
+    async with repository.session() as db:
+        room = await repository.get_room(db, parts[1])
+        if not room or room.admin_id != message.from_user.id:
+            return await message.answer("⛔ Только админ может отменять запланированные события")
+        removed = await repository.cancel_jobs(db, room.id)
+        await db.commit()
+    await message.answer(f"✔ Отменено событий: {removed}")
+
+@scheduler.handler("draw")
+async def job_draw(job):
+    # Расчёт идёт до claim: если процесс упадёт посреди жеребьёвки, задача
+    # останется в таблице и выполнится заново после перезапуска
+    async with repository.session() as db:
+        room = await repository.get_room(db, job.room_id)
+        profiles = await load_draw_profiles(db, job.room_id)
+        exclusions = await repository.exclusions(db, job.room_id)
+    pairs, error = None, None
+    if room and room.status == "drawn":
+        # Админ уже провёл жеребьёвку через /draw: задачу просто снимаем
+        room = None
+    elif room and len(profiles) < 2:
+        error = "Недостаточно участников (минимум 2)."
+    elif room:
+        try:
+            pairs = await draw_worker.run(job.room_id, profiles, exclusions)
+        except DrawInfeasible as e:
+            error = f"{e} Проверьте /exclusions {job.room_id}"
+        except DrawCancelled:
+            error = "жеребьёвка отменена."
+        except DrawTimeout:
+            error = f"не удалось подобрать пары за {draw_worker.timeout:.0f} с. Проверьте /exclusions {job.room_id}"
+
+    async with scheduler.claim(job) as db:
+        if not room:
+            return
+        # Пока шёл расчёт, жеребьёвку могли провести вручную (в том числе в другом воркере)
+        if (await repository.room_status(db, room.id) or "drawn") == "drawn":
+            return
+        if pairs:
+            await save_draw(db, room.id, pairs, profiles)
+            text = f"🎉 Запланированная жеребьёвка в комнате «{room.title}» проведена! Участники получили свои роли."
+        else:
+            text = f"❌ Запланированная жеребьёвка в комнате «{room.title}» не состоялась: {error}"
+        await repository.enqueue(db, [(room.admin_id, text)])
+    invalidate_room(job.room_id)
+    outbox.wake()
+
+@scheduler.handler("nudge")
+async def job_nudge(job):
+    async with scheduler.claim(job) as db:
+        room = await repository.get_room(db, job.room_id)
+        if not room:
+            return
+        text = (f"✍️ {format_when(job.payload['draw_at'])} в комнате «{room.title}» пройдёт жеребьёвка, "
+                f"а вы ещё не указали пожелания. Это можно сделать командой /wishes {room.id}")
+        users = await repository.members_without_wishes(db, job.room_id)
+        await repository.enqueue(db, [(user_id, text) for user_id in users])
+    outbox.wake()
+
+@scheduler.handler("reminder")
+async def job_reminder(job):
+    async with scheduler.claim(job) as db:
+        room = await repository.get_room(db, job.room_id)
+        if not room:
+            return
+        text = f"⏰ Обмен подарками в комнате «{room.title}» — {format_when(job.payload['deadline'])}."
+        messages = []
+        for user_id, target in await repository.member_targets(db, job.room_id):
+            messages.append((user_id, f"{text}\nНе забудьте подарок для @{target}!" if target else text))
+        await repository.enqueue(db, messages)
+    outbox.wake()
+
+# ---------------------------------------
+# Обслуживание базы для владельцев бота: /admin
+# ---------------------------------------
+ADMIN_USAGE = (
+    "/admin backup — сделать резервную копию сейчас\n"
+    "/admin backups — список копий\n"
+    "/admin verify [имя] — проверить копию (по умолчанию последнюю)\n"
+    "/admin restore имя — восстановить базу из копии"
+)
+
+def megabytes(size):
+    return f"{size / 2 ** 20:.1f} МБ"
+
+def backup_text(report):
+    return (f"💾 {report['name']}: {megabytes(report['db_bytes'])} → {megabytes(report['size'])} за {report['seconds']:.1f} с\n"
+            f"Шагов: {report['steps']}, блокировка чтения: до {report['max_step_seconds'] * 1000:.0f} мс за шаг, "
+            f"всего {report['locked_seconds']:.2f} с, перезапусков: {report['restarts']}")
+
+def verify_text(report):
+    if not report["ok"]:
+        return f"❌ {report['name']} повреждена:\n" + "\n".join(report["errors"])
+    return (f"✔ {report['name']} цела: версия схемы {report['version']}, "
+            f"комнат {report['rooms']}, участников {report['participants']}")
+
+def admin_status_text():
+    lines = []
+    if backups.last_report:
+        lines.append(f"Последняя копия: {format_when(backups.last_report['at'])}\n" + backup_text(backups.last_report))
+    if compactor.last_report:
+        report = compactor.last_report
+        lines.append(f"Последняя компактизация: {format_when(report['at'])}, освобождено "
+                     f"{megabytes(report['reclaimed_bytes'])} ({megabytes(report['size_before'])} → "
+                     f"{megabytes(report['size_after'])}), всего с запуска {megabytes(compactor.reclaimed_bytes)}")
+    lines.append(f"Комнат перенесено в архив с запуска: {archive.archived}")
+    return "\n\n".join(lines)
+
+@dp.message(Command("admin"))
+async def cmd_admin(message: types.Message):
+    if message.from_user.id not in OWNERS:
+        return await message.answer("⛔ Команда доступна только владельцам бота")
+    parts = message.text.split()
+    action = parts[1] if len(parts) > 1 else None
+    name = parts[2] if len(parts) > 2 else None
+    try:
+        if action == "backup":
+            await message.answer("⏳ Делаю резервную копию…")
+            text = backup_text(await backups.create())
+        elif action == "backups":
+            snapshots = backups.list()
+            text = "\n".join(f"- {n} ({megabytes(size)}, {format_when(at)})" for n, size, at in snapshots) or "Копий нет"
+        elif action == "verify":
+            text = verify_text(await backups.verify(name))
+        elif action == "restore" and name:
+            await message.answer("⏳ Восстанавливаю базу, текущее состояние сохраняю в копию prerestore…")
+            report = await backups.restore(name)
+            # В копии могла быть старая схема, а кэши помнят данные до восстановления
+            await repository.migrate()
+            room_cache.clear()
+            if isinstance(storage, SQLiteStorage):
+                storage.clear_cache()
+            scheduler.wake()
+            outbox.wake()
+            text = "✔ База восстановлена. " + verify_text(report)
+        else:
+            text = f"{admin_status_text()}\n\n{ADMIN_USAGE}"
+    except BackupError as e:
+        text = f"❌ {e}"
+    await message.answer(text)
+
 # ---------------------------------------
 # Запуск бота
 # ---------------------------------------
+@dp.startup()
+async def on_startup(bot: Bot, worker_index: int = 0, workers: int = 1):
+    if workers > 1:
+        # Апдейты одного пользователя могут прийти в разные процессы: FSM читаем
+        # только из базы, а кэш комнат держим коротким, чтобы смена пароля
+        # или описания в соседнем воркере была видна через секунды
+        if isinstance(storage, SQLiteStorage):
+            storage.cache_size = 0
+        room_cache.ttl = min(room_cache.ttl, ROOM_CACHE_SHARED_TTL)
+    # База и getMe параллельно: polling всё равно запрашивает getMe перед первым
+    # getUpdates, а после startup ответ берётся из кэша бота
+    await asyncio.gather(init_db(), *([bot.me()] if MODE == "polling" else []))
+    # Фоновые задачи нужны в одном экземпляре: outbox сам подхватывает
+    # сообщения, записанные другими воркерами, опрашивая таблицу
+    starting = []
+    if worker_index == 0:
+        starting.append(outbox.start(bot))
+        if isinstance(storage, SQLiteStorage):
+            storage.start_cleanup()
+        scheduler.start()
+        archive.start()
+        compactor.start()
+        backups.start()
+        if MODE == "webhook" and webhook.WEBHOOK_URL:
+            starting.append(bot.set_webhook(webhook.WEBHOOK_URL + webhook.WEBHOOK_PATH, secret_token=webhook.WEBHOOK_SECRET))
+    global metrics_server
+    if metrics.METRICS_PORT:
+        starting.append(metrics.start_server(metrics.METRICS_PORT + worker_index))
+    results = await asyncio.gather(*starting)
+    if metrics.METRICS_PORT:
+        metrics_server = results[-1]
+    lifecycle.ready()
+    print(f"🤖 Бот запущен ({MODE}, воркер {worker_index + 1}/{workers}) за {lifecycle.ready_seconds:.2f} с...")
+
+metrics_server = None
+
+@dp.shutdown()
+async def on_shutdown():
+    # Новые апдейты сюда уже не приходят: polling остановлен, webhook не принимает
+    # запросы. Не дольше SHUTDOWN_TIMEOUT ждём начатые обработчики (жеребьёвка
+    # дописывает пары и сообщения в outbox одной транзакцией) и рассылку, затем
+    # останавливаем фоновые задачи, дописываем batcher и делаем checkpoint WAL
+    lifecycle.begin_shutdown()
+    # Тяжёлая жеребьёвка в отдельном процессе может идти дольше SHUTDOWN_TIMEOUT:
+    # её отменяют за DRAW_STOP_GRACE до срока, и обработчик /draw успевает завершиться
+    handlers, _ = await asyncio.gather(
+        lifecycle.drain(), draw_worker.stop(lifecycle.remaining() - DRAW_STOP_GRACE)
+    )
+    await asyncio.gather(storage.close(), scheduler.stop(), compactor.stop(), backups.stop(), archive.close())
+    unsent = await outbox.drain(lifecycle.remaining())
+    await outbox.stop()
+    await batcher.close()
+    if metrics_server is not None:
+        await metrics_server.cleanup()
+    # Соединения, которые не вернули зависшие обработчики, закрываются по сроку
+    await pool.close(lifecycle.remaining())
+    lifecycle.stopped(handlers, unsent, pool.last_checkpoint)
+
 async def main():
-    await init_db()
-    print("🤖 Бот запущен...")
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    logging.basicConfig(level=logging.INFO)
+    if MODE == "webhook":
+        webhook.run(dp, bot)
+    else:
+        asyncio.run(main())
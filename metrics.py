@@ -0,0 +1,253 @@
+import logging
+import os
+import re
+import time
+from collections import defaultdict
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+# ---------------------------------------
+# Настройки метрик
+# ---------------------------------------
+# Порт для /metrics в формате Prometheus; если не задан, сервер не запускается.
+# В режиме webhook с несколькими воркерами каждый слушает METRICS_PORT + номер воркера.
+METRICS_HOST = os.getenv("SANTA_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("SANTA_METRICS_PORT", "0"))
+# Апдейты дольше порога пишутся в лог как медленные, 0 — выключено
+SLOW_UPDATE_MS = float(os.getenv("SANTA_SLOW_UPDATE_MS", "1000"))
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger("santa.metrics")
+
+
+# ---------------------------------------
+# Гистограммы и счётчики
+# ---------------------------------------
+class Histogram:
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self._sum = defaultdict(float)
+        self._count = defaultdict(int)
+
+    def observe(self, label_value, seconds):
+        buckets = self._buckets[label_value]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                buckets[i] += 1
+        self._sum[label_value] += seconds
+        self._count[label_value] += 1
+
+    def total(self):
+        return sum(self._sum.values()), sum(self._count.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, buckets in self._buckets.items():
+            label = f'{self.label}="{_escape(value)}"'
+            for bound, count in zip(BUCKETS, buckets):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {self._count[value]}')
+            lines.append(f"{self.name}_sum{{{label}}} {self._sum[value]}")
+            lines.append(f"{self.name}_count{{{label}}} {self._count[value]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, label=None, kind="counter"):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.kind = kind
+        self.values = defaultdict(float)
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for value, number in self.values.items():
+            label = f'{{{self.label}="{_escape(value)}"}}' if self.label else ""
+            lines.append(f"{self.name}{label} {number}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+handler_seconds = Histogram("santa_handler_seconds", "Время работы обработчика", "handler")
+handler_errors = Counter("santa_handler_errors_total", "Исключения в обработчиках", "handler")
+update_seconds = Histogram("santa_update_seconds", "Полное время обработки апдейта", "type")
+updates_in_flight = Counter("santa_updates_in_flight", "Апдейтов в обработке сейчас", kind="gauge")
+slow_updates = Counter("santa_slow_updates_total", "Апдейтов дольше SANTA_SLOW_UPDATE_MS")
+db_seconds = Histogram("santa_db_query_seconds", "Время SQL-запроса", "query")
+throttled_updates = Counter("santa_throttled_updates_total", "Апдейты, отклонённые throttle.ThrottleMiddleware", "reason")
+
+# Дополнительные значения, которые считываются в момент запроса /metrics
+collectors = []
+
+
+def cache_collector(name, cache):
+    # Попадания и промахи кэша (cache.TTLCache) под меткой cache=name
+    def collect():
+        return [
+            "# TYPE santa_cache_hits_total counter",
+            f'santa_cache_hits_total{{cache="{name}"}} {cache.hits}',
+            "# TYPE santa_cache_misses_total counter",
+            f'santa_cache_misses_total{{cache="{name}"}} {cache.misses}',
+            "# TYPE santa_cache_size gauge",
+            f'santa_cache_size{{cache="{name}"}} {len(cache)}',
+        ]
+    return collect
+
+
+def batcher_collector(batcher):
+    # Сколько транзакций сделал batcher.WriteBatcher и сколько записей в них вошло
+    def collect():
+        return [
+            "# TYPE santa_write_batches_total counter",
+            f"santa_write_batches_total {batcher.flushes}",
+            "# TYPE santa_write_batched_operations_total counter",
+            f"santa_write_batched_operations_total {batcher.operations}",
+        ]
+    return collect
+
+
+def archive_collector(archive, compactor):
+    # Перенос комнат в архив (archive.Archive) и освобождённое место в santa.db (archive.Compactor)
+    def collect():
+        return [
+            "# TYPE santa_archived_rooms_total counter",
+            f"santa_archived_rooms_total {archive.archived}",
+            "# TYPE santa_archived_bytes_total counter",
+            f"santa_archived_bytes_total {archive.archived_bytes}",
+            "# TYPE santa_db_reclaimed_bytes_total counter",
+            f"santa_db_reclaimed_bytes_total {compactor.reclaimed_bytes}",
+            "# TYPE santa_db_free_pages gauge",
+            f"santa_db_free_pages {compactor.free_pages}",
+        ]
+    return collect
+
+
+def backup_collector(backups):
+    # Последняя резервная копия (backup.Backups): длительность и время удержания блокировки чтения
+    def collect():
+        report = backups.last_report or {}
+        return [
+            "# TYPE santa_backups_total counter",
+            f"santa_backups_total {backups.count}",
+            "# TYPE santa_backup_seconds gauge",
+            f"santa_backup_seconds {report.get('seconds', 0)}",
+            "# TYPE santa_backup_locked_seconds gauge",
+            f"santa_backup_locked_seconds {report.get('locked_seconds', 0)}",
+            "# TYPE santa_backup_max_step_seconds gauge",
+            f"santa_backup_max_step_seconds {report.get('max_step_seconds', 0)}",
+            "# TYPE santa_backup_restarts gauge",
+            f"santa_backup_restarts {report.get('restarts', 0)}",
+            "# TYPE santa_backup_timestamp_seconds gauge",
+            f"santa_backup_timestamp_seconds {report.get('at', 0)}",
+        ]
+    return collect
+
+
+def lifecycle_collector(lifecycle):
+    # Время запуска и до первого апдейта (lifecycle.Lifecycle), 0 — ещё не было
+    def collect():
+        return [
+            "# TYPE santa_startup_seconds gauge",
+            f"santa_startup_seconds {lifecycle.ready_seconds or 0}",
+            "# TYPE santa_first_update_seconds gauge",
+            f"santa_first_update_seconds {lifecycle.first_update_seconds or 0}",
+        ]
+    return collect
+
+
+def render():
+    lines = []
+    for metric in (handler_seconds, handler_errors, update_seconds, updates_in_flight, slow_updates, db_seconds,
+                   throttled_updates):
+        lines += metric.render()
+    for collect in collectors:
+        lines += collect()
+    return "\n".join(lines) + "\n"
+
+
+# ---------------------------------------
+# Учёт SQL-запросов (подключается к database.pool.observer и batcher.observer)
+# ---------------------------------------
+_spaces = re.compile(r"\s+")
+
+
+def observe_query(sql, seconds):
+    db_seconds.observe(_spaces.sub(" ", sql).strip()[:100], seconds)
+
+
+# ---------------------------------------
+# Middleware
+# ---------------------------------------
+def describe(update):
+    # Короткое описание апдейта для лога медленных: команда или префикс кнопки
+    if update.message and update.message.text:
+        return f"message {update.message.text.split()[0][:32]}"
+    if update.callback_query and update.callback_query.data:
+        return f"callback {update.callback_query.data.split('_')[0][:32]}"
+    return update.event_type
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    # Внешний middleware на dp.update: апдейты в работе, полное время, медленные апдейты
+    async def __call__(self, handler, event, data):
+        updates_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - start
+            updates_in_flight.inc(amount=-1)
+            update_seconds.observe(event.event_type, elapsed)
+            if SLOW_UPDATE_MS and elapsed * 1000 > SLOW_UPDATE_MS:
+                slow_updates.inc()
+                logger.warning("Медленный апдейт %s (%s): %.0f мс", event.update_id, describe(event), elapsed * 1000)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware на message/callback_query: здесь уже известен обработчик.
+    # Для кнопок это обработчик, выбранный callbacks.CallbackRouter, а не общий диспетчер.
+    async def __call__(self, handler, event, data):
+        name = data.get("callback_handler", data["handler"]).callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_seconds.observe(name, time.perf_counter() - start)
+
+
+def setup(dp, pool, batcher):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    pool.observer = observe_query
+    batcher.observer = observe_query
+
+
+# ---------------------------------------
+# HTTP-сервер /metrics
+# ---------------------------------------
+async def start_server(port=METRICS_PORT, host=METRICS_HOST):
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
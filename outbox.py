@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from database import pool
+
+# ---------------------------------------
+# Настройки рассылки
+# ---------------------------------------
+OUTBOX_WORKERS = int(os.getenv("SANTA_OUTBOX_WORKERS", "8"))
+# Telegram пропускает около 30 сообщений в секунду на бота и 1 в секунду в один чат
+OUTBOX_RATE = float(os.getenv("SANTA_OUTBOX_RATE", "25"))
+OUTBOX_PER_CHAT_INTERVAL = float(os.getenv("SANTA_OUTBOX_PER_CHAT_INTERVAL", "1.0"))
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_BATCH = 200
+OUTBOX_POLL_INTERVAL = 5.0
+OUTBOX_MAX_BACKOFF = 300
+# При остановке: как часто проверять, всё ли отправлено, и сколько ждать
+# воркеры, которые уже отправляют сообщение
+OUTBOX_DRAIN_POLL = 0.05
+OUTBOX_STOP_GRACE = 5.0
+# Пауза после непредвиденной ошибки (например, "database is locked" во время VACUUM)
+OUTBOX_ERROR_PAUSE = 5.0
+
+logger = logging.getLogger("santa.outbox")
+
+
+# ---------------------------------------
+# Ограничитель скорости: общий и для каждого чата
+# ---------------------------------------
+class RateLimiter:
+    def __init__(self, rate=OUTBOX_RATE, per_chat_interval=OUTBOX_PER_CHAT_INTERVAL):
+        self.interval = 1 / rate
+        self.per_chat_interval = per_chat_interval
+        self._next_global = 0.0
+        self._next_chat = {}
+
+    async def wait(self, chat_id):
+        # Бронируем ближайший слот, свободный и глобально, и для этого чата,
+        # и спим до него. Слоты раздаются без await, поэтому гонок нет.
+        now = time.monotonic()
+        slot = max(now, self._next_global, self._next_chat.get(chat_id, 0.0))
+        self._next_global = slot + self.interval
+        self._next_chat[chat_id] = slot + self.per_chat_interval
+        if len(self._next_chat) > 10000:
+            self._next_chat = {c: t for c, t in self._next_chat.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        # 429 без указания чата — Telegram притормаживает весь бот
+        self._next_global = max(self._next_global, time.monotonic() + seconds)
+
+
+# ---------------------------------------
+# Постоянная очередь исходящих сообщений
+# ---------------------------------------
+# Сообщения сначала записываются в таблицу outbox в той же транзакции, что и
+# изменения, которые их породили, и только потом отправляются пулом воркеров.
+# Неотправленное после перезапуска дочитывается из таблицы.
+class Outbox:
+    def __init__(self, pool, workers=OUTBOX_WORKERS, limiter=None):
+        self.pool = pool
+        self.workers = workers
+        self.limiter = limiter or RateLimiter()
+        self._bot = None
+        self._tasks = []
+        self._queue = None
+        self._wakeup = asyncio.Event()
+        self._busy = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def enqueue(self, db, messages):
+        # messages — список (chat_id, text); commit делает вызывающий код
+        await db.executemany("INSERT INTO outbox (chat_id, text) VALUES (?, ?)", messages)
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def start(self, bot):
+        self._bot = bot
+        self._queue = asyncio.Queue(maxsize=self.workers * 4)
+        async with self.pool.acquire() as db:
+            # Сообщения, взятые в работу до остановки, отправляем заново
+            await db.execute("UPDATE outbox SET status='pending' WHERE status='sending'")
+            await db.commit()
+        self._tasks = [asyncio.create_task(self._feed())]
+        self._tasks += [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def drain(self, timeout):
+        # Ждём, пока уйдут сообщения, которые уже пора отправлять, в том числе
+        # поставленные только что завершившимися обработчиками. Отложенные повторы
+        # и всё, что не успело уйти, остаётся в таблице до следующего запуска.
+        # Возвращает, сколько таких сообщений осталось.
+        if not self._tasks:
+            return 0
+        deadline = time.monotonic() + timeout
+        while True:
+            self.wake()
+            async with self.pool.acquire() as db:
+                cur = await db.execute(
+                    "SELECT COUNT(*) FROM outbox WHERE status='sending' OR (status='pending' AND next_attempt_at<=?)",
+                    (time.time(),)
+                )
+                left = (await cur.fetchone())[0]
+            if not left or time.monotonic() >= deadline:
+                return left
+            await asyncio.sleep(OUTBOX_DRAIN_POLL)
+
+    async def stop(self, grace=OUTBOX_STOP_GRACE):
+        # Сначала перестаём выбирать сообщения и даём воркерам дослать начатые:
+        # отменённая отправка могла дойти до Telegram, а строка осталась бы в
+        # таблице и ушла повторно. Выбранные, но не начатые сообщения остаются
+        # в статусе 'sending' и возвращаются в 'pending' при следующем start()
+        if not self._tasks:
+            return
+        feed, workers = self._tasks[0], self._tasks[1:]
+        feed.cancel()
+        await asyncio.gather(feed, return_exceptions=True)
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        try:
+            await asyncio.wait_for(self._idle.wait(), grace)
+        except asyncio.TimeoutError:
+            pass
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._tasks = []
+
+    async def _feed(self):
+        while True:
+            try:
+                await self._feed_step()
+            except Exception:
+                logger.exception("Ошибка выборки сообщений outbox, повтор через %.0f с", OUTBOX_ERROR_PAUSE)
+                await asyncio.sleep(OUTBOX_ERROR_PAUSE)
+
+    async def _feed_step(self):
+        self._wakeup.clear()
+        now = time.time()
+        async with self.pool.acquire() as db:
+            cur = await db.execute(
+                "SELECT id, chat_id, text, attempts FROM outbox "
+                "WHERE status='pending' AND next_attempt_at<=? ORDER BY id LIMIT ?",
+                (now, OUTBOX_BATCH)
+            )
+            rows = await cur.fetchall()
+            if rows:
+                await db.executemany("UPDATE outbox SET status='sending' WHERE id=?", [(r[0],) for r in rows])
+                await db.commit()
+                timeout = 0
+            else:
+                cur = await db.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status='pending'")
+                next_due = (await cur.fetchone())[0]
+                timeout = OUTBOX_POLL_INTERVAL if next_due is None else min(OUTBOX_POLL_INTERVAL, next_due - now)
+        for row in rows:
+            await self._queue.put(row)
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self):
+        while True:
+            message_id, chat_id, text, attempts = await self._queue.get()
+            self._busy += 1
+            self._idle.clear()
+            try:
+                await self._send(message_id, chat_id, text, attempts)
+            except Exception:
+                # Строка осталась в статусе 'sending': возвращаем её в 'pending' с паузой,
+                # иначе она пролежит так до перезапуска
+                logger.exception("Ошибка отправки сообщения %s из outbox", message_id)
+                await self._write(
+                    "UPDATE outbox SET status='pending', next_attempt_at=? WHERE id=? AND status='sending'",
+                    (time.time() + OUTBOX_ERROR_PAUSE, message_id)
+                )
+                self.wake()
+            finally:
+                self._busy -= 1
+                if not self._busy:
+                    self._idle.set()
+
+    async def _send(self, message_id, chat_id, text, attempts):
+        await self.limiter.wait(chat_id)
+        try:
+            await self._bot.send_message(chat_id, text)
+        except TelegramRetryAfter as e:
+            self.limiter.pause(e.retry_after)
+            await self._retry(message_id, attempts, e.retry_after, e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            await self._retry(message_id, attempts, min(2 ** attempts, OUTBOX_MAX_BACKOFF), e)
+        except TelegramAPIError as e:
+            # Пользователь заблокировал бота, чат не найден и т.п. — повторять бесполезно
+            await self._finish(message_id, "failed", str(e))
+        except Exception as e:
+            # Непредвиденная ошибка до отправки или при ней — повторяем позже, как при сбое сети
+            logger.exception("Не удалось отправить сообщение %s из outbox", message_id)
+            await self._retry(message_id, attempts, min(2 ** attempts, OUTBOX_MAX_BACKOFF), e)
+        else:
+            await self._finish(message_id, "sent")
+
+    async def _retry(self, message_id, attempts, delay, error):
+        if attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+            return await self._finish(message_id, "failed", str(error))
+        await self._write(
+            "UPDATE outbox SET status='pending', attempts=attempts+1, next_attempt_at=?, error=? WHERE id=?",
+            (time.time() + delay, str(error), message_id)
+        )
+        self.wake()
+
+    async def _finish(self, message_id, status, error=None):
+        if status == "sent":
+            await self._write("DELETE FROM outbox WHERE id=?", (message_id,))
+        else:
+            await self._write("UPDATE outbox SET status=?, error=? WHERE id=?", (status, error, message_id))
+
+    async def _write(self, sql, parameters):
+        # Итог отправки записывается, пока не получится: если сообщение уже ушло,
+        # повторная отправка из-за сбоя записи дала бы дубль
+        while True:
+            try:
+                async with self.pool.acquire() as db:
+                    await db.execute(sql, parameters)
+                    await db.commit()
+                return
+            except Exception:
+                logger.exception("Не удалось записать итог отправки, повтор через %.0f с", OUTBOX_ERROR_PAUSE)
+                await asyncio.sleep(OUTBOX_ERROR_PAUSE)
+
+
+outbox = Outbox(pool)
@@ -0,0 +1,903 @@
+import itertools
+import random
+import secrets
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+import draw_repair
+import room_ids
+from batcher import batcher
+from cache import Room, get_room, room_key, warm_rooms
+from database import migrate, pool
+from outbox import outbox
+from scheduler import Job, scheduler
+
+# ---------------------------------------
+# Хранилище комнат, участников, банов и пар
+# ---------------------------------------
+# Repository — операции, из которых состоят обработчики main.py: создание и
+# настройка комнаты, вход и выход, список участников, пожелания, запреты, /import
+# и баны, /myrooms, жеребьёвка с починкой пар и отложенные задачи комнаты.
+# Методы принимают db из session(): для SQLite это соединение пула, и операции
+# складываются в транзакцию вызывающего кода (commit — db.commit()); для памяти —
+# заглушка, изменения видны сразу и не откатываются. write() — одиночная запись
+# вне транзакции: в SQLite она идёт через batcher вместе с записями других
+# обработчиков.
+#
+# SQLiteRepository — рабочая реализация поверх пула, MemoryRepository — словари
+# с индексами: main.use_repository(MemoryRepository(), MemoryStorage()) гоняет
+# обработчики без файла базы (benchmarks/bench_handlers.py), а
+# benchmarks/bench_storage.py сравнивает оба хранилища на одной нагрузке.
+# Вне Repository остаются только службы самой базы: запуск пула и batcher,
+# резервные копии, архив, рассылка outbox и выбор задач планировщиком
+# (scheduler.claim).
+
+Member = namedtuple("Member", "id user_id username wishes no_gifts target_id left")
+
+JOIN_SQL = "INSERT OR IGNORE INTO participants (room_id, user_id, username) VALUES (?, ?, ?)"
+REJOIN_SQL = "UPDATE participants SET left=0, username=COALESCE(?, username) WHERE room_id=? AND user_id=?"
+LEAVE_SQL = "UPDATE participants SET left=1 WHERE room_id=? AND user_id=? AND left=0"
+TOUCH_ROOM_SQL = "UPDATE rooms SET updated_at=? WHERE id=?"
+MEMBERS_PAGE_SQL = (
+    "SELECT p.id, p.username, COALESCE(p.wishes, pr.wishes), COALESCE(p.no_gifts, pr.no_gifts), p.left "
+    "FROM participants p LEFT JOIN profiles pr ON pr.user_id=p.user_id WHERE p.room_id=?"
+)
+# Поля профиля: /wishes и /nogifts
+PROFILE_COLUMNS = ("wishes", "no_gifts")
+
+
+class Repository(ABC):
+    @abstractmethod
+    def session(self):
+        # async with repository.session() as db: ...
+        pass
+
+    async def write(self, op, *args):
+        # Одиночная запись op ("join", "rejoin", "leave", "touch_room", "set_member_profile",
+        # "set_profile") вне транзакции
+        async with self.session() as db:
+            changed = await getattr(self, op)(db, *args)
+            await db.commit()
+        return changed
+
+    # Комнаты
+    @abstractmethod
+    async def create_room(self, db, admin_id, title):
+        pass
+
+    @abstractmethod
+    async def get_room(self, db, room_id):
+        pass
+
+    @abstractmethod
+    async def touch_room(self, db, room_id, at):
+        pass
+
+    @abstractmethod
+    async def update_room(self, db, room_id, column, value):
+        # column — "password" или "description"; сдвигает updated_at
+        pass
+
+    @abstractmethod
+    async def room_status(self, db, room_id):
+        # Статус комнаты в обход кэша get_room или None
+        pass
+
+    @abstractmethod
+    async def rooms_of(self, db, user_id, after_id=0, before_id=None, limit=20):
+        # -> [(room_id, role, title, status)]: после after_id по возрастанию room_id
+        # или, если задан before_id, перед ним по убыванию
+        pass
+
+    # Участники
+    @abstractmethod
+    async def member_left(self, db, room_id, user_id):
+        # -> None, если пользователя нет в комнате, иначе значение left
+        pass
+
+    @abstractmethod
+    async def member_by_id(self, db, room_id, participant_id):
+        # Участник по participants.id (страница /participants) -> (user_id, username) или None
+        pass
+
+    @abstractmethod
+    async def find_member(self, db, room_id, username, user_id=None):
+        # user_id участника по имени или по user_id, None — нет в комнате
+        pass
+
+    @abstractmethod
+    async def members_page(self, db, room_id, after_id=0, before_id=None, limit=20):
+        # -> [(participants.id, username, wishes, no_gifts, left)] по возрастанию id:
+        # limit строк после after_id или, если задан before_id, последние limit перед ним.
+        # Пустые пожелания и запреты заменены профилем
+        pass
+
+    @abstractmethod
+    async def count_members(self, db, room_id, before_id=None):
+        # Все участники комнаты, в том числе вышедшие, или только с id < before_id
+        pass
+
+    @abstractmethod
+    async def has_members_after(self, db, room_id, participant_id):
+        pass
+
+    @abstractmethod
+    async def active_members(self, db, room_id):
+        # -> [(user_id, username)] участников с left=0
+        pass
+
+    @abstractmethod
+    async def members_without_wishes(self, db, room_id):
+        # -> [user_id] активных участников без пожеланий ни в комнате, ни в профиле
+        pass
+
+    @abstractmethod
+    async def member_targets(self, db, room_id):
+        # -> [(user_id, username получателя или None)] активных участников
+        pass
+
+    @abstractmethod
+    async def join(self, db, room_id, user_id, username):
+        # Новый участник; -> False, если он уже есть в комнате
+        pass
+
+    @abstractmethod
+    async def rejoin(self, db, room_id, user_id, username=None):
+        # Возвращение вышедшего или смена имени, username — новое имя или None
+        pass
+
+    @abstractmethod
+    async def leave(self, db, room_id, user_id):
+        pass
+
+    @abstractmethod
+    async def draw_profiles(self, db, room_id, user_ids=None):
+        # -> {user_id: (username, wishes, no_gifts)} активных участников (или только
+        # user_ids) с профилем по умолчанию вместо пустых полей
+        pass
+
+    @abstractmethod
+    async def set_member_profile(self, db, room_id, user_id, column, value):
+        # Пожелания или запреты (PROFILE_COLUMNS) в одной комнате, None — брать из
+        # профиля; -> False, если пользователя нет в комнате
+        pass
+
+    @abstractmethod
+    async def set_profile(self, db, user_id, column, value):
+        # Общие пожелания или запреты пользователя для всех комнат
+        pass
+
+    # Массовые операции (/import, /ban, /unban), по куску bulk.IMPORT_CHUNK строк
+    @abstractmethod
+    async def members_left(self, db, room_id, user_ids):
+        # -> {user_id: left} тех из user_ids, кто есть в комнате
+        pass
+
+    @abstractmethod
+    async def members_by_refs(self, db, room_id, user_ids, usernames):
+        # -> {user_id: username} участников с такими user_id или именами
+        pass
+
+    @abstractmethod
+    async def import_members(self, db, room_id, rows):
+        # rows — [(user_id, username, wishes, no_gifts)]: новые участники добавляются,
+        # существующие возвращаются в комнату; пустые wishes/no_gifts не затирают
+        # то, что участник уже ввёл сам
+        pass
+
+    # Баны
+    @abstractmethod
+    async def is_banned(self, db, room_id, user_id):
+        pass
+
+    @abstractmethod
+    async def ban(self, db, room_id, user_id, username=None):
+        # Запоминает бан и удаляет участника из комнаты
+        pass
+
+    @abstractmethod
+    async def banned_among(self, db, room_id, user_ids):
+        # -> множество заблокированных из user_ids
+        pass
+
+    @abstractmethod
+    async def ban_many(self, db, room_id, targets):
+        # targets — {user_id: username или None}; -> сколько участников удалено из комнаты
+        pass
+
+    @abstractmethod
+    async def unban(self, db, room_id, refs):
+        # refs — строки с user_id или username; -> сколько банов снято
+        pass
+
+    # Пары
+    @abstractmethod
+    async def exclusions(self, db, room_id):
+        # -> [(даритель, получатель)]
+        pass
+
+    @abstractmethod
+    async def exclusion_list(self, db, room_id):
+        # -> [(имя дарителя, имя получателя, kind)] для /exclusions
+        pass
+
+    @abstractmethod
+    async def add_exclusions(self, db, room_id, pairs, kind, replace=False):
+        # Запреты [(даритель, получатель)], в которых оба есть в комнате; replace —
+        # заменить kind уже записанного запрета. -> сколько записано
+        pass
+
+    @abstractmethod
+    async def remove_exclusions(self, db, room_id, pairs):
+        pass
+
+    @abstractmethod
+    async def drawn_pairs(self, db, room_id):
+        # -> [(даритель, получатель)] проведённой жеребьёвки, для /excludepast
+        pass
+
+    @abstractmethod
+    async def save_pairs(self, db, room_id, pairs):
+        # Записывает {даритель: получатель} и отмечает комнату как 'drawn'
+        pass
+
+    @abstractmethod
+    async def repair_join(self, db, room_id, user_id):
+        # Починка пар после жеребьёвки, см. draw_repair: -> [(даритель, новый
+        # получатель)] или None, если нужна полная жеребьёвка
+        pass
+
+    @abstractmethod
+    async def repair_leave(self, db, room_id, user_id):
+        pass
+
+    # Сообщения
+    @abstractmethod
+    async def enqueue(self, db, messages):
+        # [(chat_id, text)] в outbox в текущей транзакции; после commit — outbox.wake()
+        pass
+
+    # Отложенные задачи комнаты (их выполняет scheduler.py)
+    @abstractmethod
+    async def add_job(self, db, room_id, kind, due_at, payload=None):
+        # Задача в текущей транзакции; после commit — scheduler.wake()
+        pass
+
+    @abstractmethod
+    async def cancel_jobs(self, db, room_id, kinds=None):
+        # Удаляет невыполненные задачи комнаты (только kinds, если заданы); -> их число
+        pass
+
+    @abstractmethod
+    async def pending_jobs(self, db, room_id):
+        # -> [Job] по возрастанию due_at
+        pass
+
+    # Обслуживание
+    @abstractmethod
+    async def migrate(self, warm=0):
+        # Схема до текущей версии (при запуске и после восстановления из копии),
+        # warm — сколько недавних комнат положить в кэш
+        pass
+
+
+# ---------------------------------------
+# SQLite (aiosqlite, database.pool)
+# ---------------------------------------
+class SQLiteRepository(Repository):
+    def __init__(self, pool, batcher):
+        self.pool = pool
+        self.batcher = batcher
+
+    @asynccontextmanager
+    async def session(self):
+        async with self.pool.acquire() as db:
+            yield db
+
+    # Одиночные записи: один и тот же запрос идёт либо в batcher (write),
+    # либо в транзакцию вызывающего кода
+    _writes = {
+        "join": lambda room_id, user_id, username: (JOIN_SQL, (room_id, user_id, username)),
+        "rejoin": lambda room_id, user_id, username=None: (REJOIN_SQL, (username, room_id, user_id)),
+        "leave": lambda room_id, user_id: (LEAVE_SQL, (room_id, user_id)),
+        "touch_room": lambda room_id, at: (TOUCH_ROOM_SQL, (at, room_id)),
+        "set_member_profile": lambda room_id, user_id, column, value: (
+            f"UPDATE participants SET {column}=? WHERE room_id=? AND user_id=?", (value, room_id, user_id)
+        ),
+        "set_profile": lambda user_id, column, value: (
+            f"INSERT INTO profiles (user_id, {column}) VALUES (?, ?) "
+            f"ON CONFLICT (user_id) DO UPDATE SET {column}=excluded.{column}",
+            (user_id, value)
+        ),
+    }
+
+    async def write(self, op, *args):
+        return await self.batcher.submit(*self._writes[op](*args)) > 0
+
+    async def _execute(self, db, op, *args):
+        cur = await db.execute(*self._writes[op](*args))
+        return cur.rowcount > 0
+
+    async def create_room(self, db, admin_id, title):
+        return await room_ids.create_room(db, admin_id, title)
+
+    async def get_room(self, db, room_id):
+        return await get_room(db, room_id)
+
+    async def touch_room(self, db, room_id, at):
+        return await self._execute(db, "touch_room", room_id, at)
+
+    async def update_room(self, db, room_id, column, value):
+        await db.execute(f"UPDATE rooms SET {column}=?, updated_at=? WHERE id=?", (value, time.time(), room_id))
+
+    async def room_status(self, db, room_id):
+        cur = await db.execute("SELECT status FROM rooms WHERE id=?", (room_id,))
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def rooms_of(self, db, user_id, after_id=0, before_id=None, limit=20):
+        # Диапазон первичного ключа memberships (user_id, room_id), таблицу ведут
+        # триггеры (database._add_memberships)
+        if before_id is None:
+            sql = "SELECT room_id, role, title, status FROM memberships WHERE user_id=? AND room_id>? ORDER BY room_id LIMIT ?"
+            cur = await db.execute(sql, (user_id, after_id, limit))
+        else:
+            sql = "SELECT room_id, role, title, status FROM memberships WHERE user_id=? AND room_id<? ORDER BY room_id DESC LIMIT ?"
+            cur = await db.execute(sql, (user_id, before_id, limit))
+        return await cur.fetchall()
+
+    async def member_left(self, db, room_id, user_id):
+        cur = await db.execute("SELECT left FROM participants WHERE room_id=? AND user_id=?", (room_id, user_id))
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def member_by_id(self, db, room_id, participant_id):
+        cur = await db.execute("SELECT user_id, username FROM participants WHERE id=? AND room_id=?", (participant_id, room_id))
+        return await cur.fetchone()
+
+    async def find_member(self, db, room_id, username, user_id=None):
+        cur = await db.execute(
+            "SELECT user_id FROM participants WHERE room_id=? AND (username=? OR user_id=?)", (room_id, username, user_id)
+        )
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def members_page(self, db, room_id, after_id=0, before_id=None, limit=20):
+        # Keyset-пагинация по participants.id: читается одна страница, а не вся комната
+        if before_id is None:
+            cur = await db.execute(f"{MEMBERS_PAGE_SQL} AND p.id>? ORDER BY p.id LIMIT ?", (room_id, after_id, limit))
+            return await cur.fetchall()
+        cur = await db.execute(f"{MEMBERS_PAGE_SQL} AND p.id<? ORDER BY p.id DESC LIMIT ?", (room_id, before_id, limit))
+        return (await cur.fetchall())[::-1]
+
+    async def count_members(self, db, room_id, before_id=None):
+        # С before_id — диапазон индекса idx_participants_room перед этим id
+        if before_id is None:
+            cur = await db.execute("SELECT COUNT(*) FROM participants WHERE room_id=?", (room_id,))
+        else:
+            cur = await db.execute("SELECT COUNT(*) FROM participants WHERE room_id=? AND id<?", (room_id, before_id))
+        return (await cur.fetchone())[0]
+
+    async def has_members_after(self, db, room_id, participant_id):
+        cur = await db.execute("SELECT EXISTS(SELECT 1 FROM participants WHERE room_id=? AND id>?)", (room_id, participant_id))
+        return bool((await cur.fetchone())[0])
+
+    async def active_members(self, db, room_id):
+        cur = await db.execute("SELECT user_id, username FROM participants WHERE room_id=? AND left=0", (room_id,))
+        return await cur.fetchall()
+
+    async def members_without_wishes(self, db, room_id):
+        cur = await db.execute(
+            "SELECT p.user_id FROM participants p LEFT JOIN profiles pr ON pr.user_id=p.user_id "
+            "WHERE p.room_id=? AND p.left=0 AND COALESCE(p.wishes, pr.wishes, '')=''",
+            (room_id,)
+        )
+        return [row[0] for row in await cur.fetchall()]
+
+    async def member_targets(self, db, room_id):
+        cur = await db.execute("""
+            SELECT p.user_id, t.username FROM participants p
+            LEFT JOIN participants t ON t.room_id=p.room_id AND t.user_id=p.target_id
+            WHERE p.room_id=? AND p.left=0
+        """, (room_id,))
+        return await cur.fetchall()
+
+    async def join(self, db, room_id, user_id, username):
+        return await self._execute(db, "join", room_id, user_id, username)
+
+    async def rejoin(self, db, room_id, user_id, username=None):
+        return await self._execute(db, "rejoin", room_id, user_id, username)
+
+    async def leave(self, db, room_id, user_id):
+        return await self._execute(db, "leave", room_id, user_id)
+
+    async def draw_profiles(self, db, room_id, user_ids=None):
+        # Все профили комнаты одним запросом, а не SELECT на каждого получателя
+        sql = ("SELECT p.user_id, p.username, COALESCE(p.wishes, pr.wishes), COALESCE(p.no_gifts, pr.no_gifts) "
+               "FROM participants p LEFT JOIN profiles pr ON pr.user_id=p.user_id WHERE p.room_id=? AND p.left=0")
+        if user_ids is not None:
+            sql += f" AND p.user_id IN ({','.join('?' * len(user_ids))})"
+        cur = await db.execute(sql, (room_id, *(user_ids or ())))
+        return {row[0]: row[1:] for row in await cur.fetchall()}
+
+    async def set_member_profile(self, db, room_id, user_id, column, value):
+        return await self._execute(db, "set_member_profile", room_id, user_id, column, value)
+
+    async def set_profile(self, db, user_id, column, value):
+        return await self._execute(db, "set_profile", user_id, column, value)
+
+    async def members_left(self, db, room_id, user_ids):
+        marks = ",".join("?" * len(user_ids))
+        cur = await db.execute(
+            f"SELECT user_id, left FROM participants WHERE room_id=? AND user_id IN ({marks})", (room_id, *user_ids)
+        )
+        return dict(await cur.fetchall())
+
+    async def members_by_refs(self, db, room_id, user_ids, usernames):
+        conditions = []
+        if user_ids:
+            conditions.append(f"user_id IN ({','.join('?' * len(user_ids))})")
+        if usernames:
+            conditions.append(f"username IN ({','.join('?' * len(usernames))})")
+        if not conditions:
+            return {}
+        cur = await db.execute(
+            f"SELECT user_id, username FROM participants WHERE room_id=? AND ({' OR '.join(conditions)})",
+            (room_id, *user_ids, *usernames)
+        )
+        return dict(await cur.fetchall())
+
+    async def import_members(self, db, room_id, rows):
+        await db.executemany("""
+        INSERT INTO participants (room_id, user_id, username, wishes, no_gifts) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (room_id, user_id) DO UPDATE SET username=excluded.username, left=0,
+            wishes=COALESCE(excluded.wishes, wishes), no_gifts=COALESCE(excluded.no_gifts, no_gifts)
+        """, [(room_id, *row) for row in rows])
+
+    async def is_banned(self, db, room_id, user_id):
+        cur = await db.execute("SELECT 1 FROM bans WHERE room_id=? AND user_id=?", (room_id, user_id))
+        return await cur.fetchone() is not None
+
+    async def ban(self, db, room_id, user_id, username=None):
+        await db.execute(
+            "INSERT OR IGNORE INTO bans (room_id, user_id, username) VALUES (?, ?, ?)", (room_id, user_id, username)
+        )
+        await db.execute("DELETE FROM participants WHERE room_id=? AND user_id=?", (room_id, user_id))
+
+    async def banned_among(self, db, room_id, user_ids):
+        marks = ",".join("?" * len(user_ids))
+        cur = await db.execute(f"SELECT user_id FROM bans WHERE room_id=? AND user_id IN ({marks})", (room_id, *user_ids))
+        return {row[0] for row in await cur.fetchall()}
+
+    async def ban_many(self, db, room_id, targets):
+        await db.executemany("""
+        INSERT INTO bans (room_id, user_id, username) VALUES (?, ?, ?)
+        ON CONFLICT (room_id, user_id) DO UPDATE SET username=COALESCE(excluded.username, username)
+        """, [(room_id, user_id, username) for user_id, username in targets.items()])
+        cur = await db.executemany(
+            "DELETE FROM participants WHERE room_id=? AND user_id=?", [(room_id, user_id) for user_id in targets]
+        )
+        return cur.rowcount
+
+    async def unban(self, db, room_id, refs):
+        cur = await db.executemany(
+            "DELETE FROM bans WHERE room_id=? AND (user_id=? OR username=?)",
+            [(room_id, int(ref) if ref.isdigit() else None, ref) for ref in refs]
+        )
+        return cur.rowcount
+
+    async def exclusions(self, db, room_id):
+        cur = await db.execute("SELECT giver_id, receiver_id FROM exclusions WHERE room_id=?", (room_id,))
+        return await cur.fetchall()
+
+    async def exclusion_list(self, db, room_id):
+        cur = await db.execute("""
+        SELECT g.username, r.username, e.kind FROM exclusions e
+        LEFT JOIN participants g ON g.room_id=e.room_id AND g.user_id=e.giver_id
+        LEFT JOIN participants r ON r.room_id=e.room_id AND r.user_id=e.receiver_id
+        WHERE e.room_id=?
+        """, (room_id,))
+        return await cur.fetchall()
+
+    async def add_exclusions(self, db, room_id, pairs, kind, replace=False):
+        cur = await db.executemany(f"""
+        INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO exclusions (room_id, giver_id, receiver_id, kind)
+        SELECT ?, ?, ?, ? WHERE
+            EXISTS (SELECT 1 FROM participants WHERE room_id=? AND user_id=?) AND
+            EXISTS (SELECT 1 FROM participants WHERE room_id=? AND user_id=?)
+        """, [(room_id, giver, receiver, kind, room_id, giver, room_id, receiver) for giver, receiver in pairs])
+        return cur.rowcount
+
+    async def remove_exclusions(self, db, room_id, pairs):
+        await db.executemany(
+            "DELETE FROM exclusions WHERE room_id=? AND giver_id=? AND receiver_id=?",
+            [(room_id, giver, receiver) for giver, receiver in pairs]
+        )
+
+    async def drawn_pairs(self, db, room_id):
+        cur = await db.execute(
+            "SELECT user_id, target_id FROM participants WHERE room_id=? AND target_id IS NOT NULL", (room_id,)
+        )
+        return await cur.fetchall()
+
+    async def save_pairs(self, db, room_id, pairs):
+        # Все target_id одним executemany в текущей транзакции. С updated_at
+        # отсчитывается срок до переноса комнаты в архив (archive.py); кэш комнаты
+        # сбрасывает вызывающий код после commit (invalidate_room)
+        await db.executemany(
+            "UPDATE participants SET target_id=? WHERE room_id=? AND user_id=?",
+            [(receiver, room_id, giver) for giver, receiver in pairs.items()]
+        )
+        await db.execute("UPDATE rooms SET status='drawn', updated_at=? WHERE id=?", (time.time(), room_id))
+
+    async def repair_join(self, db, room_id, user_id):
+        return await draw_repair.add_participant(db, room_id, user_id)
+
+    async def repair_leave(self, db, room_id, user_id):
+        return await draw_repair.remove_participant(db, room_id, user_id)
+
+    async def enqueue(self, db, messages):
+        await outbox.enqueue(db, messages)
+
+    async def add_job(self, db, room_id, kind, due_at, payload=None):
+        return await scheduler.add(db, room_id, kind, due_at, payload)
+
+    async def cancel_jobs(self, db, room_id, kinds=None):
+        return await scheduler.cancel(db, room_id, kinds)
+
+    async def pending_jobs(self, db, room_id):
+        return await scheduler.pending(db, room_id)
+
+    async def migrate(self, warm=0):
+        async with self.pool.acquire() as db:
+            await migrate(db)
+            if warm:
+                await warm_rooms(db, warm)
+
+
+# ---------------------------------------
+# В памяти
+# ---------------------------------------
+# Индексы повторяют индексы santa.db: участники по комнате (в порядке
+# добавления, как idx_participants_room) и комнаты по пользователю (memberships).
+# room_id приводится к числу через room_key: SQLite сравнивает "1234" и 1234 сама.
+# Сообщения для outbox складываются в список sent, отложенные задачи — в jobs
+# (их никто не выполняет). Запреты комнаты — {(даритель, получатель): kind}.
+class _MemorySession:
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+class MemoryRepository(Repository):
+    def __init__(self):
+        self.rooms = {}
+        self.members = {}
+        self.user_rooms = {}
+        self.bans = {}
+        self.exclusion_pairs = {}
+        self.profiles = {}
+        self.sent = []
+        self.jobs = {}
+        self._counter = 0
+        self._member_ids = itertools.count(1)
+        self._job_ids = itertools.count(1)
+        self._key = secrets.token_bytes(32)
+        self._session = _MemorySession()
+
+    @asynccontextmanager
+    async def session(self):
+        yield self._session
+
+    def _room_members(self, room_id):
+        return self.members.get(room_key(room_id), {})
+
+    async def create_room(self, db, admin_id, title):
+        room_id = room_ids.room_id_for(self._counter, self._key)
+        self._counter += 1
+        self.rooms[room_id] = Room(room_id, admin_id, title, "open", None, None, time.time())
+        self.members[room_id] = {}
+        self.user_rooms.setdefault(admin_id, {})[room_id] = "admin"
+        return room_id
+
+    async def get_room(self, db, room_id):
+        return self.rooms.get(room_key(room_id))
+
+    async def touch_room(self, db, room_id, at):
+        room_id = room_key(room_id)
+        if room_id not in self.rooms:
+            return False
+        self.rooms[room_id] = self.rooms[room_id]._replace(updated_at=at)
+        return True
+
+    async def update_room(self, db, room_id, column, value):
+        room_id = room_key(room_id)
+        if room_id in self.rooms:
+            self.rooms[room_id] = self.rooms[room_id]._replace(**{column: value, "updated_at": time.time()})
+
+    async def room_status(self, db, room_id):
+        room = self.rooms.get(room_key(room_id))
+        return room.status if room else None
+
+    async def rooms_of(self, db, user_id, after_id=0, before_id=None, limit=20):
+        rooms = self.user_rooms.get(user_id, {})
+        if before_id is None:
+            ids = sorted(r for r in rooms if r > after_id)[:limit]
+        else:
+            ids = sorted((r for r in rooms if r < before_id), reverse=True)[:limit]
+        return [(r, rooms[r], self.rooms[r].title, self.rooms[r].status) for r in ids]
+
+    async def member_left(self, db, room_id, user_id):
+        member = self._room_members(room_id).get(user_id)
+        return member.left if member else None
+
+    async def member_by_id(self, db, room_id, participant_id):
+        for member in self._room_members(room_id).values():
+            if member.id == participant_id:
+                return member.user_id, member.username
+        return None
+
+    async def find_member(self, db, room_id, username, user_id=None):
+        for member in self._room_members(room_id).values():
+            if member.username == username or member.user_id == user_id:
+                return member.user_id
+        return None
+
+    # Участники комнаты лежат в порядке добавления, то есть по возрастанию id
+    async def members_page(self, db, room_id, after_id=0, before_id=None, limit=20):
+        members = self._room_members(room_id).values()
+        if before_id is None:
+            page = [m for m in members if m.id > after_id][:limit]
+        else:
+            page = [m for m in members if m.id < before_id][-limit:]
+        return [(m.id, m.username, *self._profile_of(m), m.left) for m in page]
+
+    async def count_members(self, db, room_id, before_id=None):
+        members = self._room_members(room_id).values()
+        return sum(1 for m in members if before_id is None or m.id < before_id)
+
+    async def has_members_after(self, db, room_id, participant_id):
+        return any(m.id > participant_id for m in self._room_members(room_id).values())
+
+    async def active_members(self, db, room_id):
+        return [(m.user_id, m.username) for m in self._room_members(room_id).values() if not m.left]
+
+    async def members_without_wishes(self, db, room_id):
+        return [m.user_id for m in self._room_members(room_id).values() if not m.left and not self._profile_of(m)[0]]
+
+    async def member_targets(self, db, room_id):
+        members = self._room_members(room_id)
+        return [(m.user_id, members[m.target_id].username if m.target_id in members else None)
+                for m in members.values() if not m.left]
+
+    async def join(self, db, room_id, user_id, username):
+        room_id = room_key(room_id)
+        members = self.members.setdefault(room_id, {})
+        if user_id in members:
+            return False
+        members[user_id] = Member(next(self._member_ids), user_id, username, None, None, None, 0)
+        self.user_rooms.setdefault(user_id, {}).setdefault(room_id, "member")
+        return True
+
+    async def rejoin(self, db, room_id, user_id, username=None):
+        room_id = room_key(room_id)
+        member = self._room_members(room_id).get(user_id)
+        if member is None:
+            return False
+        self.members[room_id][user_id] = member._replace(left=0, username=username or member.username)
+        self.user_rooms.setdefault(user_id, {}).setdefault(room_id, "member")
+        return True
+
+    async def leave(self, db, room_id, user_id):
+        room_id = room_key(room_id)
+        member = self._room_members(room_id).get(user_id)
+        if member is None or member.left:
+            return False
+        self.members[room_id][user_id] = member._replace(left=1)
+        self._forget(room_id, user_id)
+        return True
+
+    def _forget(self, room_id, user_id):
+        rooms = self.user_rooms.get(user_id, {})
+        if rooms.get(room_id) == "member":
+            del rooms[room_id]
+
+    def _profile_of(self, member):
+        # Как COALESCE в SQL: профиль подставляется только вместо NULL, пустая строка остаётся
+        wishes, no_gifts = self.profiles.get(member.user_id, (None, None))
+        return (wishes if member.wishes is None else member.wishes,
+                no_gifts if member.no_gifts is None else member.no_gifts)
+
+    async def draw_profiles(self, db, room_id, user_ids=None):
+        return {member.user_id: (member.username, *self._profile_of(member))
+                for member in self._room_members(room_id).values()
+                if not member.left and (user_ids is None or member.user_id in user_ids)}
+
+    async def set_member_profile(self, db, room_id, user_id, column, value):
+        room_id = room_key(room_id)
+        member = self._room_members(room_id).get(user_id)
+        if member is None:
+            return False
+        self.members[room_id][user_id] = member._replace(**{column: value})
+        return True
+
+    async def set_profile(self, db, user_id, column, value):
+        profile = dict(zip(PROFILE_COLUMNS, self.profiles.get(user_id, (None, None))))
+        profile[column] = value
+        self.profiles[user_id] = tuple(profile.values())
+        return True
+
+    async def members_left(self, db, room_id, user_ids):
+        members = self._room_members(room_id)
+        return {user_id: members[user_id].left for user_id in user_ids if user_id in members}
+
+    async def members_by_refs(self, db, room_id, user_ids, usernames):
+        user_ids, usernames = set(user_ids), set(usernames)
+        return {m.user_id: m.username for m in self._room_members(room_id).values()
+                if m.user_id in user_ids or m.username in usernames}
+
+    async def import_members(self, db, room_id, rows):
+        room_id = room_key(room_id)
+        members = self.members.setdefault(room_id, {})
+        for user_id, username, wishes, no_gifts in rows:
+            member = members.get(user_id)
+            if member is None:
+                members[user_id] = Member(next(self._member_ids), user_id, username, wishes, no_gifts, None, 0)
+            else:
+                members[user_id] = member._replace(
+                    username=username, left=0,
+                    wishes=member.wishes if wishes is None else wishes,
+                    no_gifts=member.no_gifts if no_gifts is None else no_gifts,
+                )
+            self.user_rooms.setdefault(user_id, {}).setdefault(room_id, "member")
+
+    async def is_banned(self, db, room_id, user_id):
+        return (room_key(room_id), user_id) in self.bans
+
+    async def ban(self, db, room_id, user_id, username=None):
+        room_id = room_key(room_id)
+        self.bans.setdefault((room_id, user_id), username)
+        if self.members.get(room_id, {}).pop(user_id, None) is not None:
+            self._forget(room_id, user_id)
+
+    async def banned_among(self, db, room_id, user_ids):
+        room_id = room_key(room_id)
+        return {user_id for user_id in user_ids if (room_id, user_id) in self.bans}
+
+    async def ban_many(self, db, room_id, targets):
+        room_id = room_key(room_id)
+        removed = 0
+        for user_id, username in targets.items():
+            key = (room_id, user_id)
+            self.bans[key] = username if username is not None else self.bans.get(key)
+            if self.members.get(room_id, {}).pop(user_id, None) is not None:
+                self._forget(room_id, user_id)
+                removed += 1
+        return removed
+
+    async def unban(self, db, room_id, refs):
+        room_id = room_key(room_id)
+        removed = 0
+        for ref in refs:
+            user_id = int(ref) if ref.isdigit() else None
+            keys = [key for key, username in self.bans.items()
+                    if key[0] == room_id and (key[1] == user_id or username == ref)]
+            for key in keys:
+                del self.bans[key]
+            removed += len(keys)
+        return removed
+
+    async def exclusions(self, db, room_id):
+        return list(self.exclusion_pairs.get(room_key(room_id), ()))
+
+    async def exclusion_list(self, db, room_id):
+        members = self._room_members(room_id)
+
+        def name(user_id):
+            return members[user_id].username if user_id in members else None
+
+        return [(name(giver), name(receiver), kind)
+                for (giver, receiver), kind in self.exclusion_pairs.get(room_key(room_id), {}).items()]
+
+    async def add_exclusions(self, db, room_id, pairs, kind, replace=False):
+        room_id = room_key(room_id)
+        members = self._room_members(room_id)
+        room_pairs = self.exclusion_pairs.setdefault(room_id, {})
+        added = 0
+        for pair in pairs:
+            if pair[0] in members and pair[1] in members and (replace or pair not in room_pairs):
+                room_pairs[pair] = kind
+                added += 1
+        return added
+
+    async def remove_exclusions(self, db, room_id, pairs):
+        room_pairs = self.exclusion_pairs.get(room_key(room_id), {})
+        for pair in pairs:
+            room_pairs.pop(tuple(pair), None)
+
+    async def drawn_pairs(self, db, room_id):
+        return [(m.user_id, m.target_id) for m in self._room_members(room_id).values() if m.target_id is not None]
+
+    async def save_pairs(self, db, room_id, pairs):
+        room_id = room_key(room_id)
+        self._set_targets(room_id, pairs.items())
+        self.rooms[room_id] = self.rooms[room_id]._replace(status="drawn", updated_at=time.time())
+
+    def _set_targets(self, room_id, changes):
+        members = self.members[room_id]
+        for giver, receiver in changes:
+            members[giver] = members[giver]._replace(target_id=receiver)
+
+    # Починка пар — тот же алгоритм, что в draw_repair, но по словарям
+    def _allowed(self, room_id, giver, receiver):
+        return giver != receiver and (giver, receiver) not in self.exclusion_pairs.get(room_id, ())
+
+    def _random_pair(self, room_id, receiver_for, giver_for, skip_givers, skip_receivers):
+        pairs = [(m.user_id, m.target_id) for m in self.members[room_id].values()
+                 if not m.left and m.target_id is not None
+                 and m.user_id not in skip_givers and m.target_id not in skip_receivers
+                 and self._allowed(room_id, receiver_for, m.target_id) and self._allowed(room_id, m.user_id, giver_for)]
+        return random.choice(pairs) if pairs else None
+
+    async def repair_join(self, db, room_id, user_id):
+        room_id = room_key(room_id)
+        member = self.members[room_id].get(user_id)
+        if member and member.target_id is not None:
+            return []
+        pair = self._random_pair(room_id, user_id, user_id, (user_id,), (user_id,))
+        if pair is None:
+            return None
+        giver, target = pair
+        changes = [(giver, user_id), (user_id, target)]
+        self._set_targets(room_id, changes)
+        return changes
+
+    async def repair_leave(self, db, room_id, user_id):
+        room_id = room_key(room_id)
+        members = self.members[room_id]
+        member = members.get(user_id)
+        target = member.target_id if member else None
+        giver = next((m.user_id for m in members.values() if m.target_id == user_id and m.user_id != user_id), None)
+        if member:
+            self._set_targets(room_id, [(user_id, None)])
+        if target is None or giver is None:
+            return []
+        if self._allowed(room_id, giver, target):
+            changes = [(giver, target)]
+        else:
+            pair = self._random_pair(room_id, giver, target, (giver, target, user_id), (giver, user_id))
+            if pair is None:
+                return None
+            other, other_target = pair
+            changes = [(giver, other_target), (other, target)]
+        self._set_targets(room_id, changes)
+        return changes
+
+    async def enqueue(self, db, messages):
+        self.sent.extend(messages)
+
+    async def add_job(self, db, room_id, kind, due_at, payload=None):
+        job_id = next(self._job_ids)
+        self.jobs[job_id] = Job(job_id, room_key(room_id), kind, due_at, payload or {})
+        return job_id
+
+    async def cancel_jobs(self, db, room_id, kinds=None):
+        room_id = room_key(room_id)
+        ids = [job.id for job in self.jobs.values() if job.room_id == room_id and (not kinds or job.kind in kinds)]
+        for job_id in ids:
+            del self.jobs[job_id]
+        return len(ids)
+
+    async def pending_jobs(self, db, room_id):
+        room_id = room_key(room_id)
+        return sorted((job for job in self.jobs.values() if job.room_id == room_id), key=lambda job: job.due_at)
+
+    async def migrate(self, warm=0):
+        pass
+
+
+repository = SQLiteRepository(pool, batcher)
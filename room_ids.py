@@ -0,0 +1,94 @@
+import hashlib
+import hmac
+import os
+import time
+
+# ---------------------------------------
+# Выдача ID комнат
+# ---------------------------------------
+# Каждая новая комната получает следующий номер счётчика из таблицы meta, а
+# номер превращается в ID секретной перестановкой (сеть Фейстеля с ключом).
+# Перестановка взаимно однозначна, поэтому ID не повторяются и не требуют
+# проверки в цикле, а без ключа следующий ID не угадать.
+#
+# Пространство ID расширяется ярусами: сначала 4-значные 1000–9999 (как было),
+# затем 5-значные 10000–99999 и так далее. Старые ID, ссылки /start и /join
+# продолжают работать — это обычные числа.
+FEISTEL_ROUNDS = 4
+FIRST_TIER_DIGITS = 4
+# Если при миграции 4-значных комнат уже столько, начинаем сразу с 5-значных
+LEGACY_TIER_LIMIT = 1000
+
+
+def tier_bounds(counter):
+    # Номер счётчика -> (наименьший ID яруса, размер яруса, номер внутри яруса)
+    digits = FIRST_TIER_DIGITS
+    while True:
+        low = 10 ** (digits - 1)
+        size = 9 * low
+        if counter < size:
+            return low, size, counter
+        counter -= size
+        digits += 1
+
+
+def tier_start(digits):
+    return sum(9 * 10 ** (d - 1) for d in range(FIRST_TIER_DIGITS, digits))
+
+
+def _round(key, tier_size, number, value, bits):
+    digest = hmac.new(key, f"{tier_size}:{number}:{value}".encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], "big") & ((1 << bits) - 1)
+
+
+def permute(value, size, key):
+    # Сеть Фейстеля на 2*half битах; значения за пределами [0, size)
+    # прогоняются повторно (cycle walking), в среднем не больше 4 раз
+    half = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    while True:
+        left, right = value >> half, value & mask
+        for number in range(FEISTEL_ROUNDS):
+            left, right = right, left ^ _round(key, size, number, right, half)
+        value = (left << half) | right
+        if value < size:
+            return value
+
+
+def room_id_for(counter, key):
+    low, size, offset = tier_bounds(counter)
+    return low + permute(offset, size, key)
+
+
+# ---------------------------------------
+# Работа с базой
+# ---------------------------------------
+_key = None
+
+
+async def _load_key(db):
+    global _key
+    if _key is None:
+        env_key = os.getenv("SANTA_ROOM_ID_KEY")
+        if env_key:
+            _key = env_key.encode()
+        else:
+            cur = await db.execute("SELECT value FROM meta WHERE key='room_id_key'")
+            _key = bytes.fromhex((await cur.fetchone())[0])
+    return _key
+
+
+async def create_room(db, admin_id, title):
+    # Вставляет комнату в текущей транзакции и возвращает её ID, commit делает вызывающий код.
+    # Повтор возможен только при совпадении со старым случайным 4-значным ID.
+    key = await _load_key(db)
+    while True:
+        cur = await db.execute("UPDATE meta SET value=value+1 WHERE key='room_id_counter' RETURNING value-1")
+        counter = (await cur.fetchone())[0]
+        room_id = room_id_for(counter, key)
+        cur = await db.execute(
+            "INSERT OR IGNORE INTO rooms (id, admin_id, title, updated_at) VALUES (?, ?, ?, ?)",
+            (room_id, admin_id, title, time.time())
+        )
+        if cur.rowcount:
+            return room_id
@@ -0,0 +1,187 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from contextlib import asynccontextmanager
+
+from database import pool
+
+# ---------------------------------------
+# Настройки планировщика
+# ---------------------------------------
+# В память загружаются только задачи, срок которых наступит в ближайшие
+# SCHEDULER_HORIZON секунд; таблица перечитывается раз в SCHEDULER_REFILL
+# секунд (так подхватываются задачи, добавленные другими воркерами) и сразу
+# после wake()
+SCHEDULER_HORIZON = float(os.getenv("SANTA_SCHEDULER_HORIZON", "600"))
+SCHEDULER_REFILL = float(os.getenv("SANTA_SCHEDULER_REFILL", "60"))
+# После ошибки (например, "database is locked") цикл ждёт столько секунд и продолжает
+SCHEDULER_ERROR_PAUSE = 5.0
+
+logger = logging.getLogger("santa.scheduler")
+
+Job = namedtuple("Job", "id room_id kind due_at payload")
+
+
+class JobTaken(Exception):
+    # Задачу уже выполнил другой воркер или её отменили
+    pass
+
+
+# ---------------------------------------
+# Постоянные отложенные задачи
+# ---------------------------------------
+# Задача живёт в таблице jobs, пока не выполнена. Обработчик делает всю
+# медленную работу до claim(), а внутри claim() в одной транзакции удаляет
+# задачу и записывает её результат (пары, сообщения в outbox). Если процесс
+# упадёт раньше commit, задача останется в таблице и выполнится после
+# перезапуска; выполнить её дважды не даёт условие status='pending' в DELETE.
+class Scheduler:
+    def __init__(self, pool, horizon=SCHEDULER_HORIZON, refill=SCHEDULER_REFILL):
+        self.pool = pool
+        self.horizon = horizon
+        self.refill = refill
+        self.handlers = {}
+        self._heap = []
+        self._queued = set()
+        self._active = set()
+        self._running = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def handler(self, kind):
+        # Декоратор: @scheduler.handler("draw") async def job_draw(job): ...
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    async def add(self, db, room_id, kind, due_at, payload=None):
+        # Задача добавляется в текущей транзакции; после commit вызовите wake()
+        cur = await db.execute(
+            "INSERT INTO jobs (room_id, kind, due_at, payload) VALUES (?, ?, ?, ?)",
+            (room_id, kind, due_at, json.dumps(payload or {}))
+        )
+        return cur.lastrowid
+
+    async def cancel(self, db, room_id, kinds=None):
+        # Удаляет невыполненные задачи комнаты, возвращает их число
+        sql = "DELETE FROM jobs WHERE room_id=? AND status='pending'"
+        params = [room_id]
+        if kinds:
+            sql += f" AND kind IN ({','.join('?' * len(kinds))})"
+            params += kinds
+        cur = await db.execute(sql, params)
+        return cur.rowcount
+
+    async def pending(self, db, room_id):
+        cur = await db.execute(
+            "SELECT id, room_id, kind, due_at, payload FROM jobs "
+            "WHERE room_id=? AND status='pending' ORDER BY due_at", (room_id,)
+        )
+        return [Job(*row[:4], json.loads(row[4])) for row in await cur.fetchall()]
+
+    @asynccontextmanager
+    async def claim(self, job):
+        async with self.pool.acquire() as db:
+            cur = await db.execute("DELETE FROM jobs WHERE id=? AND status='pending'", (job.id,))
+            if not cur.rowcount:
+                await db.rollback()
+                raise JobTaken()
+            yield db
+            await db.commit()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = list(self._running)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._heap, self._queued = [], set()
+
+    async def _run(self):
+        next_refill = 0
+        while True:
+            try:
+                next_refill = await self._step(next_refill)
+            except Exception:
+                logger.exception("Ошибка планировщика, повтор через %.0f с", SCHEDULER_ERROR_PAUSE)
+                await asyncio.sleep(SCHEDULER_ERROR_PAUSE)
+
+    async def _step(self, next_refill):
+        now = time.time()
+        if now >= next_refill or self._wakeup.is_set():
+            self._wakeup.clear()
+            await self._load(now)
+            next_refill = now + self.refill
+        while self._heap and self._heap[0][0] <= now:
+            _, job_id = heapq.heappop(self._heap)
+            self._queued.discard(job_id)
+            self._active.add(job_id)
+            task = asyncio.create_task(self._execute(job_id))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+        wake_at = min(next_refill, self._heap[0][0]) if self._heap else next_refill
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), max(0, wake_at - time.time()))
+        except asyncio.TimeoutError:
+            pass
+        return next_refill
+
+    async def _load(self, now):
+        async with self.pool.acquire() as db:
+            cur = await db.execute(
+                "SELECT id, due_at FROM jobs WHERE status='pending' AND due_at<=? ORDER BY due_at",
+                (now + self.horizon,)
+            )
+            rows = await cur.fetchall()
+        for job_id, due_at in rows:
+            # Выполняющиеся задачи ещё в таблице, но второй раз их не запускаем
+            if job_id not in self._queued and job_id not in self._active:
+                self._queued.add(job_id)
+                heapq.heappush(self._heap, (due_at, job_id))
+
+    async def _execute(self, job_id):
+        try:
+            await self._execute_job(job_id)
+        finally:
+            self._active.discard(job_id)
+
+    async def _execute_job(self, job_id):
+        async with self.pool.acquire() as db:
+            cur = await db.execute(
+                "SELECT id, room_id, kind, due_at, payload FROM jobs WHERE id=? AND status='pending'", (job_id,)
+            )
+            row = await cur.fetchone()
+        if row is None:
+            return
+        job = Job(*row[:4], json.loads(row[4]))
+        handler = self.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise RuntimeError(f"нет обработчика для задачи {job.kind}")
+            await handler(job)
+        except JobTaken:
+            pass
+        except Exception as e:
+            logger.exception("Задача %s (%s, комната %s) завершилась ошибкой", job.id, job.kind, job.room_id)
+            async with self.pool.acquire() as db:
+                await db.execute(
+                    "UPDATE jobs SET status='failed', error=? WHERE id=? AND status='pending'", (repr(e), job.id)
+                )
+                await db.commit()
+
+
+scheduler = Scheduler(pool)
@@ -0,0 +1,145 @@
+import logging
+import math
+import os
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.exceptions import TelegramAPIError
+
+import metrics
+
+# ---------------------------------------
+# Настройки ограничения частоты
+# ---------------------------------------
+# Общий лимит на пользователя: THROTTLE_RATE апдейтов в секунду с запасом
+# THROTTLE_BURST подряд; 0 — лимиты на пользователей (и по командам) выключены
+THROTTLE_RATE = float(os.getenv("SANTA_THROTTLE_RATE", "3"))
+THROTTLE_BURST = float(os.getenv("SANTA_THROTTLE_BURST", "20"))
+# Больше стольких апдейтов одновременно процесс не обрабатывает, лишние
+# отклоняются сразу; 0 — без ограничения
+MAX_IN_FLIGHT = int(os.getenv("SANTA_MAX_IN_FLIGHT", "500"))
+THROTTLE_MAX_ENTRIES = 100_000
+# Дорогие команды и кнопки (префикс callback_data): (в секунду, запас)
+COMMAND_LIMITS = {
+    "newroom": (1 / 10, 3),
+    "start": (1, 5),
+    "join": (1, 5),
+    "participants": (1 / 2, 5),
+    "draw": (1 / 5, 2),
+    "import": (1 / 10, 3),
+}
+# Отказ объясняем пользователю не чаще раза в NOTICE_INTERVAL секунд, чтобы
+# флуд не превращался в такой же поток ответов
+NOTICE_INTERVAL = 30
+
+logger = logging.getLogger("santa.throttle")
+
+
+# ---------------------------------------
+# Token bucket для множества ключей
+# ---------------------------------------
+# Запись — (жетоны, время последнего обращения) в OrderedDict в порядке
+# обращений. Бакет, простоявший дольше idle, успел наполниться и ничем не
+# отличается от отсутствующего, поэтому такие записи удаляются с начала
+# словаря по ходу работы, без отдельного прохода по всем ключам.
+class TokenBuckets:
+    def __init__(self, idle, max_entries=THROTTLE_MAX_ENTRIES):
+        self.idle = idle
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst, now):
+        # -> 0, если жетон взят, иначе сколько секунд ждать следующего
+        entry = self._buckets.pop(key, None)
+        tokens = burst if entry is None else min(burst, entry[0] + (now - entry[1]) * rate)
+        wait = 0 if tokens >= 1 else (1 - tokens) / rate
+        self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+        self._evict(now)
+        return wait
+
+    def _evict(self, now):
+        while self._buckets:
+            key, (_, last) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_entries and now - last < self.idle:
+                break
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def command_of(update):
+    # Имя команды без @бота или префикс кнопки
+    text = update.message and (update.message.text or update.message.caption)
+    if text and text.startswith("/"):
+        return text.split()[0][1:].split("@")[0].lower()
+    if update.callback_query and update.callback_query.data:
+        return update.callback_query.data.split("_")[0]
+    return None
+
+
+# ---------------------------------------
+# Middleware
+# ---------------------------------------
+class ThrottleMiddleware(BaseMiddleware):
+    # Внешний middleware на dp.update: отказ стоит одного ответа и не трогает
+    # ни базу, ни FSM. В режиме webhook лимиты считаются в каждом воркере.
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST, commands=COMMAND_LIMITS,
+                 max_in_flight=MAX_IN_FLIGHT):
+        self.rate = rate
+        self.burst = burst
+        self.commands = commands
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        limits = [(rate or 1, burst)] + list(commands.values()) + [(1 / NOTICE_INTERVAL, 1)]
+        self.buckets = TokenBuckets(idle=max(b / r for r, b in limits))
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            metrics.throttled_updates.inc("overload")
+            return await self._refuse(event, user, "⏳ Бот сейчас перегружен, попробуйте через минуту.")
+        if user is not None and self.rate:
+            wait = self._wait(user.id, command_of(event))
+            if wait:
+                metrics.throttled_updates.inc("rate")
+                return await self._refuse(event, user, f"⏳ Слишком часто. Попробуйте через {math.ceil(wait)} с.")
+        self.in_flight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+
+    def _wait(self, user_id, command):
+        now = time.monotonic()
+        wait = self.buckets.take(user_id, self.rate, self.burst, now)
+        if not wait and command in self.commands:
+            wait = self.buckets.take((user_id, command), *self.commands[command], now)
+        return wait
+
+    async def _refuse(self, update, user, text):
+        # Объясняем не чаще раза в NOTICE_INTERVAL, но кнопку «отпускаем» всегда,
+        # иначе у пользователя так и крутятся часики
+        notify = user is not None and not self.buckets.take((user.id, "notice"), 1 / NOTICE_INTERVAL, 1, time.monotonic())
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text if notify else None)
+            elif update.message and notify:
+                await update.message.answer(text)
+        except TelegramAPIError as e:
+            logger.warning("Не удалось ответить на отклонённый апдейт %s: %s", update.update_id, e)
+        return None
+
+
+def setup(dp):
+    # Dispatcher сам регистрирует внешний FSMContextMiddleware, и всё, что
+    # добавлено через outer_middleware(), выполнялось бы после чтения состояния
+    # из базы. Снимаем его (dp.fsm) и регистрируем заново после ограничителя:
+    # отказ не трогает ни базу, ни FSM. Вызывать последним из внешних middleware
+    # dp.update; event_from_user к этому моменту уже заполнил UserContextMiddleware.
+    middleware = ThrottleMiddleware()
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(middleware)
+    dp.update.outer_middleware(dp.fsm)
+    return middleware
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from lifecycle import SHUTDOWN_TIMEOUT
+
+# ---------------------------------------
+# Настройки режима webhook
+# ---------------------------------------
+WEBHOOK_HOST = os.getenv("SANTA_WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("SANTA_WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("SANTA_WEBHOOK_PATH", "/webhook")
+# Публичный адрес, который сообщается Telegram (например https://santa.example.com).
+# Если не задан, webhook не регистрируется — удобно для локальной проверки.
+WEBHOOK_URL = os.getenv("SANTA_WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("SANTA_WEBHOOK_SECRET")
+WEB_WORKERS = int(os.getenv("SANTA_WEB_WORKERS", "1"))
+# Сколько родитель ждёт остановки воркеров после SIGTERM или Ctrl+C, прежде чем
+# добить их SIGKILL: воркер сам укладывается в SHUTDOWN_TIMEOUT, плюс запас
+WORKERS_STOP_TIMEOUT = SHUTDOWN_TIMEOUT + 5
+
+
+# ---------------------------------------
+# Запуск aiohttp-приложения в одном или нескольких процессах
+# ---------------------------------------
+# Сокет открывается один раз в родительском процессе, воркеры получают его через
+# fork и принимают соединения с него, ядро распределяет их между процессами.
+# Каждый воркер — отдельный event loop со своим пулом соединений к santa.db.
+# В обработчики startup/shutdown диспетчера передаются worker_index и workers.
+# systemd и docker присылают SIGTERM только родителю: он передаёт его каждому
+# воркеру и ждёт их штатной остановки (on_shutdown) не дольше WORKERS_STOP_TIMEOUT.
+def run(dp, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET, workers=WEB_WORKERS):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+
+    if workers <= 1:
+        return _serve(dp, bot, sock, path, secret, 0, 1)
+
+    ctx = multiprocessing.get_context("fork")
+    processes = [
+        ctx.Process(target=_serve, args=(dp, bot, sock, path, secret, index, workers), name=f"santa-worker-{index}")
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    sock.close()
+    # Обработчик ставится после fork, воркерам остаётся свой (aiohttp run_app)
+    signal.signal(signal.SIGTERM, lambda signum, frame: _forward_sigterm(processes))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Ctrl+C: SIGINT уже получила вся группа процессов, повторный сигнал
+        # прервал бы воркерам on_shutdown
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        _join(processes, WORKERS_STOP_TIMEOUT)
+
+
+def _forward_sigterm(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    # Прерываем бессрочный join() в run(), дальше ждём уже с таймаутом
+    raise KeyboardInterrupt
+
+
+def _join(processes, timeout):
+    deadline = time.monotonic() + timeout
+    for process in processes:
+        process.join(max(0.0, deadline - time.monotonic()))
+    for process in processes:
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+
+def _serve(dp, bot, sock, path, secret, worker_index, workers):
+    app = web.Application()
+    # on_shutdown вызываются по порядку: сначала shutdown диспетчера (дожидается
+    # обработчиков и рассылки), и только потом обработчик webhook закрывает сессию бота
+    setup_application(app, dp, bot=bot, worker_index=worker_index, workers=workers)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=path)
+    web.run_app(app, sock=sock, print=None)